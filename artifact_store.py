@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище сгенерированных артефактов NinjaEssayAI
+
+Файлы (готовые .docx и промежуточный JSON с главами) хранятся в каталоге
+generated/ по хешу содержимого: одинаковые файлы занимают место один раз.
+Время последнего обращения хранится в mtime файла — по нему работает
+вытеснение по TTL и LRU при превышении квоты.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+
+class ArtifactStore:
+    """Content-addressed хранилище файлов с квотой и вытеснением"""
+
+    def __init__(self, root: str = "generated", max_bytes: int = 1024 * 1024 * 1024,
+                 ttl_seconds: int = 30 * 24 * 3600):
+        """
+        Args:
+            root: Корневой каталог хранилища
+            max_bytes: Максимальный суммарный размер файлов
+            ttl_seconds: Через сколько секунд без обращений файл удаляется
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Считается лениво при первом обращении
+
+    @staticmethod
+    def make_key(data: bytes, suffix: str = "") -> str:
+        """Возвращает ключ артефакта: sha256 содержимого + расширение"""
+        return hashlib.sha256(data).hexdigest() + suffix
+
+    def path_for(self, key: str) -> Path:
+        """Путь к файлу артефакта (двухуровневое дерево по префиксу хеша)"""
+        return self.root / key[:2] / key[2:4] / key
+
+    def put(self, data: bytes, suffix: str = "") -> str:
+        """
+        Сохраняет данные и возвращает ключ артефакта
+
+        Если такой файл уже есть, он не перезаписывается, а только
+        помечается как недавно использованный.
+        """
+        key = self.make_key(data, suffix)
+        path = self.path_for(key)
+        with self._lock:
+            if path.exists():
+                self._touch(path)
+                return key
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Пишем во временный файл и атомарно переименовываем
+            tmp_path = path.with_name(f".{key}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            if self._total_bytes is not None:
+                self._total_bytes += len(data)
+
+        logging.info(f"Артефакт сохранён: {key} ({len(data)} байт)")
+
+        if self._current_size() > self.max_bytes:
+            self.evict()
+        return key
+
+    def get(self, key: str) -> bytes:
+        """Читает артефакт по ключу или возвращает None, если он вытеснен"""
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._touch(path)
+        return data
+
+    def exists(self, key: str) -> bool:
+        return self.path_for(key).exists()
+
+    def evict(self) -> int:
+        """
+        Удаляет устаревшие файлы (TTL), затем самые давно использованные,
+        пока суммарный размер не станет меньше квоты
+
+        Returns:
+            Количество удалённых файлов
+        """
+        now = time.time()
+        removed = 0
+        with self._lock:
+            files = []
+            for path in self.root.rglob("*"):
+                if not path.is_file() or path.name.startswith("."):
+                    continue
+                stat = path.stat()
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            total = 0
+            alive = []
+            for mtime, size, path in files:
+                if self.ttl_seconds and now - mtime > self.ttl_seconds:
+                    removed += self._unlink(path)
+                else:
+                    alive.append((mtime, size, path))
+                    total += size
+
+            # LRU: сначала удаляем файлы с самым старым временем обращения
+            alive.sort()
+            for mtime, size, path in alive:
+                if total <= self.max_bytes:
+                    break
+                removed += self._unlink(path)
+                total -= size
+
+            self._total_bytes = total
+
+        if removed:
+            logging.info(f"Из хранилища артефактов удалено файлов: {removed}")
+        return removed
+
+    def _current_size(self) -> int:
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(
+                    p.stat().st_size for p in self.root.rglob("*")
+                    if p.is_file() and not p.name.startswith(".")
+                )
+            return self._total_bytes
+
+    @staticmethod
+    def _touch(path: Path) -> None:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _unlink(path: Path) -> int:
+        try:
+            path.unlink()
+            return 1
+        except OSError as e:
+            logging.warning(f"Не удалось удалить артефакт {path}: {e}")
+            return 0
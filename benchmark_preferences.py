@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏱️ Бенчмарк распределения пожеланий по главам (preference_matcher.py)
+
+Сравнивает preference_matcher.parse_preferences_by_chapter с прежней
+реализацией из bot.py:
+1. На наборе планов и пожеланий проверяет, что без морфологии
+   (morphology=False) результат совпадает полностью
+2. Измеряет время на планах разной длины (до 35 глав дипломной работы)
+   и на длинных текстах пожеланий
+3. Показывает, сколько предложений остаётся в общих пожеланиях и сколько
+   символов пожеланий попадает в промпты глав без морфологии и с ней
+
+Запуск: py benchmark_preferences.py [--repeat 5]
+"""
+
+import re
+import sys
+import time
+import random
+import argparse
+import logging
+
+import preference_matcher
+
+# Отладочный вывод распределения не нужен в выводе бенчмарка
+logging.disable(logging.INFO)
+
+
+# ===================== ПРЕЖНЯЯ РЕАЛИЗАЦИЯ (эталон) =====================
+
+def reference_parse_preferences_by_chapter(preferences: str, plan_array: list) -> dict:
+    """Прежняя реализация из bot.py (без изменений)"""
+    result = {
+        'global': '',
+        'by_chapter': {}
+    }
+    
+    if not preferences or preferences == "Без особых предпочтений":
+        return result
+    
+    # === ЭТАП 1: Базовые ключевые слова для типовых разделов ===
+    base_chapter_keywords = {
+        'введение': ['введение', 'введении', 'во введение', 'для введения', 'во введении'],
+        'заключение': ['заключение', 'заключении', 'в заключение', 'для заключения', 'в заключении'],
+        'основная часть': ['основная часть', 'основной части', 'в основной части', 'основную часть'],
+    }
+    
+    # === ЭТАП 2: Контентные ключевые слова (по смыслу содержания) ===
+    content_keywords = {
+        'введение': [
+            'цель', 'задачи', 'задач', 'актуальность', 'актуальности', 
+            'проблема', 'проблемы', 'постановка задачи',
+            'объект исследования', 'предмет исследования', 'гипотеза', 'гипотезу'
+        ],
+        'основная часть': [
+            'методология', 'методологию', 'анализ', 'исследование', 'практика', 
+            'теория', 'теоретическая часть', 'обзор литературы', 
+            'эксперимент', 'данные', 'данных', 'результаты', 'результатов'
+        ],
+        'заключение': [
+            'выводы', 'вывод', 'итоги', 'итог', 'резюме', 'достижения', 
+            'перспективы', 'перспектив', 'рекомендации', 'рекомендаций',
+            'заключительные положения'
+        ]
+    }
+    
+    # === ЭТАП 3: Создание словаря ключевых слов для каждой главы плана ===
+    all_chapter_keywords = {}
+    for chapter in plan_array:
+        chapter_lower = chapter.lower()
+        all_chapter_keywords[chapter_lower] = [chapter_lower]
+        
+        # Добавляем базовые ключевые слова
+        for base_chapter, keywords in base_chapter_keywords.items():
+            if base_chapter in chapter_lower:
+                all_chapter_keywords[chapter_lower].extend(keywords)
+                # Добавляем контентные ключевые слова
+                if base_chapter in content_keywords:
+                    all_chapter_keywords[chapter_lower].extend(content_keywords[base_chapter])
+    
+    # === ЭТАП 4: Разбиваем пожелания на предложения ===
+    sentences = re.split(r'[.;!?]', preferences)
+    
+    for sentence in sentences:
+        sentence = sentence.strip()
+        if not sentence or len(sentence) < 5:
+            continue
+        
+        sentence_lower = sentence.lower()
+        matched = False
+        
+        # === ЭТАП 5: Поиск соответствий по ключевым словам ===
+        for chapter in plan_array:
+            chapter_lower = chapter.lower()
+            keywords = all_chapter_keywords.get(chapter_lower, [])
+            
+            # Проверяем наличие любого ключевого слова в предложении
+            for keyword in keywords:
+                if keyword in sentence_lower:
+                    if chapter not in result['by_chapter']:
+                        result['by_chapter'][chapter] = []
+                    
+                    # Убираем упоминание главы из текста пожелания
+                    cleaned = re.sub(
+                        f'({"|".join(re.escape(k) for k in keywords)})',
+                        '',
+                        sentence,
+                        flags=re.IGNORECASE
+                    ).strip()
+                    
+                    # Очищаем от лишних предлогов в начале
+                    cleaned = re.sub(r'^(в|для|по|о|про)\s+', '', cleaned, flags=re.IGNORECASE).strip()
+                    
+                    if cleaned and len(cleaned) > 5:
+                        result['by_chapter'][chapter].append(cleaned)
+                    matched = True
+                    break
+            
+            if matched:
+                break
+        
+        # Если не нашли соответствий - это общее пожелание для всей работы
+        if not matched:
+            if result['global']:
+                result['global'] += '. ' + sentence
+            else:
+                result['global'] = sentence
+    
+    # === ЭТАП 6: Объединяем списки пожеланий для каждой главы в строку ===
+    for chapter in result['by_chapter']:
+        if isinstance(result['by_chapter'][chapter], list):
+            result['by_chapter'][chapter] = '. '.join(result['by_chapter'][chapter])
+    
+    # === ЛОГИРОВАНИЕ ДЛЯ ОТЛАДКИ ===
+    logging.info("📋 Умное распределение пожеланий по главам:")
+    logging.info(f"   Общие пожелания: {result['global']}")
+    for chapter, prefs in result['by_chapter'].items():
+        logging.info(f"   {chapter}: {prefs}")
+    
+    return result
+
+
+# ===================== КОРПУС =====================
+
+SHORT_PLAN = ["Введение", "Теоретические основы темы", "Анализ практики", "Рекомендации", "Заключение"]
+
+SECTION_TOPICS = [
+    "Понятие и сущность цифровой экономики", "Методология исследования", "Анализ рынка труда",
+    "Практика применения в российских компаниях", "Обзор литературы по теме", "Правовое регулирование",
+    "Экономическая эффективность проекта", "Оценка рисков", "Сравнительный анализ зарубежного опыта",
+    "Результаты эксперимента", "Основная часть: описание объекта", "Перспективы развития отрасли",
+]
+
+PREFERENCE_SENTENCES = [
+    "Во введении обязательно укажи цель и задачи работы",
+    "В заключении сделай выводы по каждой главе",
+    "Пиши научным стилем без воды",
+    "Добавь больше статистических данных за последние пять лет",
+    "Актуальность раскрой через примеры из практики",
+    "В основной части нужен подробный анализ рынка",
+    "Используй не менее пятнадцати источников",
+    "Про правовое регулирование напиши со ссылками на законы",
+    "Для заключения важны рекомендации для руководства",
+    "Гипотезу сформулируй во введении явно",
+    "Обзор литературы сделай по отечественным авторам",
+    "Не используй списки",
+    "Сравнительный анализ зарубежного опыта оформи таблицей",
+    "Оценка рисков должна включать количественные показатели",
+    "Перспективы развития отрасли опиши оптимистично",
+    "Введению удели не больше двух страниц",
+    "Выводам в конце дай нумерацию",
+    "В анализе практики российских компаний приведи три кейса",
+    "Правовому регулированию посвяти отдельный абзац",
+    "В целом пиши простым языком",
+    "Ок",
+]
+
+
+def diploma_plan(chapters: int, rng: random.Random) -> list:
+    """План из введения, разделов основной части и заключения"""
+    middle = [f"{i}.{j} {rng.choice(SECTION_TOPICS)}" for i in range(1, 4) for j in range(1, 13)]
+    return ["Введение"] + middle[:chapters - 2] + ["Заключение"]
+
+
+def preferences_text(sentences: int, rng: random.Random) -> str:
+    return ". ".join(rng.choice(PREFERENCE_SENTENCES) for _ in range(sentences)) + "."
+
+
+def build_cases(rng: random.Random) -> list:
+    """Пары (пожелания, план) для проверки совпадения результатов"""
+    cases = [
+        ("", SHORT_PLAN),
+        ("Без особых предпочтений", SHORT_PLAN),
+        ("Во введении укажи цель. Анализ практики сделай по трём компаниям!", SHORT_PLAN),
+        ("Итоги подведи кратко; рекомендации дай списком? нет, текстом", SHORT_PLAN),
+        ("Введение и заключение пиши коротко", ["Введение и заключение", "Основная часть"]),
+        ("Проблема описана? Да", []),
+        ("Напиши про ВВЕДЕНИЕ подробно", ["ВВЕДЕНИЕ", "Введение", ""]),
+    ]
+    for chapters in (5, 10, 20, 35):
+        for sentences in (1, 5, 20, 60):
+            cases.append((preferences_text(sentences, rng), diploma_plan(chapters, rng)))
+    return cases
+
+
+# Пожелания, которые по основам слов должны попасть в конкретную главу: (пожелания, план, глава)
+STEM_CASES = [
+    (
+        "В анализе практики российских компаний приведи примеры",
+        ["Введение", "Глава 1. Теоретические основы", "Глава 2. Анализ практики российских компаний", "Заключение"],
+        "Глава 2. Анализ практики российских компаний",
+    ),
+    ("Введению удели не больше двух страниц", SHORT_PLAN, "Введение"),
+]
+
+
+# ===================== ПРОВЕРКА И ЗАМЕРЫ =====================
+
+def measure(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк распределения пожеланий по главам")
+    parser.add_argument("--repeat", type=int, default=5, help="число повторов замера")
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    print("\n" + "=" * 70)
+    print("  ⏱️ РАСПРЕДЕЛЕНИЕ ПОЖЕЛАНИЙ: прежняя реализация и автомат Ахо–Корасик")
+    print("=" * 70)
+
+    print("\n🔍 Совпадение результатов:")
+    cases = build_cases(rng)
+    mismatches = 0
+    for preferences, plan in cases:
+        expected = reference_parse_preferences_by_chapter(preferences, plan)
+        actual = preference_matcher.parse_preferences_by_chapter(preferences, plan, morphology=False)
+        if expected != actual:
+            mismatches += 1
+            print(f"   ❌ план из {len(plan)} глав, пожелания: {preferences[:60]!r}")
+    status = "✅" if not mismatches else "❌"
+    print(f"{status} Совпало {len(cases) - mismatches}/{len(cases)} случаев")
+
+    print("\n🔍 Сравнение по основам слов:")
+    for preferences, plan, chapter in STEM_CASES:
+        parsed = preference_matcher.parse_preferences_by_chapter(preferences, plan)
+        if chapter not in parsed['by_chapter'] or parsed['global']:
+            mismatches += 1
+            print(f"   ❌ {preferences!r} не попало в главу {chapter!r}")
+        else:
+            print(f"   ✅ {preferences!r} → {chapter!r}")
+
+    print(f"\n⏱️ Время на 100 заказов (лучшее из {args.repeat}):")
+    print(f"   {'глав':>5} {'предложений':>12} {'прежняя, мс':>12} {'автомат, мс':>12} {'+ основы, мс':>13}")
+    for chapters, sentences in ((5, 5), (15, 20), (35, 20), (35, 100)):
+        orders = [(preferences_text(sentences, rng), diploma_plan(chapters, rng)) for _ in range(100)]
+        before = measure(lambda: [reference_parse_preferences_by_chapter(p, plan) for p, plan in orders], args.repeat)
+        after = measure(lambda: [
+            preference_matcher.parse_preferences_by_chapter(p, plan, morphology=False) for p, plan in orders
+        ], args.repeat)
+        stemmed = measure(
+            lambda: [preference_matcher.parse_preferences_by_chapter(p, plan) for p, plan in orders], args.repeat
+        )
+        print(f"   {chapters:>5} {sentences:>12} {before * 1000:>12.1f} {after * 1000:>12.1f} {stemmed * 1000:>13.1f}")
+
+    print("\n🧭 Распределение по главам (100 заказов, 15 глав, 20 предложений):")
+    orders = [(preferences_text(20, rng), diploma_plan(15, rng)) for _ in range(100)]
+    for title, morphology in (("только точные совпадения", False), ("с основами слов", True)):
+        in_global = prompt_chars = 0
+        for preferences, plan in orders:
+            parsed = preference_matcher.parse_preferences_by_chapter(preferences, plan, morphology=morphology)
+            in_global += len([s for s in parsed['global'].split('. ') if s])
+            # Общие пожелания добавляются в промпт каждой главы, специфичные — только в свою
+            prompt_chars += len(parsed['global']) * len(plan) + sum(map(len, parsed['by_chapter'].values()))
+        print(f"   • {title}: в общих пожеланиях {in_global} предложений, "
+              f"символов пожеланий в промптах глав {prompt_chars}")
+
+    print("\n" + "=" * 70)
+    if mismatches:
+        print(f"❌ Найдено расхождений: {mismatches}")
+    else:
+        print("🎉 Результаты совпадают во всех случаях")
+    print("=" * 70 + "\n")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
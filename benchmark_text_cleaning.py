@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏱️ Бенчмарк очистки текста глав (text_cleaning.py)
+
+Сравнивает модуль text_cleaning с прежними реализациями из bot.py:
+1. На корпусе глав проверяет, что результат совпадает символ в символ
+2. Измеряет время обработки корпуса старой и новой реализацией
+
+Корпус — сохранённые главы заказов из user_activity.db (таблица order_chapters),
+если база есть, плюс встроенные примеры с типичными артефактами ответа модели
+(вводные фразы, заголовок в начале текста, эмодзи).
+
+Запуск: py benchmark_text_cleaning.py [--db user_activity.db] [--repeat 20]
+"""
+
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import logging
+from pathlib import Path
+
+import text_cleaning
+
+# Предупреждения о слишком коротком тексте не нужны в выводе бенчмарка
+logging.disable(logging.WARNING)
+
+
+# ===================== ПРЕЖНИЕ РЕАЛИЗАЦИИ (эталон) =====================
+
+def reference_remove_emojis(text: str) -> str:
+    if not text:
+        return text
+    emoji_pattern = re.compile(
+        "["
+        u"\U0001F600-\U0001F64F"
+        u"\U0001F300-\U0001F5FF"
+        u"\U0001F680-\U0001F6FF"
+        u"\U0001F1E0-\U0001F1FF"
+        u"\U00002702-\U000027B0"
+        u"\U000024C2-\U0001F251"
+        u"\U0001F900-\U0001F9FF"
+        u"\U0001FA70-\U0001FAFF"
+        u"\U00002500-\U00002BEF"
+        u"\U0001F018-\U0001F270"
+        u"\U00002300-\U000023FF"
+        u"\U0001F004-\U0001F0CF"
+        "]+", flags=re.UNICODE
+    )
+    return emoji_pattern.sub('', text)
+
+
+def reference_remove_theme_emojis(theme: str) -> str:
+    emoji_pattern = re.compile(
+        "["
+        u"\U0001F600-\U0001F64F"
+        u"\U0001F300-\U0001F5FF"
+        u"\U0001F680-\U0001F6FF"
+        u"\U0001F1E0-\U0001F1FF"
+        u"\U00002702-\U000027B0"
+        u"\U000024C2-\U0001F251"
+        u"\U0001F900-\U0001F9FF"
+        u"\U0001FA70-\U0001FAFF"
+        "]+", flags=re.UNICODE
+    )
+    return emoji_pattern.sub('', theme).strip()
+
+
+def reference_validate_generated_content(content: str, chapter: str) -> str:
+    if not content or len(content.strip()) < 100:
+        raise ValueError(f"Слишком короткий контент для главы {chapter}")
+    content = reference_remove_emojis(content)
+    unwanted_patterns = [
+        r'^[^.]*отлично[^.]*\.',
+        r'^[^.]*вот план[^.]*\.',
+        r'^[^.]*рассмотрим[^.]*\.',
+        r'^[^.]*вот текст[^.]*\.',
+        r'^[^.]*итак[^.]*\.',
+        r'^[^.]*составленный с учетом[^.]*\.',
+        r'^[^.]*план .* по теме[^.]*\.',
+    ]
+    content_cleaned = content.strip()
+    for pattern in unwanted_patterns:
+        content_cleaned = re.sub(pattern, '', content_cleaned, flags=re.IGNORECASE)
+    content_cleaned = content_cleaned.lstrip()
+    if len(content_cleaned.strip()) < 200:
+        return content.strip()
+    return content_cleaned
+
+
+def reference_remove_chapter_title_from_text(chapter_text: str, chapter_title: str) -> str:
+    if not chapter_text or not chapter_title:
+        return chapter_text
+    clean_title = re.sub(r'^\d+\.\s*', '', chapter_title).strip()
+    clean_title = re.sub(r'^Глава\s+\d+[\.:]\s*', '', clean_title, flags=re.IGNORECASE).strip()
+    patterns = [
+        rf'^Глава\s+\d+[\.:]\s*{re.escape(clean_title)}\.?\s*\n*',
+        rf'^\d+\.\s*{re.escape(clean_title)}\.?\s*\n*',
+        rf'^{re.escape(clean_title)}\.?\s*\n*',
+        rf'^{re.escape(clean_title.upper())}\.?\s*\n*',
+        rf'^#+\s*{re.escape(clean_title)}\.?\s*\n*',
+        rf'^\*\*{re.escape(clean_title)}\*\*\.?\s*\n*',
+    ]
+    result = chapter_text.strip()
+    for pattern in patterns:
+        result = re.sub(pattern, '', result, count=1, flags=re.IGNORECASE | re.MULTILINE)
+    return result.lstrip('\n').strip()
+
+
+# ===================== КОРПУС =====================
+
+SAMPLE_PARAGRAPHS = [
+    "Актуальность темы исследования обусловлена тем, что цифровая трансформация экономики "
+    "затрагивает все сферы хозяйственной деятельности. Предприятия вынуждены пересматривать "
+    "бизнес-процессы, внедрять новые информационные системы и переобучать персонал.",
+    "В отечественной литературе данная проблема рассматривается в работах ряда авторов, "
+    "однако единого подхода к оценке эффективности цифровых решений до сих пор не выработано. "
+    "Это определяет необходимость дальнейшего изучения вопроса.",
+    "Целью работы является анализ современных подходов к управлению изменениями в организации. "
+    "Для достижения цели поставлены следующие задачи: изучить теоретические основы, "
+    "проанализировать практику российских компаний и сформулировать рекомендации.",
+    "Методологическую основу исследования составляют общенаучные методы анализа и синтеза, "
+    "сравнительный метод, а также статистическая обработка данных открытых источников.",
+]
+
+SAMPLE_TITLES = [
+    "Введение",
+    "Теоретические основы управления изменениями",
+    "Анализ практики российских компаний (2015–2023 гг.)",
+    "Рекомендации по совершенствованию процессов",
+    "Заключение",
+]
+
+OPENERS = [
+    "",
+    "Отлично, вот текст главы. ",
+    "Итак. Рассмотрим основные положения. ",
+    "Вот план изложения материала по теме исследования. ",
+    "Ниже представлен текст, составленный с учетом требований. ",
+    "😊 Отлично! Вот текст для главы 🚀. ",
+]
+
+
+def title_variants(position: int, title: str) -> list:
+    return [
+        "",
+        f"{title}\n\n",
+        f"{title.upper()}\n",
+        f"{position}. {title}\n\n",
+        f"Глава {position}: {title}.\n",
+        f"## {title}\n\n",
+        f"**{title}**\n\n",
+    ]
+
+
+def builtin_corpus() -> list:
+    """Главы из встроенных примеров во всех сочетаниях вводных фраз и заголовков"""
+    corpus = []
+    body = "\n\n".join(SAMPLE_PARAGRAPHS)
+    for position, title in enumerate(SAMPLE_TITLES, 1):
+        for opener in OPENERS:
+            for heading in title_variants(position, title):
+                corpus.append((f"{position}. {title}", heading + opener + body))
+        # Заголовок, повторённый в середине текста, и слишком короткий после очистки текст
+        corpus.append((title, f"{body}\n{title}\nПродолжение текста главы. ✅ {body}"))
+        corpus.append((title, "Отлично, вот текст главы. " + SAMPLE_PARAGRAPHS[0]))
+    return corpus
+
+
+def database_corpus(db_path: str) -> list:
+    """Сохранённые главы заказов"""
+    if not Path(db_path).exists():
+        return []
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute("SELECT title, text FROM order_chapters WHERE text IS NOT NULL").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"⚠️  Не удалось прочитать главы из {db_path}: {e}")
+        return []
+    return [(title or "", text) for title, text in rows]
+
+
+# ===================== ПРОВЕРКА И ЗАМЕРЫ =====================
+
+def call(func, *args):
+    try:
+        return func(*args)
+    except ValueError as e:
+        return f"ValueError: {e}"
+
+
+def check_identical(corpus: list) -> int:
+    """Количество расхождений между старой и новой реализациями"""
+    pairs = [
+        ("remove_emojis", reference_remove_emojis, text_cleaning.remove_emojis,
+         lambda title, text: (text,)),
+        ("remove_theme_emojis", reference_remove_theme_emojis, text_cleaning.remove_theme_emojis,
+         lambda title, text: (title + " 📚",)),
+        ("validate_generated_content", reference_validate_generated_content,
+         text_cleaning.validate_generated_content, lambda title, text: (text, title)),
+        ("remove_chapter_title_from_text", reference_remove_chapter_title_from_text,
+         text_cleaning.remove_chapter_title_from_text, lambda title, text: (text, title)),
+    ]
+    mismatches = 0
+    for name, reference, optimized, make_args in pairs:
+        failed = 0
+        for title, text in corpus:
+            args = make_args(title, text)
+            if call(reference, *args) != call(optimized, *args):
+                failed += 1
+                if failed <= 3:
+                    print(f"   ❌ {name}: расхождение для главы {title!r}")
+        status = "✅" if not failed else "❌"
+        print(f"{status} {name}: {len(corpus) - failed}/{len(corpus)} совпадений")
+        mismatches += failed
+    return mismatches
+
+
+def process_chapters(corpus: list, validate, remove_title) -> None:
+    """Путь главы в заказе: очистка ответа модели, затем удаление заголовка при сборке документа"""
+    for title, text in corpus:
+        try:
+            text = validate(text, title)
+        except ValueError:
+            continue
+        remove_title(text, title)
+
+
+def measure(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк очистки текста глав")
+    parser.add_argument("--db", default="user_activity.db", help="база с сохранёнными главами")
+    parser.add_argument("--repeat", type=int, default=20, help="число повторов замера")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 70)
+    print("  ⏱️ ОЧИСТКА ТЕКСТА ГЛАВ: старая и новая реализации")
+    print("=" * 70)
+
+    saved = database_corpus(args.db)
+    corpus = builtin_corpus() + saved
+    print(f"📚 Глав в корпусе: {len(corpus)} (из базы: {len(saved)})")
+
+    print("\n🔍 Совпадение результатов:")
+    mismatches = check_identical(corpus)
+
+    print(f"\n⏱️ Время обработки корпуса (лучшее из {args.repeat}):")
+    # Во встроенном корпусе заголовков немного и старые шаблоны берутся из кеша re; в работе у каждого
+    # заказа свои заголовки, и прежняя реализация компилирует шесть шаблонов на каждую главу
+    before = measure(lambda: process_chapters(
+        corpus, reference_validate_generated_content, reference_remove_chapter_title_from_text
+    ), args.repeat)
+    after = measure(lambda: process_chapters(
+        corpus, text_cleaning.validate_generated_content, text_cleaning.remove_chapter_title_from_text
+    ), args.repeat)
+    per_chapter = 1_000_000 / len(corpus)
+    print(f"   • прежняя реализация: {before * 1000:.1f} мс ({before * per_chapter:.1f} мкс на главу)")
+    print(f"   • text_cleaning:      {after * 1000:.1f} мс ({after * per_chapter:.1f} мкс на главу)")
+    print(f"   • ускорение: {before / after:.1f}x")
+
+    print("\n" + "=" * 70)
+    if mismatches:
+        print(f"❌ Найдено расхождений: {mismatches}")
+    else:
+        print("🎉 Результаты совпадают на всём корпусе")
+    print("=" * 70 + "\n")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
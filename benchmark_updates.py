@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+⏱️ Бенчмарк обработки обновлений Telegram (update_processor.py)
+
+Имитирует поток обновлений от многих чатов и прогоняет его так же, как
+это делает Application: обновления по очереди берутся из очереди и
+передаются процессору. Сравниваются три режима:
+1. Последовательно — поведение Application по умолчанию
+2. SimpleUpdateProcessor из python-telegram-bot — параллельно без порядка
+3. ChatOrderedUpdateProcessor — параллельно, внутри чата по порядку
+
+Обработчики не обращаются к сети: обычное обновление ждёт --handler-ms
+(запрос к Bot API), каждое --slow-every-е — --slow-ms (админ-отчёт,
+тестовый заказ). Один «горячий» чат присылает --hot-share обновлений.
+Для каждого режима выводятся время, пропускная способность, задержка
+от поступления до окончания обработки и число нарушений порядка внутри
+чата (обработка началась раньше, чем закончилась предыдущая).
+
+Запуск: py benchmark_updates.py [--updates 2000] [--chats 200] [--concurrency 32]
+"""
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime
+
+from telegram import Update, Message, Chat, User
+from telegram.ext import SimpleUpdateProcessor
+
+from update_processor import ChatOrderedUpdateProcessor
+
+
+def make_updates(count: int, chats: int, hot_share: float, seed: int = 1) -> list:
+    """Обновления-сообщения; доля hot_share приходится на один чат"""
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(count):
+        chat_id = 1 if rng.random() < hot_share else rng.randint(2, chats + 1)
+        message = Message(
+            update_id, datetime.now(), Chat(chat_id, Chat.PRIVATE),
+            from_user=User(chat_id, "Тест", False), text="сообщение"
+        )
+        updates.append(Update(update_id, message=message))
+    return updates
+
+
+class Workload:
+    """Обработчик-имитация: задержки, журнал времени и проверка порядка внутри чата"""
+
+    def __init__(self, handler_ms: float, slow_ms: float, slow_every: int):
+        self.handler = handler_ms / 1000
+        self.slow = slow_ms / 1000
+        self.slow_every = slow_every
+        self.arrived = {}
+        self.latencies = []
+        self.violations = 0
+        self._chat_busy = set()
+        self._chat_last = {}
+
+    async def handle(self, update: Update) -> None:
+        chat_id = update.effective_chat.id
+        # Обновление чата начинается раньше, чем закончилось предыдущее, или не по порядку
+        if chat_id in self._chat_busy or self._chat_last.get(chat_id, -1) > update.update_id:
+            self.violations += 1
+        self._chat_busy.add(chat_id)
+        self._chat_last[chat_id] = update.update_id
+        try:
+            slow = self.slow_every and update.update_id % self.slow_every == 0
+            await asyncio.sleep(self.slow if slow else self.handler)
+        finally:
+            self._chat_busy.discard(chat_id)
+        self.latencies.append(time.perf_counter() - self.arrived[update.update_id])
+
+
+async def run_mode(updates: list, processor, workload: Workload, rate: float) -> float:
+    """Подаёт обновления с частотой rate в секунду и обрабатывает их, как Application"""
+    queue = asyncio.Queue()
+
+    async def produce() -> None:
+        started = time.perf_counter()
+        for i, update in enumerate(updates):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            workload.arrived[update.update_id] = time.perf_counter()
+            queue.put_nowait(update)
+
+    started = time.perf_counter()
+    producer = asyncio.create_task(produce())
+    tasks = []
+    for _ in range(len(updates)):
+        update = await queue.get()
+        if processor is None:
+            await workload.handle(update)
+        else:
+            tasks.append(asyncio.create_task(processor.process_update(update, workload.handle(update))))
+    await asyncio.gather(producer, *tasks)
+    return time.perf_counter() - started
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки обновлений Telegram")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=500, help="обновлений в секунду")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--handler-ms", type=float, default=20)
+    parser.add_argument("--slow-ms", type=float, default=1000)
+    parser.add_argument("--slow-every", type=int, default=200)
+    parser.add_argument("--hot-share", type=float, default=0.1)
+    parser.add_argument("--skip-sequential", action="store_true", help="не запускать последовательный режим (долго)")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 70)
+    print("  ⏱️ ОБРАБОТКА ОБНОВЛЕНИЙ: последовательно и параллельно")
+    print("=" * 70)
+    print(f"📨 {args.updates} обновлений из {args.chats} чатов ({args.hot_share * 100:.0f}% из одного), "
+          f"{args.rate:.0f}/с; обработчик {args.handler_ms:.0f} мс, "
+          f"каждое {args.slow_every}-е — {args.slow_ms:.0f} мс; параллельность {args.concurrency}")
+
+    modes = [
+        ("ChatOrderedUpdateProcessor", lambda: ChatOrderedUpdateProcessor(args.concurrency)),
+        ("SimpleUpdateProcessor", lambda: SimpleUpdateProcessor(args.concurrency)),
+    ]
+    if not args.skip_sequential:
+        modes.insert(0, ("последовательно", lambda: None))
+
+    ordered_violations = 0
+    print()
+    for name, make_processor in modes:
+        updates = make_updates(args.updates, args.chats, args.hot_share)
+        workload = Workload(args.handler_ms, args.slow_ms, args.slow_every)
+        processor = make_processor()
+        elapsed = asyncio.run(run_mode(updates, processor, workload, args.rate))
+        if isinstance(processor, ChatOrderedUpdateProcessor):
+            ordered_violations = workload.violations
+        print(f"• {name}:")
+        print(f"   время {elapsed:.1f} с, {len(updates) / elapsed:.0f} обновлений/с")
+        print(f"   задержка p50 {percentile(workload.latencies, 0.5) * 1000:.0f} мс, "
+              f"p95 {percentile(workload.latencies, 0.95) * 1000:.0f} мс, "
+              f"макс. {max(workload.latencies) * 1000:.0f} мс")
+        print(f"   {'✅' if not workload.violations else '⚠️'} нарушений порядка в чате: {workload.violations}")
+
+    print("\n" + "=" * 70)
+    if ordered_violations:
+        print(f"❌ ChatOrderedUpdateProcessor нарушил порядок {ordered_violations} раз")
+    else:
+        print("🎉 ChatOrderedUpdateProcessor сохраняет порядок обновлений внутри чата")
+    print("=" * 70 + "\n")
+    return 1 if ordered_violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,107 +9,243 @@ import sqlite3
 import time
 import csv
 import sys
+import signal
 import logging
-import aiohttp
-from collections import defaultdict
-
-# Настройка кодировки для Windows консоли
-if sys.platform == 'win32':
-    import codecs
-    sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
-    sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
-
-try:
-    import psutil
-except ImportError:
-    psutil = None
+
+# Тяжёлые зависимости (openai, python-docx, yookassa, aiohttp, psutil) импортируются
+# при первом использовании, а побочные действия (логирование, схема базы, настройка
+# YooKassa) выполняются в main(): импорт модуля быстрый и ничего не меняет на диске
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackContext, MessageHandler, filters, ConversationHandler, CallbackQueryHandler
-from openai import AsyncOpenAI
-import docx
-from docx.shared import Pt, Cm, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING
-from docx.enum.section import WD_SECTION
-from docx.oxml.ns import qn
-from docx.oxml import OxmlElement
 import logging
 import json
 import re
 import html
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base  # Updated import for SQLAlchemy 2.0
+from sqlalchemy import or_
 from datetime import datetime, timezone, timedelta
-import uuid
-from yookassa import Configuration, Payment, Refund
+from metrics import metrics_handler
+from rate_limit import RateLimiter, RateLimitPolicy, MemoryBackend, SQLiteBackend
+from conversation_store import SQLitePersistence
+from update_processor import ChatOrderedUpdateProcessor
+from priority_scheduler import PriorityScheduler
+from payment_gateway import idempotence_key
+# Генерация, сборка документа, источники, платежи, база и отчёты — в пакете engines,
+# который импортируется без Telegram; здесь обработчики бота и фоновые циклы
+from engines import metrics
+from engines.storage import (
+    SessionLocal, UserAction, Order, OrderChapter, OrderArtifact, OutboxMessage, init_db,
+    log_user_action, create_order, update_order_status, transition_order_status, get_order,
+    load_chapter_checkpoints, save_order_artifact, get_order_artifact, find_telegram_file_id,
+    set_telegram_file_id, order_stage, as_utc, notify_message, add_outbox_messages, PermanentOutboxError,
+    artifact_store
+)
+from engines.generation import (
+    DEEPSEEK_API_KEY, GENERATION_RETRY_LANE_LIMIT, GENERATION_TEST_LANE_LIMIT,
+    generation_scheduler, order_lane, order_user_data, generate_plan, generate_chapters, send_notice
+)
+from engines.rendering import render_document
+from engines.sources import (
+    COZE_API_TOKEN, COZE_WORKFLOW_ID, COZE_SPACE_ID, coze_client, collect_sources, close_sources
+)
+from engines.payments import (
+    YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, payment_gateway, configure_yookassa, payment_request,
+    find_order_by_payment, schedule_refund, execute_refund
+)
+from engines.settings import settings, watch_settings, format_value
+from engines.jobs import order_job, enqueue_order_job, consume_order_jobs, consumer_id, order_job_counts
+from engines.admin import (
+    stats_report, users_report, orders_report, finance_report, orders_csv, actions_csv, latency_report
+)
 
 # Загрузка переменных окружения
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-# Значения по умолчанию для YooKassa удалены для безопасности
-YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
-YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
-
-# Настройки Coze API для поиска источников
-COZE_API_TOKEN = os.getenv("COZE_API_TOKEN")
-COZE_WORKFLOW_ID = os.getenv("COZE_WORKFLOW_ID")
-COZE_SPACE_ID = os.getenv("COZE_SPACE_ID")
-COZE_API_URL = os.getenv("COZE_API_URL", "https://api.coze.com/v1/workflow/run")
-
-# 🧪 ТЕСТОВЫЙ РЕЖИМ - установите в False для рабочего режима с реальными платежами
-TESTING_MODE = False
-
-# Администраторы бота
-ADMIN_IDS = [659874549]  # Ваш Telegram ID как администратор
-
-# Пользователи с постоянным тестовым режимом (по username)
-# Для этих пользователей оплата всегда бесплатная
-TEST_MODE_USERNAMES = ["AbuHavva"]  # Username без @
-
-# Система ограничения запросов (rate limiting)
-user_request_times = defaultdict(list)
-MAX_REQUESTS_PER_HOUR = 5
-REQUEST_WINDOW = 3600  # 1 час в секундах
-
-# Настройка YooKassa
-Configuration.account_id = YOOKASSA_SHOP_ID or ""
-Configuration.secret_key = YOOKASSA_SECRET_KEY or ""
-
-# Проверяем, что ключ DeepSeek загружен корректно
-if not DEEPSEEK_API_KEY:
-    raise ValueError(
-        "Переменная окружения DEEPSEEK_API_KEY не установлена. "
-        "Убедитесь, что файл .env содержит корректный ключ API."
-    )
-# Предупреждаем, если переменные YooKassa не заданы
-if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
-    logging.warning(
-        "Переменные окружения YOOKASSA_SHOP_ID или YOOKASSA_SECRET_KEY "
-        "не установлены. Платежи через YooKassa не будут работать."
-    )
-# Предупреждаем, если переменные Coze API не заданы
-if not COZE_API_TOKEN or not COZE_WORKFLOW_ID or not COZE_SPACE_ID:
-    logging.warning(
-        "Переменные окружения COZE_API_TOKEN, COZE_WORKFLOW_ID или COZE_SPACE_ID "
-        "не установлены. Автоматический поиск источников не будет работать."
-    )
-
-client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
 
-# Настройка логирования с правильной кодировкой для Windows
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
+# Тестовый режим (TESTING_MODE), администраторы (ADMIN_IDS), пользователи с постоянным
+# тестовым режимом (TEST_MODE_USERNAMES), лимиты и ёмкость — настройки engines.settings:
+# значения по умолчанию задаются там или в .env, а на ходу меняются командой /admin_config
+
+# Уведомления YooKassa о платежах (HTTP webhook) и резервный опрос статуса
+YOOKASSA_WEBHOOK_ENABLED = os.getenv("YOOKASSA_WEBHOOK_ENABLED", "false").lower() == "true"
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", "8080"))
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "false").lower() == "true"
+# Режим webhook: обновления Telegram принимает тот же HTTP-сервер вместо long polling
+TELEGRAM_WEBHOOK_ENABLED = os.getenv("TELEGRAM_WEBHOOK_ENABLED", "false").lower() == "true"
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+# Публичный https-адрес для setWebhook; пусто — не регистрировать (локальная проверка или регистрация вручную)
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))
+# Сколько полученных обновлений может ждать обработки; сверх этого Telegram повторит доставку позже
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Сколько обновлений разных чатов обрабатывается одновременно (внутри чата — по порядку); 1 — строго по одному
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+# Метрики Prometheus на том же HTTP-сервере
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # пусто — метрики отдаются только на localhost
+PAYMENT_POLL_INTERVAL = 5  # секунды, если уведомления не настроены
+PAYMENT_POLL_INTERVAL_WEBHOOK = 60  # секунды, резервный опрос при включённых уведомлениях
+# Неоплаченный заказ считается брошенным и переводится в expired
+PAYMENT_EXPIRE_AFTER = int(os.getenv("PAYMENT_EXPIRE_MINUTES", "120")) * 60
+PAYMENT_RECONCILE_BATCH = int(os.getenv("PAYMENT_RECONCILE_BATCH", "20"))  # платежей за один проход сверки
+PAYMENT_RECONCILE_TICK = 5  # секунды между проходами сверки
+
+# Допуск заказов: сколько заказов генерируется одновременно (MAX_ACTIVE_ORDERS), сколько может
+# ждать в очереди (MAX_QUEUED_ORDERS) и сколько выполняющихся заказов может быть у одного
+# пользователя (MAX_USER_ACTIVE_ORDERS) — настройки engines.settings
+DEFAULT_ORDER_DURATION = 180  # секунды, пока нет статистики выполненных заказов
+ORDER_RESUME_DELAY = 10  # секунды перед автоматической догенерацией недостающих глав
+# Заказы выполняются по заданиям из таблицы order_jobs. false — их берёт сам бот (MAX_ACTIVE_ORDERS
+# одновременно); true — только отдельные воркеры (worker.py), а бот обрабатывает диалог и платежи
+ORDER_WORKERS_EXTERNAL = os.getenv("ORDER_WORKERS_EXTERNAL", "false").lower() == "true"
+# Одновременно выполняемые заказы; остальные ждут в очереди в порядке приоритета полос
+order_scheduler = PriorityScheduler(settings.get("MAX_ACTIVE_ORDERS"), lane_limits={
+    "retry": GENERATION_RETRY_LANE_LIMIT,
+    "test": GENERATION_TEST_LANE_LIMIT,
+})
+settings.on_change("MAX_ACTIVE_ORDERS", order_scheduler.resize)
+
+def scheduler_samples(field: str):
+    return [
+        ({"scheduler": name, "lane": lane}, stats[field])
+        for name, scheduler in (("generation", generation_scheduler), ("orders", order_scheduler))
+        for lane, stats in scheduler.stats().items()
     ]
+
+metrics.gauge("scheduler_running", "Занятые слоты планировщиков по полосам", ("scheduler", "lane")).set_function(
+    lambda: scheduler_samples("running")
+)
+metrics.gauge("scheduler_waiting", "Ожидающие слот по полосам", ("scheduler", "lane")).set_function(
+    lambda: scheduler_samples("waiting")
+)
+metrics.gauge("scheduler_capacity", "Ёмкость планировщиков", ("scheduler",)).set_function(lambda: [
+    ({"scheduler": "generation"}, generation_scheduler.capacity),
+    ({"scheduler": "orders"}, order_scheduler.capacity),
+])
+
+# Outbox: возвраты и уведомления выполняются фоновым обработчиком с повторами
+OUTBOX_BATCH = 20  # сообщений за один проход
+OUTBOX_TICK = 2  # секунды между проходами
+OUTBOX_RETRY_DELAY = 15  # секунды до первой повторной попытки, далее удваивается
+OUTBOX_MAX_RETRY_DELAY = 3600
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+
+# Система ограничения запросов (rate limiting); лимит заказов — настройки
+# MAX_REQUESTS_PER_HOUR и REQUEST_WINDOW (секунды), меняются без перезапуска
+def order_rate_policy() -> RateLimitPolicy:
+    return RateLimitPolicy(settings.get("MAX_REQUESTS_PER_HOUR"), settings.get("REQUEST_WINDOW"))
+
+# Файл SQLite для лимитов (переживают перезапуск и общие для процессов); пусто — только в памяти
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "rate_limits.db")
+rate_limiter = RateLimiter(
+    {
+        "order": order_rate_policy(),
+        "broadcast": RateLimitPolicy(2, 3600),
+        "admin": RateLimitPolicy(30, 60),
+    },
+    backend=SQLiteBackend(RATE_LIMIT_DB) if RATE_LIMIT_DB else MemoryBackend()
+)
+for name in ("MAX_REQUESTS_PER_HOUR", "REQUEST_WINDOW"):
+    settings.on_change(name, lambda _: rate_limiter.set_policy("order", order_rate_policy()))
+
+# Состояние диалогов (user_data и шаг оформления заказа) сохраняется в SQLite и
+# переживает перезапуск; пусто — только в памяти, как раньше
+PERSISTENCE_DB = os.getenv("PERSISTENCE_DB", "conversations.db")
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL_HOURS", "24")) * 3600  # брошенный диалог удаляется
+PERSISTENCE_MAX_USERS = int(os.getenv("PERSISTENCE_MAX_USERS", "10000"))  # пользователей в памяти
+PERSISTENCE_INTERVAL = 5  # секунды между пакетными записями
+CONVERSATION_EXPIRE_TICK = 600  # секунды между проверками брошенных диалогов
+persistence = SQLitePersistence(
+    PERSISTENCE_DB, ttl=CONVERSATION_TTL, max_users=PERSISTENCE_MAX_USERS,
+    update_interval=PERSISTENCE_INTERVAL
+) if PERSISTENCE_DB else None
+
+def check_config() -> None:
+    """Проверяет обязательные переменные окружения при запуске бота"""
+    # Проверяем, что ключ DeepSeek загружен корректно
+    if not DEEPSEEK_API_KEY:
+        raise ValueError(
+            "Переменная окружения DEEPSEEK_API_KEY не установлена. "
+            "Убедитесь, что файл .env содержит корректный ключ API."
+        )
+    # Предупреждаем, если переменные YooKassa не заданы
+    if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
+        logging.warning(
+            "Переменные окружения YOOKASSA_SHOP_ID или YOOKASSA_SECRET_KEY "
+            "не установлены. Платежи через YooKassa не будут работать."
+        )
+    # Предупреждаем, если переменные Coze API не заданы
+    if not COZE_API_TOKEN or not COZE_WORKFLOW_ID or not COZE_SPACE_ID:
+        logging.warning(
+            "Переменные окружения COZE_API_TOKEN, COZE_WORKFLOW_ID или COZE_SPACE_ID "
+            "не установлены. Автоматический поиск источников не будет работать."
+        )
+    # Секрет webhook передаётся Telegram в setWebhook и проверяется в каждом запросе
+    if TELEGRAM_WEBHOOK_ENABLED and not re.fullmatch(r"[A-Za-z0-9_-]{16,256}", TELEGRAM_WEBHOOK_SECRET):
+        raise ValueError(
+            "Для режима webhook задайте TELEGRAM_WEBHOOK_SECRET: 16–256 символов A-Z, a-z, 0-9, _ и -."
+        )
+
+# Метрики процесса (эндпоинт METRICS_PATH); движки регистрируют свои метрики в том же реестре
+telegram_request_seconds = metrics.histogram(
+    "telegram_request_seconds", "Длительность запросов к Bot API (кроме getUpdates)", ("method",)
+)
+telegram_request_errors_total = metrics.counter(
+    "telegram_request_errors_total", "Неуспешные запросы к Bot API", ("method",)
 )
-# Явно устанавливаем кодировку для логов
-for handler in logging.root.handlers:
-    if isinstance(handler, logging.StreamHandler):
-        handler.stream = sys.stdout
+payment_polls_total = metrics.counter(
+    "payment_polls_total", "Проверки статуса платежей при сверке по результату", ("result",)
+)
+telegram_webhook_updates_total = metrics.counter(
+    "telegram_webhook_updates_total", "Обновления, полученные через webhook, по результату", ("result",)
+)
+update_queue_size = metrics.gauge("update_queue_size", "Обновления Telegram, ожидающие обработки")
+updates_in_progress_gauge = metrics.gauge(
+    "updates_in_progress", "Обновления в обработке или в ожидании очереди своего чата"
+)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API, учитывающий задержки и ошибки по методам"""
+    
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            telegram_request_errors_total.inc(method=api_method)
+            raise
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            telegram_request_errors_total.inc(method=api_method)
+        return code, payload
+
+def configure_logging() -> None:
+    """Настройка логирования с правильной кодировкой для Windows"""
+    # Настройка кодировки для Windows консоли
+    if sys.platform == 'win32':
+        import codecs
+        sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+        sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+    # Явно устанавливаем кодировку для логов
+    for handler in logging.root.handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.stream = sys.stdout
 
 # Функции валидации и безопасности
 def sanitize_filename(text: str) -> str:
@@ -158,533 +294,43 @@ def get_chat_id(context: CallbackContext, update: Update = None) -> int:
     else:
         raise ValueError("Не удалось определить chat_id")
 
-def remove_emojis(text: str) -> str:
-    """Удаляет все эмодзи и смайлики из текста"""
-    if not text:
-        return text
-    
-    # Расширенный паттерн для удаления всех эмодзи
-    emoji_pattern = re.compile(
-        "["
-        u"\U0001F600-\U0001F64F"  # эмоции
-        u"\U0001F300-\U0001F5FF"  # символы и пиктограммы
-        u"\U0001F680-\U0001F6FF"  # транспорт и символы на карте
-        u"\U0001F1E0-\U0001F1FF"  # флаги
-        u"\U00002702-\U000027B0"  # разное
-        u"\U000024C2-\U0001F251"  # заключенные символы
-        u"\U0001F900-\U0001F9FF"  # дополнительные смайлики
-        u"\U0001FA70-\U0001FAFF"  # расширенные символы
-        u"\U00002500-\U00002BEF"  # китайские символы
-        u"\U0001F018-\U0001F270"  # разные символы
-        u"\U00002300-\U000023FF"  # технические символы
-        u"\U0001F004-\U0001F0CF"  # игровые символы
-        "]+", flags=re.UNICODE
-    )
-    return emoji_pattern.sub('', text)
-
-def validate_generated_content(content: str, chapter: str) -> str:
-    """Валидирует и очищает сгенерированный контент от нежелательных фраз и смайликов"""
-    if not content or len(content.strip()) < 100:
-        raise ValueError(f"Слишком короткий контент для главы {chapter}")
-    
-    # Удаляем все смайлики и эмодзи из текста
-    content = remove_emojis(content)
-    
-    # Удаляем нежелательные фразы в начале текста
-    unwanted_patterns = [
-        r'^[^.]*отлично[^.]*\.',
-        r'^[^.]*вот план[^.]*\.',
-        r'^[^.]*рассмотрим[^.]*\.',
-        r'^[^.]*вот текст[^.]*\.',
-        r'^[^.]*итак[^.]*\.',
-        r'^[^.]*составленный с учетом[^.]*\.',
-        r'^[^.]*план .* по теме[^.]*\.',
-    ]
-    
-    content_cleaned = content.strip()
-    
-    # Удаляем первое предложение, если оно содержит нежелательные фразы
-    for pattern in unwanted_patterns:
-        content_cleaned = re.sub(pattern, '', content_cleaned, flags=re.IGNORECASE)
-    
-    # Удаляем лишние пробелы и переносы в начале
-    content_cleaned = content_cleaned.lstrip()
-    
-    # Проверяем, что осталось достаточно контента
-    if len(content_cleaned.strip()) < 200:
-        logging.warning(f"Контент для главы {chapter} стал слишком коротким после очистки")
-        return content.strip()  # Возвращаем оригинал
-    
-    return content_cleaned
-
-def remove_chapter_title_from_text(chapter_text: str, chapter_title: str) -> str:
-    """Удаляет дублирующийся заголовок главы из начала текста
-    
-    Args:
-        chapter_text: Текст главы, возможно содержащий заголовок
-        chapter_title: Название главы для поиска и удаления
-    
-    Returns:
-        Текст без дублирующегося заголовка
-    """
-    if not chapter_text or not chapter_title:
-        return chapter_text
-    
-    # Очищаем название главы от номеров и лишних символов для поиска
-    clean_title = re.sub(r'^\d+\.\s*', '', chapter_title).strip()
-    clean_title = re.sub(r'^Глава\s+\d+[\.:]\s*', '', clean_title, flags=re.IGNORECASE).strip()
-    
-    # Паттерны для поиска заголовка в начале текста
-    patterns = [
-        # С номером главы в начале: "1. Введение", "Глава 1. Введение", "Глава 1: Введение"
-        rf'^Глава\s+\d+[\.:]\s*{re.escape(clean_title)}\.?\s*\n*',
-        rf'^\d+\.\s*{re.escape(clean_title)}\.?\s*\n*',
-        # Без номера: "Введение", "ВВЕДЕНИЕ"
-        rf'^{re.escape(clean_title)}\.?\s*\n*',
-        rf'^{re.escape(clean_title.upper())}\.?\s*\n*',
-        # С дополнительными символами
-        rf'^#+\s*{re.escape(clean_title)}\.?\s*\n*',
-        rf'^\*\*{re.escape(clean_title)}\*\*\.?\s*\n*',
-    ]
-    
-    # Пробуем удалить заголовок по каждому паттерну
-    result = chapter_text.strip()
-    for pattern in patterns:
-        result = re.sub(pattern, '', result, count=1, flags=re.IGNORECASE | re.MULTILINE)
-    
-    # Удаляем лишние переносы строк в начале
-    result = result.lstrip('\n').strip()
-    
-    return result
-
-# ===================== ФУНКЦИИ ДЛЯ РАБОТЫ С ИСТОЧНИКАМИ =====================
-
-async def fetch_sources_from_coze(keywords: str, count: int = 15) -> list:
-    """
-    Получает источники через Coze workflow API
-    
-    Args:
-        keywords: Ключевые слова для поиска источников
-        count: Количество источников для поиска (не используется, т.к. workflow возвращает фиксированное количество)
-    
-    Returns:
-        Список словарей с ключами 'title' и 'url'
-    """
-    logging.info(f"Запрос источников через Coze workflow по ключевым словам: {keywords}")
-    
-    headers = {
-        "Authorization": f"Bearer {COZE_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
-    # ВАЖНО: Простой запрос (только ключевые слова) даёт максимум источников (~10)
-    # Сложные инструкции с указанием количества уменьшают результат до 3 источников
-    payload = {
-        "workflow_id": COZE_WORKFLOW_ID,
-        "parameters": {
-            "input": keywords  # Простой запрос без дополнительных инструкций
-        }
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(COZE_API_URL, headers=headers, json=payload, timeout=60) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logging.info(f"Ответ от Coze API: {data}")
-                    
-                    # Извлекаем источники из ответа
-                    sources = parse_coze_response(data)
-                    logging.info(f"Получено источников: {len(sources)}")
-                    return sources
-                else:
-                    error_text = await response.text()
-                    logging.error(f"Ошибка при запросе к Coze API: {response.status}, {error_text}")
-                    return []
-    except asyncio.TimeoutError:
-        logging.error("Таймаут при запросе к Coze API")
-        return []
-    except Exception as e:
-        logging.error(f"Исключение при запросе к Coze API: {e}")
-        return []
-
-def parse_coze_response(data: dict) -> list:
-    """
-    Парсит ответ от Coze workflow и извлекает источники
-    
-    Args:
-        data: JSON ответ от Coze API
-    
-    Returns:
-        Список словарей с ключами 'title' и 'url'
-    """
-    sources = []
-    
-    try:
-        # Извлекаем данные из ответа
-        if "data" in data:
-            data_str = data.get("data", "{}")
-            
-            # Если data - это строка, парсим как JSON
-            if isinstance(data_str, str):
-                try:
-                    data_obj = json.loads(data_str)
-                except json.JSONDecodeError:
-                    logging.error("Не удалось распарсить JSON из data")
-                    return []
-            else:
-                data_obj = data_str
-            
-            # Извлекаем массив output
-            if "output" in data_obj:
-                output_array = data_obj.get("output", [])
-                
-                if isinstance(output_array, list):
-                    for item in output_array:
-                        if isinstance(item, dict):
-                            # Извлекаем title и link
-                            title = item.get("title", "")
-                            link = item.get("link", "")
-                            
-                            if title and link:
-                                sources.append({"title": title, "url": link})
-                        elif isinstance(item, str):
-                            # Если элемент - строка, парсим её
-                            parsed = parse_source_string(item)
-                            if parsed:
-                                sources.append(parsed)
-        
-        logging.info(f"Распарсено источников: {len(sources)}")
-    except Exception as e:
-        logging.error(f"Ошибка при парсинге ответа Coze: {e}")
-    
-    return sources
-
-def parse_sources_from_text(text: str) -> list:
-    """
-    Парсит источники из текстового ответа
-    
-    Args:
-        text: Текст с источниками
-    
-    Returns:
-        Список словарей с ключами 'title' и 'url'
-    """
-    sources = []
-    
-    # Ищем паттерны вида "Заголовок - URL" или "Заголовок: URL"
-    patterns = [
-        r'(.+?)\s*[-–—]\s*(https?://[^\s]+)',
-        r'(.+?):\s*(https?://[^\s]+)',
-        r'\d+\.\s*(.+?)\s*[-–—]\s*(https?://[^\s]+)',
-        r'\d+\.\s*(.+?):\s*(https?://[^\s]+)',
-    ]
-    
-    for pattern in patterns:
-        matches = re.findall(pattern, text, re.MULTILINE)
-        for match in matches:
-            title = match[0].strip()
-            url = match[1].strip()
-            sources.append({"title": title, "url": url})
-    
-    # Если ничего не нашли, попробуем найти просто URL
-    if not sources:
-        urls = re.findall(r'https?://[^\s]+', text)
-        for i, url in enumerate(urls, 1):
-            sources.append({"title": f"Источник {i}", "url": url})
-    
-    return sources
-
-def parse_source_string(text: str) -> dict:
-    """
-    Парсит одну строку с источником
-    
-    Args:
-        text: Строка с источником
-    
-    Returns:
-        Словарь с ключами 'title' и 'url' или None
-    """
-    patterns = [
-        r'(.+?)\s*[-–—]\s*(https?://[^\s]+)',
-        r'(.+?):\s*(https?://[^\s]+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.match(pattern, text.strip())
-        if match:
-            return {"title": match.group(1).strip(), "url": match.group(2).strip()}
-    
-    # Если это просто URL
-    if text.strip().startswith('http'):
-        return {"title": "Источник", "url": text.strip()}
-    
-    return None
-
-def format_source_gost(source: dict, index: int) -> str:
-    """
-    Оформляет источник по ГОСТу
-    
-    Args:
-        source: Словарь с ключами 'title' и 'url'
-        index: Номер источника в списке
-    
-    Returns:
-        Строка с оформленным источником
-    """
-    title = source.get("title", "Без названия")
-    url = source.get("url", "")
-    
-    # Базовое оформление по ГОСТ 7.0.5-2008
-    # Для электронных ресурсов
-    if url:
-        # Определяем тип источника по URL
-        if "doi.org" in url or "scholar.google" in url or "elibrary.ru" in url:
-            # Научная статья
-            formatted = f"{index}. {title} [Электронный ресурс]. – URL: {url} (дата обращения: {datetime.now().strftime('%d.%m.%Y')})."
-        elif "wikipedia.org" in url:
-            # Википедия
-            formatted = f"{index}. {title} // Википедия [Электронный ресурс]. – URL: {url} (дата обращения: {datetime.now().strftime('%d.%m.%Y')})."
-        else:
-            # Обычный веб-ресурс
-            formatted = f"{index}. {title} [Электронный ресурс]. – URL: {url} (дата обращения: {datetime.now().strftime('%d.%m.%Y')})."
-    else:
-        # Если URL отсутствует
-        formatted = f"{index}. {title}."
-    
-    return formatted
-
-def extract_keywords_from_theme(theme: str, science_name: str) -> str:
-    """
-    Извлекает ключевые слова из темы работы для поиска источников
-    
-    Args:
-        theme: Тема работы
-        science_name: Название предмета
-    
-    Returns:
-        Строка с ключевыми словами
-    """
-    # Объединяем тему и предмет для более точного поиска
-    keywords = f"{theme} {science_name}"
-    
-    # Убираем лишние слова
-    stop_words = ["по", "для", "в", "на", "с", "о", "и", "или", "а", "но"]
-    words = keywords.split()
-    filtered_words = [w for w in words if w.lower() not in stop_words]
-    
-    return " ".join(filtered_words)
-
 # Функции администрирования и безопасности
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь администратором"""
-    return user_id in ADMIN_IDS
+    return user_id in settings.get("ADMIN_IDS")
 
-def check_rate_limit(user_id: int) -> bool:
+def check_rate_limit(user_id: int, policy: str = "order") -> bool:
     """Проверка лимита запросов пользователя"""
-    current_time = time.time()
-    user_times = user_request_times[user_id]
-    
-    # Удаляем старые запросы за пределами окна
-    user_times[:] = [t for t in user_times if current_time - t < REQUEST_WINDOW]
-    
-    # Проверяем лимит
-    if len(user_times) >= MAX_REQUESTS_PER_HOUR:
-        return False
-    
-    # Добавляем текущий запрос
-    user_times.append(current_time)
-    return True
+    return rate_limiter.hit(policy, user_id).allowed
+
+async def enforce_rate_limit(update: Update, policy: str) -> bool:
+    """Учитывает команду в лимите; при превышении отвечает пользователю и возвращает False"""
+    result = rate_limiter.hit(policy, update.effective_user.id)
+    if not result.allowed:
+        await update.message.reply_text(
+            f"⏳ Слишком частые запросы. Повторите через {int(result.retry_after) + 1} с."
+        )
+    return result.allowed
 
 async def admin_stats(update: Update, context: CallbackContext) -> None:
     """Статистика для администраторов"""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         session = SessionLocal()
-        
-        # Общая статистика
-        total_actions = session.query(UserAction).count()
-        unique_users = session.query(UserAction.user_id).distinct().count()
-        
-        # Статистика по действиям
-        start_commands = session.query(UserAction).filter(UserAction.action == "start_command").count()
-        order_commands = session.query(UserAction).filter(UserAction.action == "order_command").count()
-        
-        # Статистика за последние 24 часа
-        day_ago = datetime.now(timezone.utc) - timedelta(hours=24)
-        recent_actions = session.query(UserAction).filter(UserAction.timestamp > day_ago).count()
-        
-        # Дополнительные метрики
-        week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        week_actions = session.query(UserAction).filter(UserAction.timestamp > week_ago).count()
-        
-        # Топ-3 популярных действий
-        from sqlalchemy import func
-        top_actions = session.query(
-            UserAction.action,
-            func.count(UserAction.id).label('count')
-        ).group_by(UserAction.action).order_by(func.count(UserAction.id).desc()).limit(3).all()
-        
-        # Активность по дням недели
-        from sqlalchemy import extract
-        today_weekday = datetime.now().weekday()
-        today_actions = session.query(UserAction).filter(
-            extract('dow', UserAction.timestamp) == today_weekday,
-            UserAction.timestamp > day_ago
-        ).count()
-        
-        # Новые пользователи за неделю
-        new_users_week = session.query(UserAction.user_id).filter(
-            UserAction.timestamp > week_ago
-        ).distinct().count()
-        
-        # Активные пользователи (действия за последние 7 дней)
-        active_users_week = session.query(UserAction.user_id).filter(
-            UserAction.timestamp > week_ago
-        ).distinct().count()
-        
-        # Среднее количество действий на пользователя
-        avg_actions_per_user = total_actions / unique_users if unique_users > 0 else 0
-        
-        # === ДОПОЛНИТЕЛЬНЫЕ МЕТРИКИ ===
-        # Статистика заказов
-        total_orders = session.query(Order).count()
-        paid_orders = session.query(Order).filter(Order.status == "paid").count()
-        completed_orders = session.query(Order).filter(Order.status == "completed").count()
-        failed_orders = session.query(Order).filter(Order.status == "failed").count()
-        
-        # Заказы за последние 24 часа и неделю
-        recent_orders = session.query(Order).filter(Order.created_at > day_ago).count()
-        week_orders = session.query(Order).filter(Order.created_at > week_ago).count()
-        
-        # Конверсия (% пользователей, сделавших заказ)
-        users_with_orders = session.query(Order.user_id).distinct().count()
-        conversion_rate = (users_with_orders / unique_users * 100) if unique_users > 0 else 0
-        
-        # Средняя цена заказа
-        from sqlalchemy import func
-        avg_order_price = session.query(func.avg(Order.price)).scalar() or 0
-        
-        # Доходы
-        total_revenue = session.query(func.sum(Order.price)).filter(Order.status.in_(["paid", "completed"])).scalar() or 0
-        week_revenue = session.query(func.sum(Order.price)).filter(
-            Order.status.in_(["paid", "completed"]),
-            Order.created_at > week_ago
-        ).scalar() or 0
-        
-        # Популярные типы работ
-        popular_works = session.query(
-            Order.work_type,
-            func.count(Order.id).label('count')
-        ).group_by(Order.work_type).order_by(func.count(Order.id).desc()).limit(3).all()
-        
-        # Популярные предметы
-        popular_subjects = session.query(
-            Order.science_name,
-            func.count(Order.id).label('count')
-        ).group_by(Order.science_name).order_by(func.count(Order.id).desc()).limit(3).all()
-        
-        # Среднее время выполнения заказа (для завершенных заказов)
-        completed_orders_with_time = session.query(Order).filter(
-            Order.status == "completed",
-            Order.completed_at.isnot(None)
-        ).all()
-        
-        if completed_orders_with_time:
-            completion_times = [
-                (order.completed_at - order.created_at).total_seconds() / 3600  # в часах
-                for order in completed_orders_with_time
-            ]
-            avg_completion_time = sum(completion_times) / len(completion_times)
-        else:
-            avg_completion_time = 0
-        
-        # Активность по часам (топ-3 часа)
-        from sqlalchemy import extract
-        hourly_activity = session.query(
-            extract('hour', UserAction.timestamp).label('hour'),
-            func.count(UserAction.id).label('count')
-        ).filter(UserAction.timestamp > day_ago).group_by(
-            extract('hour', UserAction.timestamp)
-        ).order_by(func.count(UserAction.id).desc()).limit(3).all()
-        
-        # Retention: пользователи, вернувшиеся после первого дня
-        first_actions = session.query(
-            UserAction.user_id,
-            func.min(UserAction.timestamp).label('first_action')
-        ).group_by(UserAction.user_id).subquery()
-        
-        returning_users = session.query(UserAction.user_id).join(
-            first_actions, UserAction.user_id == first_actions.c.user_id
-        ).filter(
-            UserAction.timestamp > first_actions.c.first_action + timedelta(days=1)
-        ).distinct().count()
-        
-        retention_rate = (returning_users / unique_users * 100) if unique_users > 0 else 0
-        
-        stats_text = f"""
-📊 **Статистика бота:**
-
-👥 Уникальных пользователей: {unique_users}
-📝 Всего действий: {total_actions}
-🚀 Команд /start: {start_commands}
-📋 Команд /order: {order_commands}
-📈 Среднее действий/пользователь: {avg_actions_per_user:.1f}
-🔄 Retention rate: {retention_rate:.1f}%
-
-💰 **Статистика заказов:**
-📦 Всего заказов: {total_orders}
-✅ Оплаченных: {paid_orders}
-🎯 Завершенных: {completed_orders}
-❌ Неудачных: {failed_orders}
-📈 Конверсия: {conversion_rate:.1f}%
-💵 Средняя цена: {avg_order_price:.0f} руб.
-💸 Общий доход: {total_revenue:.0f} руб.
-
-⏰ **Временная аналитика:**
-🕐 Действий за 24 часа: {recent_actions}
-📅 Действий за неделю: {week_actions}
-🆕 Новых пользователей за неделю: {new_users_week}
-🔥 Активных пользователей за неделю: {active_users_week}
-📊 Активность сегодня: {today_actions}
-🛒 Заказов за 24 часа: {recent_orders}
-📋 Заказов за неделю: {week_orders}
-💰 Доход за неделю: {week_revenue:.0f} руб.
-⏱️ Среднее время выполнения: {avg_completion_time:.1f} ч.
-
-🎯 **Популярные действия:**"""
-        
-        for action, count in top_actions:
-            stats_text += f"\n• {action}: {count}"
-        
-        stats_text += f"""
-
-📊 **Популярные типы работ:**"""
-        for work_type, count in popular_works:
-            stats_text += f"\n• {work_type}: {count}"
-            
-        stats_text += f"""
-
-🎓 **Популярные предметы:**"""
-        for subject, count in popular_subjects:
-            stats_text += f"\n• {subject}: {count}"
-            
-        stats_text += f"""
-
-🕐 **Активность по часам (топ-3):**"""
-        for hour, count in hourly_activity:
-            stats_text += f"\n• {int(hour)}:00 - {count} действий"
+        stats_text = stats_report(session)
         
         stats_text += f"""
 
 ⚡ **Система:**
-🔒 Администраторов: {len(ADMIN_IDS)}
-🛡️ Rate limiting: {MAX_REQUESTS_PER_HOUR} req/hour
-🎯 Семафор генерации: 10 слотов (свободно: {GENERATION_SEMAPHORE._value})
-🕐 Rate limit записей: {len(user_request_times)}
+🔒 Администраторов: {len(settings.get("ADMIN_IDS"))}
+🛡️ Rate limiting: {settings.get("MAX_REQUESTS_PER_HOUR")} req/{settings.get("REQUEST_WINDOW")} s
+🎯 Слоты генерации: {generation_scheduler.capacity} (свободно: {generation_scheduler.available()})
+🕐 Rate limit записей: {rate_limiter.size()}
         """
         
         await update.message.reply_text(stats_text, parse_mode='Markdown')
@@ -700,25 +346,12 @@ async def admin_users(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         session = SessionLocal()
-        
-        # Получаем топ пользователей по активности
-        from sqlalchemy import func, desc
-        top_users = session.query(
-            UserAction.user_id,
-            func.count(UserAction.id).label('action_count'),
-            func.max(UserAction.timestamp).label('last_activity')
-        ).group_by(UserAction.user_id)\
-         .order_by(desc('action_count'))\
-         .limit(10).all()
-        
-        users_text = "👥 **Топ-10 активных пользователей:**\n\n"
-        for user_id, action_count, last_activity in top_users:
-            users_text += f"• User ID: {user_id}\n"
-            users_text += f"  📝 Действий: {action_count}\n"
-            users_text += f"  🕐 Последняя активность: {last_activity.strftime('%Y-%m-%d %H:%M')}\n\n"
+        users_text = users_report(session)
         
         await update.message.reply_text(users_text, parse_mode='Markdown')
         
@@ -733,6 +366,8 @@ async def admin_broadcast(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "broadcast"):
+        return
     
     if not context.args:
         await update.message.reply_text(
@@ -788,19 +423,28 @@ async def admin_system(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         import psutil
         import sys
         
         # Системная информация
-        cpu_percent = psutil.cpu_percent(interval=1)
+        cpu_percent = psutil.cpu_percent(interval=None)  # с предыдущего замера, без ожидания
         memory = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
         
         # Информация о Python процессе
         process = psutil.Process()
         bot_memory = process.memory_info().rss / 1024 / 1024  # MB
+        coze_stats = coze_client.stats()
+        jobs = order_job_counts()
+        payment_stats = "\n".join(
+            f"• {name}: {s['calls']} вызовов, ошибок {s['errors']}, таймаутов {s['timeouts']}, "
+            f"средняя {s['avg_latency']:.2f} с, макс. {s['max_latency']:.2f} с"
+            for name, s in payment_gateway.stats().items()
+        ) or "• вызовов пока не было"
         
         system_text = f"""
 🖥️ **Системная информация:**
@@ -812,8 +456,20 @@ async def admin_system(update: Update, context: CallbackContext) -> None:
 🤖 **Бот:**
 📊 Память бота: {bot_memory:.1f} MB
 🐍 Python: {sys.version.split()[0]}
-⚡ Активных генераций: {10 - GENERATION_SEMAPHORE._value}
-🕐 Rate limit записей: {len(user_request_times)}
+⚡ Активных генераций: {generation_scheduler.running()}
+🧾 Заданий заказов: в очереди {jobs.get('queued', 0)}, выполняется {jobs.get('running', 0)}{' (воркеры)' if ORDER_WORKERS_EXTERNAL else ''}
+📨 Обновлений в обработке: {updates_in_progress(context.application)}
+🕐 Rate limit записей: {rate_limiter.size()}
+💬 Незавершённых диалогов: {persistence.size()[1] if persistence else "не сохраняются"}
+
+📚 **Источники (Coze):**
+🎯 Попаданий в кеш: {coze_stats['hit_rate'] * 100:.0f}% ({coze_stats['cache_hits']}/{coze_stats['requests']})
+🔗 Объединено запросов: {coze_stats['coalesced']}
+⏱️ Задержка: средняя {coze_stats['avg_latency']:.1f} с, p95 {coze_stats['p95_latency']:.1f} с
+❌ Ошибок: {coze_stats['errors']}
+
+💳 **YooKassa:**
+{payment_stats}
         """
         
         await update.message.reply_text(system_text, parse_mode='Markdown')
@@ -821,8 +477,8 @@ async def admin_system(update: Update, context: CallbackContext) -> None:
     except ImportError:
         await update.message.reply_text(
             "📋 **Базовая информация:**\n\n"
-            "⚡ Семафор генерации: доступно слотов " + str(GENERATION_SEMAPHORE._value) + "/10\n"
-            "🕐 Rate limit записей: " + str(len(user_request_times)) + "\n\n"
+            "⚡ Слоты генерации: свободно " + str(generation_scheduler.available()) + "/" + str(generation_scheduler.capacity) + "\n"
+            "🕐 Rate limit записей: " + str(rate_limiter.size()) + "\n\n"
             "ℹ️ Для полной информации установите: pip install psutil"
         )
     except Exception as e:
@@ -834,57 +490,12 @@ async def admin_orders(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         session = SessionLocal()
-        
-        # Статистика по заказам
-        from sqlalchemy import func, desc
-        
-        total_orders = session.query(Order).count()
-        completed_orders = session.query(Order).filter(Order.status == "completed").count()
-        failed_orders = session.query(Order).filter(Order.status == "failed").count()
-        refunded_orders = session.query(Order).filter(Order.status == "refunded").count()
-        
-        # Последние заказы
-        recent_orders = session.query(Order)\
-            .order_by(desc(Order.created_at))\
-            .limit(5).all()
-        
-        # Доходы
-        total_revenue = session.query(func.sum(Order.price))\
-            .filter(Order.status == "completed").scalar() or 0
-        
-        orders_text = f"""
-📊 **Статистика заказов:**
-
-📝 Всего заказов: {total_orders}
-✅ Выполнено: {completed_orders}
-❌ Ошибки: {failed_orders}
-💸 Возвраты: {refunded_orders}
-💰 Общий доход: {total_revenue}₽
-
-📋 **Последние заказы:**
-
-        """
-        
-        for order in recent_orders:
-            status_emoji = {
-                "created": "🆕",
-                "paid": "💳",
-                "completed": "✅",
-                "failed": "❌",
-                "refunded": "💸",
-                "cancelled": "🚫"
-            }.get(order.status, "❓")
-            
-            orders_text += f"""
-{status_emoji} ID: {order.id} | {order.work_type}
-💰 {order.price}₽ | 👤 {order.user_id}
-📚 {order.science_name} - {order.work_theme[:30]}...
-🕐 {order.created_at.strftime('%d.%m %H:%M')}
-
-"""
+        orders_text = orders_report(session)
         
         await update.message.reply_text(orders_text, parse_mode='Markdown')
         
@@ -899,132 +510,12 @@ async def admin_finance(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         session = SessionLocal()
-        from sqlalchemy import func, desc
-        
-        # Временные интервалы
-        now = datetime.now(timezone.utc)
-        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        yesterday = today - timedelta(days=1)
-        week_ago = now - timedelta(days=7)
-        month_ago = now - timedelta(days=30)
-        
-        # Доходы по периодам
-        today_revenue = session.query(func.sum(Order.price)).filter(
-            Order.status.in_(["paid", "completed"]),
-            Order.created_at >= today
-        ).scalar() or 0
-        
-        yesterday_revenue = session.query(func.sum(Order.price)).filter(
-            Order.status.in_(["paid", "completed"]),
-            Order.created_at >= yesterday,
-            Order.created_at < today
-        ).scalar() or 0
-        
-        week_revenue = session.query(func.sum(Order.price)).filter(
-            Order.status.in_(["paid", "completed"]),
-            Order.created_at >= week_ago
-        ).scalar() or 0
-        
-        month_revenue = session.query(func.sum(Order.price)).filter(
-            Order.status.in_(["paid", "completed"]),
-            Order.created_at >= month_ago
-        ).scalar() or 0
-        
-        # Заказы по периодам
-        today_orders = session.query(Order).filter(Order.created_at >= today).count()
-        yesterday_orders = session.query(Order).filter(
-            Order.created_at >= yesterday,
-            Order.created_at < today
-        ).count()
-        
-        # Средний чек по периодам
-        today_avg = today_revenue / today_orders if today_orders > 0 else 0
-        yesterday_avg = yesterday_revenue / yesterday_orders if yesterday_orders > 0 else 0
-        
-        # Топ-5 самых дорогих заказов
-        expensive_orders = session.query(Order).filter(
-            Order.status.in_(["paid", "completed"])
-        ).order_by(desc(Order.price)).limit(5).all()
-        
-        # Статистика по типам работ (доходы)
-        work_revenue = session.query(
-            Order.work_type,
-            func.sum(Order.price).label('revenue'),
-            func.count(Order.id).label('count')
-        ).filter(
-            Order.status.in_(["paid", "completed"])
-        ).group_by(Order.work_type).order_by(desc('revenue')).limit(5).all()
-        
-        # Статистика по дням недели
-        weekday_stats = session.query(
-            func.extract('dow', Order.created_at).label('weekday'),
-            func.sum(Order.price).label('revenue'),
-            func.count(Order.id).label('count')
-        ).filter(
-            Order.status.in_(["paid", "completed"]),
-            Order.created_at >= week_ago
-        ).group_by(func.extract('dow', Order.created_at)).all()
-        
-        # Конверсия воронки
-        total_users = session.query(UserAction.user_id).distinct().count()
-        order_users = session.query(Order.user_id).distinct().count()
-        paid_users = session.query(Order.user_id).filter(
-            Order.status.in_(["paid", "completed"])
-        ).distinct().count()
-        
-        conversion_to_order = (order_users / total_users * 100) if total_users > 0 else 0
-        conversion_to_payment = (paid_users / order_users * 100) if order_users > 0 else 0
-        
-        # Возвраты и отмены
-        refunds = session.query(Order).filter(Order.status == "refunded").count()
-        failed_orders = session.query(Order).filter(Order.status == "failed").count()
-        
-        finance_text = f"""
-💰 **Финансовая аналитика:**
-
-📊 **Доходы:**
-💸 Сегодня: {today_revenue:.0f} руб. ({today_orders} заказов)
-📅 Вчера: {yesterday_revenue:.0f} руб. ({yesterday_orders} заказов)
-📈 За неделю: {week_revenue:.0f} руб.
-📊 За месяц: {month_revenue:.0f} руб.
-
-💵 **Средний чек:**
-🔥 Сегодня: {today_avg:.0f} руб.
-📊 Вчера: {yesterday_avg:.0f} руб.
-
-🎯 **Конверсия:**
-👥 Всего пользователей: {total_users}
-📝 Создали заказ: {order_users} ({conversion_to_order:.1f}%)
-💳 Оплатили: {paid_users} ({conversion_to_payment:.1f}%)
-
-🔥 **Топ-5 дорогих заказов:**"""
-        
-        for order in expensive_orders:
-            finance_text += f"\n💰 {order.price}₽ - {order.work_type} ({order.science_name})"
-        
-        finance_text += f"""
-
-📊 **Доходы по типам работ:**"""
-        for work_type, revenue, count in work_revenue:
-            finance_text += f"\n• {work_type}: {revenue:.0f}₽ ({count} заказов)"
-        
-        finance_text += f"""
-
-📅 **Статистика по дням недели:**"""
-        weekdays = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-        for weekday, revenue, count in weekday_stats:
-            day_name = weekdays[int(weekday) - 1] if weekday and weekday > 0 else "Неизв"
-            finance_text += f"\n• {day_name}: {revenue:.0f}₽ ({count} заказов)"
-        
-        finance_text += f"""
-
-⚠️ **Проблемы:**
-🔴 Возвраты: {refunds}
-❌ Неудачные заказы: {failed_orders}
-        """
+        finance_text = finance_report(session)
         
         await update.message.reply_text(finance_text, parse_mode='Markdown')
         
@@ -1039,70 +530,22 @@ async def admin_export(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         session = SessionLocal()
-        import csv
-        from io import StringIO
         
         # Экспорт заказов
-        orders = session.query(Order).all()
-        
-        # Создаем CSV в памяти
-        csv_buffer = StringIO()
-        writer = csv.writer(csv_buffer)
-        
-        # Заголовки
-        writer.writerow([
-            'ID', 'User ID', 'Work Type', 'Science Name', 'Theme', 
-            'Pages', 'Price', 'Status', 'Created At', 'Completed At'
-        ])
-        
-        # Данные
-        for order in orders:
-            writer.writerow([
-                order.id,
-                order.user_id,
-                order.work_type,
-                order.science_name,
-                order.work_theme,
-                order.page_number,
-                order.price,
-                order.status,
-                order.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                order.completed_at.strftime('%Y-%m-%d %H:%M:%S') if order.completed_at else ''
-            ])
-        
-        # Отправляем файл
-        csv_content = csv_buffer.getvalue().encode('utf-8')
         await update.message.reply_document(
-            document=io.BytesIO(csv_content),
+            document=io.BytesIO(orders_csv(session)),
             filename=f"orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
             caption="📊 Экспорт заказов в CSV"
         )
         
         # Экспорт активности пользователей
-        actions = session.query(UserAction).all()
-        
-        actions_csv_buffer = StringIO()
-        actions_writer = csv.writer(actions_csv_buffer)
-        
-        # Заголовки
-        actions_writer.writerow(['ID', 'User ID', 'Action', 'Timestamp'])
-        
-        # Данные
-        for action in actions:
-            actions_writer.writerow([
-                action.id,
-                action.user_id,
-                action.action,
-                action.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            ])
-        
-        # Отправляем файл активности
-        actions_csv_content = actions_csv_buffer.getvalue().encode('utf-8')
         await update.message.reply_document(
-            document=io.BytesIO(actions_csv_content),
+            document=io.BytesIO(actions_csv(session)),
             filename=f"user_actions_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
             caption="📊 Экспорт активности пользователей в CSV"
         )
@@ -1120,6 +563,8 @@ async def admin_monitor(update: Update, context: CallbackContext) -> None:
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Доступ запрещен")
         return
+    if not await enforce_rate_limit(update, "admin"):
+        return
     
     try:
         session = SessionLocal()
@@ -1131,11 +576,42 @@ async def admin_monitor(update: Update, context: CallbackContext) -> None:
         ).count()
         
         # Активные генерации
-        active_generations = 10 - GENERATION_SEMAPHORE._value
+        active_generations = generation_scheduler.running()
+        
+        # Очереди по полосам приоритета (слоты запросов к модели и слоты заказов)
+        lane_names = {"paid": "💳 Оплаченные", "retry": "🔁 Повторы", "test": "🧪 Тестовые"}
+        lane_stats = ""
+        order_lanes = order_scheduler.stats()
+        for lane, stats in generation_scheduler.stats().items():
+            lane_stats += (
+                f"\n{lane_names[lane]}: заказов {order_lanes[lane]['running']} (ждут {order_lanes[lane]['waiting']}), "
+                f"запросов {stats['running']}/{stats['limit']} (ждут {stats['waiting']}), "
+                f"ожидание слота ср. {stats['avg_wait']:.1f} с, макс. {stats['max_wait']:.0f} с"
+            )
         
         # Заказы в очереди (created статус)
         pending_orders = session.query(Order).filter(Order.status == "created").count()
         
+        # Ожидают оплаты (сверяются с YooKassa)
+        awaiting_payment = session.query(Order).filter(Order.status == "payment_created").count()
+        
+        # Очередь генерации и оценка времени выполнения нового заказа
+        load = get_generation_load()
+        new_order_eta = estimate_order_eta(load["backlog"], load["typical_duration"])
+        max_active, max_queued = settings.get("MAX_ACTIVE_ORDERS"), settings.get("MAX_QUEUED_ORDERS")
+        
+        # Время выполнения стадий заказов
+        latency_text = latency_report(session)
+        
+        # Возвраты, которые не удались или уже повторялись
+        stuck_refunds = session.query(OutboxMessage).filter(
+            OutboxMessage.kind == "refund",
+            or_(
+                OutboxMessage.status == "failed",
+                (OutboxMessage.status == "pending") & (OutboxMessage.attempts >= 2)
+            )
+        ).count()
+        
         # Неудачные заказы за последний час
         last_hour = datetime.now(timezone.utc) - timedelta(hours=1)
         failed_recent = session.query(Order).filter(
@@ -1146,37 +622,48 @@ async def admin_monitor(update: Update, context: CallbackContext) -> None:
         # Системные метрики
         try:
             import psutil
-            cpu_percent = psutil.cpu_percent(interval=1)
+            cpu_percent = psutil.cpu_percent(interval=None)  # с предыдущего замера, без ожидания
             memory_percent = psutil.virtual_memory().percent
             system_status = f"💻 CPU: {cpu_percent}% | 🧠 RAM: {memory_percent}%"
         except ImportError:
             system_status = "📊 Системные метрики недоступны"
         
         # Статус семафора
-        semaphore_status = "🟢 Норма" if active_generations < 8 else "🟡 Высокая нагрузка" if active_generations < 10 else "🔴 Перегрузка"
+        semaphore_status = "🟢 Норма" if active_generations < generation_scheduler.capacity * 0.8 else "🟡 Высокая нагрузка" if active_generations < generation_scheduler.capacity else "🔴 Перегрузка"
         
         # Алерты
         alerts = []
         if failed_recent > 5:
             alerts.append("🚨 Много неудачных заказов за час")
-        if active_generations >= 9:
+        if active_generations >= generation_scheduler.capacity - 1:
             alerts.append("⚠️ Высокая нагрузка генерации")
         if pending_orders > 10:
             alerts.append("📋 Много заказов в очереди")
+        if load["backlog"] >= max_active + max_queued:
+            alerts.append("🔥 Очередь заполнена — новые заказы не принимаются")
+        if stuck_refunds:
+            alerts.append(f"💸 Зависших возвратов: {stuck_refunds} (/admin_refunds)")
         
         monitor_text = f"""
 🔍 **Мониторинг системы:**
 
 ⚡ **Активность:**
 🕐 Действий за 5 мин: {recent_activity}
-🎯 Активных генераций: {active_generations}/10
+🎯 Активных генераций: {active_generations}/{generation_scheduler.capacity}
 📋 Заказов в очереди: {pending_orders}
+💳 Ожидают оплаты: {awaiting_payment}
+🧾 Оплачено и в работе: {load['backlog']} (одновременно до {max_active}, очередь до {max_queued})
+⏱ Новый заказ будет готов: {format_eta(new_order_eta)} (типичный заказ {format_eta(load['typical_duration'])})
 ❌ Неудачных заказов/час: {failed_recent}
 
 🖥️ **Система:**
 {system_status}
 🎯 Статус генерации: {semaphore_status}
 
+🛣 **Полосы генерации:**{lane_stats}
+
+⏱ **Время стадий заказа:**{latency_text}
+
 🚨 **Алерты:**"""
         
         if alerts:
@@ -1191,6 +678,9 @@ async def admin_monitor(update: Update, context: CallbackContext) -> None:
 /admin_stats - Полная статистика
 /admin_finance - Финансовая аналитика
 /admin_system - Системная информация
+/admin_resume - Возобновить неудачный заказ
+/admin_refunds - Зависшие возвраты
+/admin_config - Настройки без перезапуска
         """
         
         await update.message.reply_text(monitor_text, parse_mode='Markdown')
@@ -1201,106 +691,169 @@ async def admin_monitor(update: Update, context: CallbackContext) -> None:
     finally:
         session.close()
 
-# Настройка базы данных
-DATABASE_URL = "sqlite:///user_activity.db"
-Base = declarative_base()  # Updated to use sqlalchemy.orm.declarative_base
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Модель для хранения действий пользователей
-class UserAction(Base):
-    __tablename__ = "user_actions"
-
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)
-    action = Column(String, index=True)
-    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
-
-# Новая модель для хранения заказов
-class Order(Base):
-    __tablename__ = "orders"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)
-    work_type = Column(String)
-    science_name = Column(String)
-    work_theme = Column(String)
-    page_number = Column(Integer)
-    price = Column(Integer)
-    status = Column(String, default="created")  # created, paid, completed, failed, refunded
-    payment_id = Column(String, nullable=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
-    completed_at = Column(DateTime, nullable=True)
-
-# Создание таблиц
-Base.metadata.create_all(bind=engine)
-
-# Функция для записи действий пользователя
-async def log_user_action(user_id: str, action: str):
+# Ссылки на фоновые задачи, чтобы их не удалил сборщик мусора
+background_tasks = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Запускает корутину в фоне и хранит ссылку на задачу до её завершения"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# ===================== КОНТЕКСТ ЗАКАЗА =====================
+
+# Поля user_data, которых достаточно, чтобы повторить генерацию заказа без диалога
+ORDER_PARAM_KEYS = (
+    "work_type", "science_name", "work_theme", "page_number",
+    "preferences", "use_custom_plan", "custom_plan", "price"
+)
+
+def order_params_from_user_data(user_data: dict) -> dict:
+    """Снимок параметров заказа из context.user_data"""
+    return {key: user_data.get(key) for key in ORDER_PARAM_KEYS if key in user_data}
+
+class OrderContext:
+    """Минимальная замена CallbackContext для обработки заказа вне диалога"""
+
+    def __init__(self, bot, chat_id: int, user_data: dict):
+        self.bot = bot
+        self._chat_id = chat_id
+        self.user_data = user_data
+
+def build_order_context(bot, order, lane: str = None) -> OrderContext:
+    """Восстанавливает контекст генерации по сохранённому заказу"""
+    return OrderContext(bot, int(order.user_id), order_user_data(order, lane))
+
+# ===================== ДОСТАВКА ДОКУМЕНТОВ =====================
+
+class DeliveryError(Exception):
+    """Документ создан и сохранён, но не доставлен в Telegram"""
+
+async def send_order_document(bot, chat_id: int, order_id: int, caption: str) -> None:
+    """Отправляет документ заказа, повторно используя Telegram file_id
+
+    Документ берётся из хранилища; после первой загрузки сохраняется
+    file_id, и следующие отправки не загружают файл заново.
+    """
+    artifact = get_order_artifact(order_id, "docx")
+    if artifact is None:
+        raise DeliveryError(f"Документ заказа {order_id} не найден")
+
+    file_id = artifact.telegram_file_id or find_telegram_file_id(artifact.artifact_key)
+    if file_id:
+        try:
+            await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+            if not artifact.telegram_file_id:
+                set_telegram_file_id(order_id, "docx", file_id)
+            return
+        except Exception as e:
+            logging.warning(f"Не удалось отправить заказ {order_id} по file_id: {e}")
+
+    data = await asyncio.to_thread(artifact_store.get, artifact.artifact_key)
+    if data is None:
+        raise DeliveryError(f"Документ заказа {order_id} удалён из хранилища")
+
+    last_error = None
+    for attempt in range(3):
+        try:
+            message = await bot.send_document(
+                chat_id=chat_id,
+                document=io.BytesIO(data),
+                filename=artifact.filename,
+                caption=caption
+            )
+            if message and message.document:
+                set_telegram_file_id(order_id, "docx", message.document.file_id)
+            return
+        except Exception as e:
+            last_error = e
+            logging.warning(f"Ошибка отправки документа заказа {order_id} (попытка {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+    raise DeliveryError(f"Не удалось отправить документ заказа {order_id}: {last_error}")
+
+async def deliver_document(bot, chat_id: int, order_id: int, data: bytes, filename: str, caption: str) -> None:
+    """Сохраняет готовый документ в хранилище и отправляет его пользователю"""
+    await save_order_artifact(order_id, "docx", data, filename)
+    await send_order_document(bot, chat_id, order_id, caption)
+
+async def mark_delivery_failed(order_id: int, chat_id: int) -> None:
+    """Документ готов, но не доставлен: статус delivery_failed и уведомление через outbox
+
+    Уведомление отправляет outbox_worker с повторами, поэтому оно дойдёт, даже
+    если Telegram был недоступен в момент доставки.
+    """
+    await update_order_status(order_id, "delivery_failed")
+    add_outbox_messages([notify_message(
+        order_id, chat_id,
+        f"📄 Работа по заказу №{order_id} готова, но отправить документ не удалось. "
+        "Скачать его можно командой /my_orders",
+        "delivery_failed"
+    )])
+
+async def my_orders(update: Update, context: CallbackContext) -> None:
+    """Список заказов пользователя с возможностью повторно скачать документ"""
+    user_id = update.effective_user.id
+    await log_user_action(user_id, "my_orders_command")
+
     session = SessionLocal()
     try:
-        user_action = UserAction(
-            user_id=str(user_id), 
-            action=action,
-            timestamp=datetime.now(timezone.utc)  # Заменить deprecated utcnow()
-        )
-        session.add(user_action)
-        session.commit()
-        logging.info(f"User action logged: {action} for user {user_id}")
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Ошибка записи действия пользователя: {e}")
-        raise
+        orders = session.query(Order).join(
+            OrderArtifact, OrderArtifact.order_id == Order.id
+        ).filter(
+            Order.user_id == str(user_id),
+            OrderArtifact.kind == "docx"
+        ).order_by(Order.created_at.desc()).limit(10).all()
     finally:
         session.close()
 
-# Функция для создания заказа
-async def create_order(user_id: str, order_data: dict) -> int:
-    """Создает заказ в базе данных и возвращает ID заказа"""
-    session = SessionLocal()
+    if not orders:
+        await update.message.reply_text("📭 У вас пока нет готовых работ. Оформить заказ: /order")
+        return
+
+    keyboard = [
+        [InlineKeyboardButton(
+            f"📄 №{o.id} · {o.work_theme[:30]}",
+            callback_data=f"redownload:{o.id}"
+        )]
+        for o in orders
+    ]
+    await update.message.reply_text(
+        "📚 *Ваши работы:*\n\nНажмите на заказ, чтобы скачать документ ещё раз.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+async def redownload_handler(update: Update, context: CallbackContext) -> None:
+    """Повторная отправка документа заказа по inline-кнопке из /my_orders"""
+    query = update.callback_query
+    await query.answer()
     try:
-        order = Order(
-            user_id=str(user_id),
-            work_type=order_data.get("work_type", ""),
-            science_name=order_data.get("science_name", ""),
-            work_theme=order_data.get("work_theme", ""),
-            page_number=order_data.get("page_number", 0),
-            price=order_data.get("price", 0),
-            status="created"
-        )
-        session.add(order)
-        session.commit()
-        order_id = order.id
-        logging.info(f"Order created: {order_id} for user {user_id}")
-        return order_id
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Ошибка создания заказа: {e}")
-        raise
-    finally:
-        session.close()
+        order_id = int(query.data.split(":", 1)[1])
+    except (IndexError, ValueError):
+        return
 
-# Функция для обновления статуса заказа
-async def update_order_status(order_id: int, status: str, payment_id: str = None):
-    """Обновляет статус заказа"""
     session = SessionLocal()
     try:
         order = session.query(Order).filter(Order.id == order_id).first()
-        if order:
-            order.status = status
-            if payment_id:
-                order.payment_id = payment_id
-            if status == "completed":
-                order.completed_at = datetime.now(timezone.utc)
-            session.commit()
-            logging.info(f"Order {order_id} status updated to {status}")
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Ошибка обновления статуса заказа: {e}")
-        raise
     finally:
         session.close()
 
+    if order is None or order.user_id != str(query.from_user.id):
+        await query.message.reply_text("❌ Заказ не найден")
+        return
+
+    try:
+        await send_order_document(
+            context.bot, query.message.chat_id, order_id,
+            caption=f"📄 Заказ №{order_id}: {order.work_type}"
+        )
+    except DeliveryError as e:
+        logging.error(f"Ошибка повторной отправки: {e}")
+        await query.message.reply_text(
+            "❌ Документ больше недоступен для скачивания. Обратитесь в поддержку."
+        )
+
 # Команда /start
 async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
@@ -1312,8 +865,8 @@ async def start(update: Update, context: CallbackContext) -> None:
     
     # Уведомление о тестовом режиме
     mode_text = ""
-    is_test_user = username in TEST_MODE_USERNAMES
-    if TESTING_MODE or is_test_user:
+    is_test_user = username in settings.get("TEST_MODE_USERNAMES")
+    if settings.get("TESTING_MODE") or is_test_user:
         mode_text = "\n🧪 *ВНИМАНИЕ: БОТ В ТЕСТОВОМ РЕЖИМЕ* 🧪\n" \
                    "Все заказы выполняются БЕСПЛАТНО для тестирования!\n\n"
     
@@ -1333,6 +886,7 @@ async def help_command(update: Update, context: CallbackContext) -> None:
         "🆘 *Помощь* 🆘\n\n"
         "Вот список доступных команд:\n"
         "- 📋 /order - Оформить заказ\n"
+        "- 📚 /my_orders - Скачать готовые работы повторно\n"
         "- ❌ /cancel - Отменить текущий процесс\n"
         "- ℹ️ /help - Показать это сообщение помощи"
     )
@@ -1448,7 +1002,7 @@ async def work_theme_back(update: Update, context: CallbackContext) -> int:
     """Возврат к вводу количества страниц"""
     work_type = context.user_data.get("work_type", "")
     clean_type = re.sub(r"[^А-Яа-яЁё ]", "", work_type).strip()
-    max_pages = PAGE_LIMITS.get(clean_type, 10)
+    max_pages = settings.get("PAGE_LIMITS").get(clean_type, 10)
     
     keyboard = create_keyboard_with_back([], show_back=True)
     reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
@@ -1519,16 +1073,6 @@ async def preferences_back(update: Update, context: CallbackContext) -> int:
         context.user_data.pop("use_custom_plan", None)
         return CUSTOM_PLAN
 
-# Ограничение страниц по типам работы
-PAGE_LIMITS = {"Эссе": 10, "Доклад": 10, "Реферат": 20, "Проект": 20, "Курсовая работа": 30, "Дипломная работа": 70}
-# Семафор для ограничения одновременных запросов к DeepSeek API
-# Настройки семафора:
-# 5 - для малой нагрузки (1-10 пользователей)
-# 10 - для средней нагрузки (10-50 пользователей) [текущая]
-# 20 - для высокой нагрузки (50+ пользователей)
-# 30 - для максимальной нагрузки (100+ пользователей)
-GENERATION_SEMAPHORE = asyncio.Semaphore(10)
-
 # Начало заказа
 async def order(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
@@ -1651,7 +1195,7 @@ async def science_name_handler(update: Update, context: CallbackContext) -> int:
     # Шаг 2 из 6: количество страниц (с учётом лимитов)
     work_type = context.user_data.get("work_type", "")
     clean_type = re.sub(r"[^А-Яа-яЁё ]", "", work_type).strip()
-    max_pages = PAGE_LIMITS.get(clean_type, 10)
+    max_pages = settings.get("PAGE_LIMITS").get(clean_type, 10)
     
     keyboard = create_keyboard_with_back([], show_back=True)
     reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
@@ -1675,7 +1219,7 @@ async def page_number_handler(update: Update, context: CallbackContext) -> int:
         return PAGE_NUMBER
     work_type = context.user_data.get("work_type", "")
     clean_type = re.sub(r"[^А-Яа-яЁё ]", "", work_type).strip()
-    max_pages = PAGE_LIMITS.get(clean_type, 10)
+    max_pages = settings.get("PAGE_LIMITS").get(clean_type, 10)
     if page < 1 or page > max_pages:
         await update.message.reply_text(
             f"❗️Для {clean_type} максимальное количество страниц — {max_pages}. Пожалуйста, введите число от 1 до {max_pages}:"
@@ -1860,9 +1404,12 @@ async def preferences_handler(update: Update, context: CallbackContext) -> int:
             [InlineKeyboardButton("◀️ Назад", callback_data="back")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
+        load = get_generation_load()
+        eta = estimate_order_eta(load["backlog"], load["typical_duration"])
         await update.message.reply_text(
             f"💰 *Оплата заказа* 💰\n\n"
-            f"Сумма к оплате: {price} рублей\n\n"
+            f"Сумма к оплате: {price} рублей\n"
+            f"⏱ Ориентировочное время выполнения: {format_eta(eta)}\n\n"
             "Нажмите кнопку ниже для перехода к оплате:",
             reply_markup=reply_markup,
             parse_mode='Markdown'
@@ -1870,18 +1417,146 @@ async def preferences_handler(update: Update, context: CallbackContext) -> int:
         return PAYMENT
 
 
+# ===================== ДОПУСК ЗАКАЗОВ =====================
+# Оплаченные и тестовые заказы, которые выполняются или ждут в очереди
+ACTIVE_ORDER_STATUSES = ("paid", "test_paid")
+
+def get_generation_load() -> dict:
+    """Текущая очередь генерации и типичное время выполнения заказа
+    
+    Returns:
+        Словарь с ключами 'backlog' (заказов в работе и в очереди),
+        'typical_duration' (медиана по последним заказам, секунды)
+        и 'throughput' (заказов в час при полной загрузке)
+    """
+    session = SessionLocal()
+    try:
+        # Тестовые заказы идут в младшей полосе и не задерживают оплаченные
+        backlog = session.query(Order).filter(
+            Order.status == "paid",
+            or_(Order.payment_id.is_(None), Order.payment_id != "TEST_MODE")
+        ).count()
+        recent = session.query(Order.paid_at, Order.completed_at).filter(
+            Order.status == "completed",
+            Order.paid_at.isnot(None),
+            Order.completed_at.isnot(None)
+        ).order_by(Order.completed_at.desc()).limit(50).all()
+    finally:
+        session.close()
+    
+    durations = sorted(
+        d for d in ((as_utc(completed) - as_utc(paid)).total_seconds() for paid, completed in recent) if d > 0
+    )
+    typical = durations[len(durations) // 2] if durations else DEFAULT_ORDER_DURATION
+    return {
+        "backlog": backlog,
+        "typical_duration": typical,
+        "throughput": settings.get("MAX_ACTIVE_ORDERS") * 3600 / typical,
+    }
+
+def order_queue_samples():
+    """Заказы, ожидающие оплаты или выполняющиеся, по статусам"""
+    from sqlalchemy import func
+    statuses = ("payment_created",) + ACTIVE_ORDER_STATUSES
+    session = SessionLocal()
+    try:
+        counts = dict(session.query(Order.status, func.count(Order.id)).filter(
+            Order.status.in_(statuses)
+        ).group_by(Order.status).all())
+    finally:
+        session.close()
+    return [({"status": status}, counts.get(status, 0)) for status in statuses]
+
+metrics.gauge("orders_in_progress", "Заказы в очереди и в работе по статусам", ("status",)).set_function(
+    order_queue_samples
+)
+
+def estimate_order_eta(backlog: int, typical_duration: float) -> float:
+    """Ожидаемое время выполнения нового заказа (секунды)
+    
+    Заказы выполняются по MAX_ACTIVE_ORDERS одновременно: новый заказ
+    попадает в (backlog // MAX_ACTIVE_ORDERS + 1)-ю волну.
+    """
+    return typical_duration * (backlog // settings.get("MAX_ACTIVE_ORDERS") + 1)
+
+def format_eta(seconds: float) -> str:
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"≈ {minutes} мин"
+    return f"≈ {minutes // 60} ч {minutes % 60} мин"
+
+def admit_order(user_id: int) -> dict:
+    """Решает, можно ли принять новый заказ пользователя
+    
+    Returns:
+        Словарь с ключами 'allowed', 'eta' (секунды), 'queued' (заказ
+        будет ждать свободного слота) и 'reason' (текст отказа)
+    """
+    session = SessionLocal()
+    try:
+        user_active = session.query(Order).filter(
+            Order.user_id == str(user_id),
+            Order.status.in_(ACTIVE_ORDER_STATUSES)
+        ).count()
+    finally:
+        session.close()
+    
+    if user_active >= settings.get("MAX_USER_ACTIVE_ORDERS"):
+        return {
+            "allowed": False, "eta": 0, "queued": False,
+            "reason": f"⏳ У вас уже выполняется заказов: {user_active}. "
+                      "Дождитесь их завершения и оформите новый заказ."
+        }
+    
+    load = get_generation_load()
+    if load["backlog"] >= settings.get("MAX_ACTIVE_ORDERS") + settings.get("MAX_QUEUED_ORDERS"):
+        # Через сколько освободится место в очереди
+        retry_after = load["typical_duration"]
+        logging.warning(f"Заказ пользователя {user_id} отклонён: очередь заполнена ({load['backlog']})")
+        return {
+            "allowed": False, "eta": 0, "queued": False,
+            "reason": "🔥 Сейчас очень много заказов, и мы не успеем выполнить новый вовремя.\n"
+                      f"Пожалуйста, попробуйте через {format_eta(retry_after)}. Оплата не списана."
+        }
+    
+    # Лимит частоты проверяется последним, чтобы отказы по нагрузке его не расходовали
+    limit = rate_limiter.hit("order", user_id)
+    if not limit.allowed:
+        return {
+            "allowed": False, "eta": 0, "queued": False,
+            "reason": "⏳ Слишком много заказов за последний час. "
+                      f"Следующий заказ можно оформить через {format_eta(limit.retry_after)}."
+        }
+    
+    return {
+        "allowed": True,
+        "eta": estimate_order_eta(load["backlog"], load["typical_duration"]),
+        "queued": load["backlog"] >= settings.get("MAX_ACTIVE_ORDERS"),
+        "reason": None,
+    }
+
 async def create_payment(update: Update, context: CallbackContext) -> int:
     try:
         # Создаем заказ в базе данных
         user_id = update.callback_query.from_user.id
         username = update.callback_query.from_user.username or ""
         
+        admission = admit_order(user_id)
+        if not admission["allowed"]:
+            await update.callback_query.answer()
+            await update.callback_query.edit_message_text(admission["reason"])
+            return ConversationHandler.END
+        eta_text = f"Ориентировочное время выполнения: {format_eta(admission['eta'])}."
+        if admission["queued"]:
+            eta_text += "\n📋 Сейчас много заказов — ваш будет выполнен в порядке очереди."
+        
         order_data = {
             "work_type": context.user_data.get("work_type", ""),
             "science_name": context.user_data.get("science_name", ""),
             "work_theme": context.user_data.get("work_theme", ""),
             "page_number": context.user_data.get("page_number", 0),
-            "price": context.user_data.get("price", 0)
+            "price": context.user_data.get("price", 0),
+            "params": order_params_from_user_data(context.user_data)
         }
         order_id = await create_order(user_id, order_data)
         context.user_data["order_id"] = order_id
@@ -1891,22 +1566,22 @@ async def create_payment(update: Update, context: CallbackContext) -> int:
         work_type = context.user_data.get("work_type", "Работа")
         
         # Проверяем, является ли пользователь тестовым
-        is_test_user = username in TEST_MODE_USERNAMES
+        is_test_user = username in settings.get("TEST_MODE_USERNAMES")
         
         # 🧪 ТЕСТОВЫЙ РЕЖИМ - пропускаем реальную оплату
-        if TESTING_MODE or is_test_user:
+        if settings.get("TESTING_MODE") or is_test_user:
             mode_reason = "тестовый пользователь @" + username if is_test_user else "глобальный тестовый режим"
             logging.info(f"🧪 ТЕСТОВЫЙ РЕЖИМ ({mode_reason}): Пропуск оплаты для заказа {order_id}")
             await update.callback_query.answer()
             await update.callback_query.edit_message_text(
                 f"✅ Оплата успешно проведена! Начинаем выполнение вашего заказа.\n\n"
                 f"🔄 Генерация вашей работы... Пожалуйста, подождите!\n"
-                f"Это займет 2-3 минуты."
+                f"{eta_text}"
             )
-            # Обновляем статус как оплаченный
-            await update_order_status(order_id, "paid", payment_id="TEST_MODE")
-            # Запускаем процесс генерации
-            asyncio.create_task(process_order(context, user_id, order_id))
+            # Заказ отмечается оплаченным вместе с заданием на генерацию в тестовой полосе
+            transition_order_status(order_id, ["created"], "paid", payment_id="TEST_MODE", outbox=[
+                order_job(order_id, "test_mode", "test")
+            ])
             return ConversationHandler.END
         
         # Проверяем настройки YooKassa для реального режима
@@ -1923,31 +1598,10 @@ async def create_payment(update: Update, context: CallbackContext) -> int:
             logging.info(f"Создание платежа для заказа {order_id}, сумма: {price}")
             logging.info(f"Данные получателя: email=user{user_id}@ninjaessayai.com")
             
-            payment = Payment.create({
-                "amount": {"value": f"{price}.00", "currency": "RUB"},
-                "confirmation": {"type": "redirect", "return_url": "https://t.me/NinjaEssayAI_bot"},
-                "capture": True,
-                "description": f"{work_type} - {context.user_data.get('work_theme', 'Тема не указана')}",
-                "metadata": {"order_id": str(order_id)},
-                "receipt": {
-                    "customer": {
-                        "email": f"user{user_id}@ninjaessayai.com"
-                    },
-                    "items": [
-                        {
-                            "description": f"Написание работы: {work_type}",
-                            "quantity": "1.00",
-                            "amount": {
-                                "value": f"{price}.00",
-                                "currency": "RUB"
-                            },
-                            "vat_code": 1,
-                            "payment_mode": "full_payment",
-                            "payment_subject": "service"
-                        }
-                    ]
-                }
-            }, uuid.uuid4())
+            payment = await payment_gateway.create_payment(
+                payment_request(order_id, user_id, price, work_type, context.user_data.get('work_theme', 'Тема не указана')),
+                idempotence_key("payment", order_id)
+            )
             
             logging.info(f"Платеж создан успешно: {payment.id}")
             
@@ -1963,12 +1617,9 @@ async def create_payment(update: Update, context: CallbackContext) -> int:
             
             await update.callback_query.edit_message_text(
                 f"💳 Оплата {price}₽\n\n"
-                "После оплаты работа будет создана автоматически (2-3 минуты).",
+                f"После оплаты работа будет создана автоматически.\n{eta_text}",
                 reply_markup=payment_keyboard
             )
-            
-            # Запускаем мониторинг платежа
-            asyncio.create_task(monitor_payment(context, update.callback_query.from_user.id, payment.id))
             return ConversationHandler.END
             
         except Exception as payment_error:
@@ -1999,155 +1650,578 @@ async def create_payment(update: Update, context: CallbackContext) -> int:
             pass
         return ConversationHandler.END
 
-# Функция для обработки заказа в тестовом режиме
-async def process_order(context: CallbackContext, chat_id: int, order_id: int) -> None:
-    """Обработка заказа в тестовом режиме без реальной оплаты"""
+# ===================== ВЫПОЛНЕНИЕ ЗАКАЗА =====================
+# Единый путь выполнения заказа для оплаченных, тестовых и возобновлённых
+# заказов. Каждая стадия записывается в order_stages со временем начала,
+# окончания и результатом.
+
+def order_filename(user_data: dict) -> str:
+    """Безопасное имя файла документа"""
+    safe_type = sanitize_filename(user_data.get("work_type", "Работа"))
+    safe_theme = sanitize_filename(user_data.get("work_theme", "Тема"))
+    return f"{safe_type}_{safe_theme}.docx"
+
+async def collect_order_sources(order_id: int, user_data: dict) -> list:
+    """Стадия sources: при ошибке документ собирается без списка источников"""
     try:
-        logging.info(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Начало обработки заказа {order_id}")
-        
-        await context.bot.send_message(chat_id=chat_id, text="✅ Заказ принят! Начинаем выполнение вашего заказа.")
-        await context.bot.send_message(chat_id=chat_id, text="🔄 Генерация вашей работы... Пожалуйста, подождите!")
-        
-        # Генерация плана
-        plan_array = await generate_plan(context)
+        async with order_stage(order_id, "sources"):
+            return await collect_sources(
+                user_data["work_type"], user_data["work_theme"], user_data["science_name"]
+            )
+    except Exception as e:
+        logging.error(f"Ошибка подбора источников: {e}")
+        return []
+
+async def execute_order(bot, order_id: int, context=None,
+                        caption: str = "✅ Ваша работа готова! Спасибо за использование NinjaEssayAI!",
+                        completed_status: str = "completed") -> None:
+    """
+    Выполняет заказ: plan → chapters (параллельно sources) → render → deliver
+    
+    Args:
+        bot: Экземпляр бота
+        order_id: ID заказа
+        context: Контекст генерации (по умолчанию восстанавливается из заказа)
+        caption: Подпись к документу
+        completed_status: Статус заказа после доставки
+    
+    Raises:
+        DeliveryError: документ готов и сохранён, но не доставлен
+        Exception: ошибка генерации (готовые главы остаются в чекпоинтах)
+    """
+    if context is None:
+        context = build_order_context(bot, get_order(order_id))
+    user_data = context.user_data
+    chat_id = get_chat_id(context)
+    
+    async def notify(text: str) -> None:
+        await bot.send_message(chat_id=chat_id, text=text)
+    
+    async with order_stage(order_id, "plan"):
+        plan_array = await generate_plan(user_data, notify)
         if not plan_array:
             raise RuntimeError("План не сгенерирован")
-        context.user_data["plan_array"] = plan_array
+    user_data["plan_array"] = plan_array
+    
+    # Источники подбираются и проверяются параллельно с генерацией глав
+    sources_task = asyncio.create_task(collect_order_sources(order_id, user_data))
+    try:
+        async with order_stage(order_id, "chapters"):
+            chapters_text = await generate_chapters(plan_array, user_data)
+    except BaseException:
+        sources_task.cancel()
+        raise
+    sources = await sources_task
+    
+    async with order_stage(order_id, "render"):
+        # Сборка .docx занимает процессор — выполняется в отдельном потоке, не блокируя бота
+        document = await asyncio.to_thread(render_document, plan_array, chapters_text, sources, user_data)
+    
+    if sources:
+        await send_notice(notify, f"✅ Найдено и добавлено {len(sources)} источников")
+    else:
+        logging.warning("Не удалось получить источники ни из индекса, ни через Coze workflow")
+        await send_notice(notify, "⚠️ Не удалось автоматически найти источники. Пожалуйста, добавьте их самостоятельно.")
+    
+    async with order_stage(order_id, "deliver"):
+        await deliver_document(bot, chat_id, order_id, document, order_filename(user_data), caption=caption)
+    
+    await update_order_status(order_id, completed_status)
+
+# Функция для обработки заказа в тестовом режиме
+async def process_order(bot, order_id: int) -> None:
+    """Обработка заказа в тестовом режиме без реальной оплаты"""
+    chat_id = int(get_order(order_id).user_id)
+    logging.info(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Начало обработки заказа {order_id}")
+    await bot.send_message(chat_id=chat_id, text="✅ Заказ принят! Начинаем выполнение вашего заказа.")
+    await bot.send_message(chat_id=chat_id, text="🔄 Генерация вашей работы... Пожалуйста, подождите!")
+    await run_test_order(bot, order_id, completed_status="completed", failed_status="failed")
+
+# Выполнение оплаченного заказа (общий путь для опроса и уведомлений YooKassa)
+async def run_paid_order(bot, order_id: int, payment_id: str, amount: str = None) -> None:
+    """Генерирует и доставляет оплаченный заказ, при ошибке возвращает платёж"""
+    order = get_order(order_id)
+    context = build_order_context(bot, order)
+    chat_id = context._chat_id
+    
+    # Попытка генерации и возврат при ошибке
+    try:
+        await bot.send_message(chat_id=chat_id, text="✅ Оплата успешно проведена! Начинаем выполнение вашего заказа.")
+        await bot.send_message(chat_id=chat_id, text="🔄 Генерация вашей работы... Пожалуйста, подождите!")
+        await execute_order(bot, order_id, context)
+        await bot.send_message(chat_id=chat_id, text="🎉 Ваш заказ выполнен! Спасибо за использование нашего сервиса!")
+        return
         
-        # Генерация текста
-        doc_io = await generate_text(plan_array, context)
-        if doc_io is None:
-            raise RuntimeError("Документ не создан")
+    except DeliveryError as delivery_error:
+        # Работа готова и сохранена — возврат не нужен, документ доступен через /my_orders
+        logging.error(f"Заказ {order_id} не доставлен: {delivery_error}")
+        await mark_delivery_failed(order_id, chat_id)
+        return
         
-        # Создаем безопасное имя файла
-        work_type = context.user_data.get("work_type", "Работа")
-        work_theme = context.user_data.get("work_theme", "Тема")
-        safe_type = sanitize_filename(work_type)
-        safe_theme = sanitize_filename(work_theme)
-        filename = f"{safe_type}_{safe_theme}.docx"
-        
-        # Отправляем документ
-        await context.bot.send_document(
-            chat_id=chat_id, 
-            document=doc_io, 
-            filename=filename,
-            caption="✅ Ваша работа готова!"
-        )
-        await context.bot.send_message(
-            chat_id=chat_id, 
-            text="🎉 Ваш заказ выполнен! Спасибо за использование нашего сервиса!"
+    except Exception as gen_error:
+        logging.error(f"Ошибка при генерации: {gen_error}")
+    
+    # Если часть глав уже сохранена, один раз догенерируем только недостающие
+    if load_chapter_checkpoints(order_id):
+        try:
+            await asyncio.sleep(ORDER_RESUME_DELAY)
+            await resume_order(bot, order_id)
+            return
+        except DeliveryError as delivery_error:
+            logging.error(f"Заказ {order_id} не доставлен: {delivery_error}")
+            await mark_delivery_failed(order_id, chat_id)
+            return
+        except Exception as resume_error:
+            logging.error(f"Повторная попытка заказа {order_id} не удалась: {resume_error}")
+    
+    # Автоматический возврат средств
+    price = context.user_data.get("price")
+    if price is None and amount is not None:
+        try:
+            price = float(amount)
+        except ValueError:
+            price = None
+    amount_value = f"{float(price):.2f}" if price is not None else amount
+    
+    # Заказ помечается неудачным вместе с постановкой возврата в outbox;
+    # сам возврат выполняет outbox_worker, не задерживая генерацию
+    schedule_refund(order_id, payment_id, amount_value, chat_id)
+    try:
+        await bot.send_message(chat_id=chat_id, text="❌ Произошла ошибка при генерации. Оформляем возврат платежа.")
+    except Exception as e:
+        logging.error(f"Не удалось уведомить пользователя о возврате по заказу {order_id}: {e}")
+
+async def handle_payment_status(bot, payment) -> None:
+    """Применяет актуальный статус платежа YooKassa к заказу
+    
+    Вызывается и из уведомлений YooKassa, и из резервного опроса: переход
+    статуса заказа атомарный, поэтому заказ запускается ровно один раз.
+    """
+    order = find_order_by_payment(payment)
+    if order is None:
+        logging.warning(f"Заказ для платежа {payment.id} не найден")
+        return
+    
+    if payment.status == "succeeded":
+        # Платёж мог пройти уже после того, как заказ был признан брошенным;
+        # задание на генерацию сохраняется в одной транзакции со сменой статуса
+        job = order_job(order.id, "paid", "paid", {
+            "payment_id": payment.id,
+            "amount": payment.amount.value if getattr(payment, "amount", None) else None
+        })
+        if transition_order_status(order.id, ["payment_created", "expired"], "paid",
+                                   payment_id=payment.id, outbox=[job]):
+            logging.info(f"Заказ {order.id} оплачен, генерация поставлена в очередь")
+    elif payment.status in ("canceled", "failed"):
+        if not transition_order_status(order.id, ["payment_created"], "cancelled", outbox=[
+            notify_message(order.id, order.user_id, "❌ Платеж отменён или не прошёл. Заказ отменён.", "cancelled")
+        ]):
+            # Брошенный заказ: пользователь уже уведомлён, сверка платежа завершена
+            transition_order_status(order.id, ["expired"], "cancelled")
+
+# ===================== СВЕРКА ПЛАТЕЖЕЙ =====================
+# Один фоновый цикл сверяет с YooKassa все заказы в статусе payment_created
+# (основной путь — уведомления YooKassa). Время следующей проверки хранится
+# в заказе, поэтому после перезапуска бота сверка продолжается с того же места.
+# Брошенные заказы (expired) сверяются дальше, пока YooKassa не сообщит
+# окончательный статус платежа: поздняя оплата переводит заказ в paid и без
+# уведомлений, а отмена платежа — в cancelled.
+
+def payment_check_interval(age: float) -> float:
+    """Интервал до следующей проверки платежа в зависимости от возраста заказа (секунды)"""
+    base = PAYMENT_POLL_INTERVAL_WEBHOOK if YOOKASSA_WEBHOOK_ENABLED else PAYMENT_POLL_INTERVAL
+    if age < 10 * 60:
+        return base
+    if age < 60 * 60:
+        return max(base, 60)
+    return max(base, 5 * 60)
+
+async def check_pending_payment(bot, order_id: int, payment_id: str, user_id: str, age: float) -> None:
+    """Запрашивает статус одного платежа и применяет его к заказу"""
+    try:
+        payment = await payment_gateway.find_payment(payment_id)
+    except Exception as e:
+        logging.warning(f"Сверка платежа {payment_id} (заказ {order_id}) не удалась: {e}")
+        payment = None
+    payment_polls_total.inc(result=payment.status if payment is not None else "error")
+    
+    if payment is not None and payment.status in ("succeeded", "canceled", "failed"):
+        await handle_payment_status(bot, payment)
+        return
+    
+    if age >= PAYMENT_EXPIRE_AFTER:
+        # Если оплата всё же придёт, сверка (или уведомление) переведёт заказ в paid
+        if transition_order_status(order_id, ["payment_created"], "expired", outbox=[
+            notify_message(order_id, user_id, "⌛ Заказ не был оплачен и отменён. Оформить новый можно командой /order", "expired")
+        ]):
+            logging.info(f"Заказ {order_id} не оплачен за {PAYMENT_EXPIRE_AFTER // 60} мин, помечен как expired")
+
+async def reconcile_payments_once(bot) -> int:
+    """Один проход сверки: проверяет пачку заказов, у которых подошло время проверки
+    
+    Returns:
+        Количество проверенных заказов
+    """
+    now = datetime.now(timezone.utc)
+    session = SessionLocal()
+    try:
+        # NULL (ещё не проверялись) в SQLite сортируются первыми
+        due = session.query(Order).filter(
+            Order.status.in_(["payment_created", "expired"]),
+            Order.payment_id.isnot(None),
+            or_(Order.payment_next_check_at.is_(None), Order.payment_next_check_at <= now)
+        ).order_by(Order.payment_next_check_at).limit(PAYMENT_RECONCILE_BATCH).all()
+        
+        batch = []
+        for order in due:
+            age = (now - as_utc(order.created_at)).total_seconds()
+            # Время следующей проверки сохраняем до запроса, чтобы сбой не приводил к повторам в цикле
+            order.payment_checks = (order.payment_checks or 0) + 1
+            order.payment_next_check_at = now + timedelta(seconds=payment_check_interval(age))
+            batch.append((order.id, order.payment_id, order.user_id, age))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка выборки платежей для сверки: {e}")
+        raise
+    finally:
+        session.close()
+    
+    # Параллельность ограничена пулом потоков payment_gateway
+    await asyncio.gather(*(check_pending_payment(bot, *item) for item in batch))
+    return len(batch)
+
+async def payment_reconciler(bot) -> None:
+    """Фоновый цикл сверки платежей"""
+    logging.info("Сверка платежей запущена")
+    while True:
+        try:
+            checked = await reconcile_payments_once(bot)
+        except Exception as e:
+            logging.error(f"Ошибка сверки платежей: {e}")
+            checked = 0
+        # Полная пачка — вероятно, есть ещё заказы с подошедшим временем проверки
+        if checked < PAYMENT_RECONCILE_BATCH:
+            await asyncio.sleep(PAYMENT_RECONCILE_TICK)
+
+# ===================== OUTBOX =====================
+# Возвраты и уведомления сначала сохраняются в таблицу outbox (в одной
+# транзакции с изменением заказа), затем их выполняет фоновый обработчик
+# с повторами и экспоненциальной задержкой. Ключ идемпотентности не даёт
+# выполнить операцию дважды — ни при повторе, ни после перезапуска.
+
+def outbox_retry_delay(attempts: int) -> float:
+    return min(OUTBOX_MAX_RETRY_DELAY, OUTBOX_RETRY_DELAY * 2 ** max(attempts - 1, 0))
+
+async def process_outbox_message(bot, message_id: int, kind: str, order_id: int,
+                                 payload: dict, key: str, attempts: int) -> None:
+    """Выполняет одно сообщение outbox и сохраняет результат"""
+    follow_up = []
+    error = None
+    permanent = False
+    try:
+        if kind == "refund":
+            follow_up = await execute_refund(order_id, payload, key)
+        elif kind == "notify":
+            try:
+                await bot.send_message(chat_id=payload["chat_id"], text=payload["text"])
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или чат недоступен
+                raise PermanentOutboxError(str(e))
+        else:
+            raise PermanentOutboxError(f"Неизвестный тип сообщения: {kind}")
+    except PermanentOutboxError as e:
+        error, permanent = str(e), True
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    
+    now = datetime.now(timezone.utc)
+    session = SessionLocal()
+    try:
+        message = session.query(OutboxMessage).filter(OutboxMessage.id == message_id).first()
+        if error is None:
+            message.status = "done"
+            message.processed_at = now
+            message.last_error = None
+            if kind == "refund":
+                session.query(Order).filter(Order.id == order_id).update(
+                    {"status": "refunded"}, synchronize_session=False
+                )
+        elif permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+            message.status = "failed"
+            message.last_error = error
+            logging.error(f"Outbox #{message_id} ({kind}, заказ {order_id}) не выполнен: {error}")
+            if kind == "refund":
+                follow_up = [notify_message(
+                    order_id, payload["chat_id"],
+                    "⚠️ Ошибка при возврате средств. Пожалуйста, обратитесь в поддержку.", "refund_failed"
+                )]
+        else:
+            message.last_error = error
+            message.next_attempt_at = now + timedelta(seconds=outbox_retry_delay(attempts))
+            logging.warning(f"Outbox #{message_id} ({kind}, заказ {order_id}), попытка {attempts}: {error}")
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка сохранения результата outbox #{message_id}: {e}")
+        return
+    finally:
+        session.close()
+    
+    # Уведомления — отдельной транзакцией и без повторов: после /admin_refunds retry
+    # уведомление с тем же ключом уже есть, и его вставка не должна откатить статус
+    add_outbox_messages(follow_up)
+
+async def process_outbox_once(bot) -> int:
+    """Один проход обработчика outbox
+    
+    Returns:
+        Количество обработанных сообщений
+    """
+    now = datetime.now(timezone.utc)
+    session = SessionLocal()
+    try:
+        due = session.query(OutboxMessage).filter(
+            OutboxMessage.status == "pending",
+            or_(OutboxMessage.next_attempt_at.is_(None), OutboxMessage.next_attempt_at <= now)
+        ).order_by(OutboxMessage.id).limit(OUTBOX_BATCH).all()
+        
+        batch = []
+        for message in due:
+            # Попытка учитывается до выполнения: если бот упадёт посреди операции,
+            # она повторится после задержки с тем же ключом идемпотентности
+            message.attempts = (message.attempts or 0) + 1
+            message.next_attempt_at = now + timedelta(seconds=outbox_retry_delay(message.attempts))
+            batch.append((
+                message.id, message.kind, message.order_id,
+                json.loads(message.payload or "{}"), message.idempotence_key, message.attempts
+            ))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка выборки outbox: {e}")
+        raise
+    finally:
+        session.close()
+    
+    await asyncio.gather(*(process_outbox_message(bot, *item) for item in batch))
+    return len(batch)
+
+async def outbox_worker(bot) -> None:
+    """Фоновый обработчик outbox"""
+    logging.info("Обработчик outbox запущен")
+    while True:
+        try:
+            processed = await process_outbox_once(bot)
+        except Exception as e:
+            logging.error(f"Ошибка обработчика outbox: {e}")
+            processed = 0
+        if processed < OUTBOX_BATCH:
+            await asyncio.sleep(OUTBOX_TICK)
+
+# Повторное выполнение заказа по сохранённым чекпоинтам
+async def resume_order(bot, order_id: int) -> None:
+    """Выполняет заказ повторно: план и готовые главы берутся из чекпоинтов,
+    генерируются только недостающие главы"""
+    order = get_order(order_id)
+    if order is None:
+        raise ValueError(f"Заказ {order_id} не найден")
+    
+    context = build_order_context(bot, order, lane=order_lane(order, retry=True))
+    logging.info(f"Возобновление заказа {order_id}")
+    await execute_order(bot, order_id, context)
+    logging.info(f"Заказ {order_id} успешно возобновлён и доставлен")
+
+async def admin_resume(update: Update, context: CallbackContext) -> None:
+    """Возобновление неудачного заказа с сохранёнными главами"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    if not context.args:
+        session = SessionLocal()
+        try:
+            from sqlalchemy import func
+            failed = session.query(
+                Order.id, Order.status, Order.work_type, func.count(OrderChapter.id)
+            ).outerjoin(
+                OrderChapter, OrderChapter.order_id == Order.id
+            ).filter(
+                Order.status.in_(["failed", "refunded", "test_failed"])
+            ).group_by(Order.id).order_by(Order.id.desc()).limit(10).all()
+        finally:
+            session.close()
+        
+        text = "🔁 Использование: /admin_resume <order_id>\n\n"
+        if failed:
+            text += "Последние неудачные заказы:\n"
+            for order_id, status, work_type, chapters in failed:
+                text += f"• №{order_id} ({status}) {work_type} — готово глав: {chapters}\n"
+        else:
+            text += "Неудачных заказов нет."
+        await update.message.reply_text(text)
+        return
+    
+    try:
+        order_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("⚠️ ID заказа должен быть числом")
+        return
+    
+    order = get_order(order_id)
+    if order is None:
+        await update.message.reply_text("❌ Заказ не найден")
+        return
+    
+    done = len(load_chapter_checkpoints(order_id))
+    await update.message.reply_text(
+        f"🔁 Возобновляю заказ №{order_id} (статус: {order.status}, готово глав: {done})..."
+    )
+    enqueue_order_job(order_id, "resume", order_lane(order, retry=True), {"admin_chat_id": update.effective_chat.id})
+
+async def run_admin_resume(bot, order_id: int, admin_chat_id: int) -> None:
+    """Задание /admin_resume: возобновляет заказ и сообщает результат администратору"""
+    try:
+        await resume_order(bot, order_id)
+        await bot.send_message(chat_id=admin_chat_id, text=f"✅ Заказ №{order_id} выполнен и отправлен пользователю")
+    except DeliveryError as e:
+        logging.error(f"Заказ {order_id} возобновлён, но не доставлен: {e}")
+        await mark_delivery_failed(order_id, int(get_order(order_id).user_id))
+        await bot.send_message(
+            chat_id=admin_chat_id, text=f"⚠️ Заказ №{order_id} выполнен, но не доставлен: пользователь скачает его через /my_orders"
         )
-        
-        # Обновляем статус заказа как выполненный
-        await update_order_status(order_id, "completed")
-        logging.info(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Заказ {order_id} успешно завершён")
-        
     except Exception as e:
-        logging.error(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Ошибка при обработке заказа {order_id}: {e}")
-        
-        # Обновляем статус заказа как неудачный
+        logging.error(f"Ошибка возобновления заказа {order_id}: {e}")
         await update_order_status(order_id, "failed")
-        
-        await context.bot.send_message(
-            chat_id=chat_id, 
-            text="❌ Произошла ошибка при генерации работы.\n"
-                 "Попробуйте еще раз или обратитесь в поддержку."
+        await bot.send_message(chat_id=admin_chat_id, text=f"❌ Не удалось возобновить заказ №{order_id}: {e}")
+
+async def admin_refunds(update: Update, context: CallbackContext) -> None:
+    """Зависшие возвраты и их повторный запуск: /admin_refunds [retry <id>]"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    
+    session = SessionLocal()
+    try:
+        if len(context.args) == 2 and context.args[0] == "retry" and context.args[1].isdigit():
+            message_id = int(context.args[1])
+            updated = session.query(OutboxMessage).filter(
+                OutboxMessage.id == message_id,
+                OutboxMessage.kind == "refund",
+                OutboxMessage.status != "done"
+            ).update({
+                "status": "pending", "attempts": 0, "next_attempt_at": None
+            }, synchronize_session=False)
+            session.commit()
+            if updated:
+                await update.message.reply_text(f"🔁 Возврат #{message_id} поставлен на повтор")
+            else:
+                await update.message.reply_text("❌ Незавершённый возврат с таким ID не найден")
+            return
+        
+        refunds = session.query(OutboxMessage).filter(
+            OutboxMessage.kind == "refund",
+            OutboxMessage.status != "done"
+        ).order_by(OutboxMessage.id).limit(20).all()
+        
+        if not refunds:
+            await update.message.reply_text("✅ Незавершённых возвратов нет")
+            return
+        
+        text = "💸 Незавершённые возвраты:\n\n"
+        for refund in refunds:
+            payload = json.loads(refund.payload or "{}")
+            amount = payload.get("amount", {}).get("value", "?")
+            status = "❌ не выполнен" if refund.status == "failed" else "⏳ в очереди"
+            text += (
+                f"#{refund.id} | заказ №{refund.order_id} | {amount}₽ | {status}\n"
+                f"   попыток: {refund.attempts}, платёж: {payload.get('payment_id')}\n"
+            )
+            if refund.last_error:
+                text += f"   ошибка: {refund.last_error[:100]}\n"
+        text += "\nПовторить: /admin_refunds retry <id>"
+        await update.message.reply_text(text)
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка в admin_refunds: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {e}")
+    finally:
+        session.close()
+
+async def admin_config(update: Update, context: CallbackContext) -> None:
+    """Настройки без перезапуска: /admin_config [set <имя> <значение> | reset <имя>]"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Доступ запрещен")
+        return
+    if not await enforce_rate_limit(update, "admin"):
+        return
+
+    args = context.args
+    if not args:
+        text = "⚙️ Настройки (✏️ — изменено через /admin_config):\n\n"
+        for name, value, description, changed in settings.describe():
+            text += f"{'✏️ ' if changed else ''}{name} = {value}\n   {description}\n"
+            if changed:
+                updated_by, updated_at = changed
+                text += f"   изменил {updated_by or '?'} {as_utc(updated_at):%d.%m %H:%M} UTC\n"
+        text += (
+            "\nИзменить: /admin_config set <имя> <значение>\n"
+            "Вернуть значение по умолчанию: /admin_config reset <имя>\n"
+            "Бот и воркеры применяют изменения в течение нескольких секунд."
         )
+        await update.message.reply_text(text)
+        return
 
-# Функция для автоматического мониторинга статуса платежа и начала выполнения заказа
-async def monitor_payment(context: CallbackContext, chat_id: int, payment_id: str) -> None:
+    action, name = args[0].lower(), args[1].upper() if len(args) > 1 else None
+    if action not in ("set", "reset") or name is None or (action == "set" and len(args) < 3):
+        await update.message.reply_text(
+            "⚙️ Использование: /admin_config [set <имя> <значение> | reset <имя>]"
+        )
+        return
+
+    before = format_value(settings.get(name)) if name in settings.schema else None
     try:
-        order_id = context.user_data.get("order_id")
-        
-        while True:
-            payment = Payment.find_one(payment_id)
-            status = payment.status
-            
-            if status == "succeeded":
-                # Обновляем статус заказа
-                if order_id:
-                    await update_order_status(order_id, "paid", payment_id)
-                
-                # Попытка генерации и возврат при ошибке
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text="✅ Оплата успешно проведена! Начинаем выполнение вашего заказа.")
-                    await context.bot.send_message(chat_id=chat_id, text="🔄 Генерация вашей работы... Пожалуйста, подождите!")
-                    
-                    plan_array = await generate_plan(context)
-                    if not plan_array:
-                        raise RuntimeError("План не сгенерирован")
-                    context.user_data["plan_array"] = plan_array
-                    
-                    doc_io = await generate_text(plan_array, context)
-                    if doc_io is None:
-                        raise RuntimeError("Документ не создан")
-                    
-                    # Создаем безопасное имя файла
-                    work_type = context.user_data.get("work_type", "Работа")
-                    work_theme = context.user_data.get("work_theme", "Тема")
-                    safe_type = sanitize_filename(work_type)
-                    safe_theme = sanitize_filename(work_theme)
-                    filename = f"{safe_type}_{safe_theme}.docx"
-                    
-                    await context.bot.send_document(
-                        chat_id=chat_id, 
-                        document=doc_io, 
-                        filename=filename,
-                        caption="✅ Ваша работа готова! Спасибо за использование NinjaEssayAI!"
-                    )
-                    await context.bot.send_message(chat_id=chat_id, text="🎉 Ваш заказ выполнен! Спасибо за использование нашего сервиса!")
-                    
-                    # Обновляем статус заказа как выполненный
-                    if order_id:
-                        await update_order_status(order_id, "completed")
-                    
-                    return
-                    
-                except Exception as gen_error:
-                    logging.error(f"Ошибка при генерации: {gen_error}")
-                    
-                    # Обновляем статус заказа как неудачный
-                    if order_id:
-                        await update_order_status(order_id, "failed")
-                    
-                    # Автоматический возврат средств
-                    price = context.user_data.get("price")
-                    if price is None and hasattr(payment, 'amount'):
-                        try:
-                            price = float(payment.amount.value)
-                        except Exception:
-                            price = None
-                    amount_value = f"{float(price):.2f}" if price is not None else payment.amount.value
-                    
-                    try:
-                        Refund.create({
-                            "payment_id": payment_id,
-                            "amount": {"value": amount_value, "currency": "RUB"}
-                        }, uuid.uuid4())
-                        
-                        # Обновляем статус заказа как возвращенный
-                        if order_id:
-                            await update_order_status(order_id, "refunded")
-                        
-                        await context.bot.send_message(chat_id=chat_id, text="❌ Произошла ошибка при генерации. Платеж возвращён.")
-                    except Exception as refund_error:
-                        logging.error(f"Ошибка при возврате платежа: {refund_error}")
-                        await context.bot.send_message(chat_id=chat_id, text="⚠️ Ошибка при возврате средств. Пожалуйста, обратитесь в поддержку.")
-                    return
-                    
-            if status in ("canceled", "failed"):
-                if order_id:
-                    await update_order_status(order_id, "cancelled")
-                await context.bot.send_message(chat_id=chat_id, text="❌ Платеж отменён или не прошёл. Заказ отменён.")
-                return
-                
-            await asyncio.sleep(5)
-            
+        if action == "set":
+            settings.set(name, " ".join(args[2:]), updated_by=str(update.effective_user.id))
+        else:
+            settings.reset(name)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {name}: {e}")
+        return
     except Exception as e:
-        logging.error(f"Ошибка при мониторинге платежа: {e}")
-        await context.bot.send_message(chat_id=chat_id, text="❌ Произошла ошибка при проверке статуса платежа.")
+        logging.error(f"Ошибка изменения настройки {name}: {e}")
+        await update.message.reply_text(f"❌ Ошибка: {e}")
         return
 
+    logging.info(f"Администратор {update.effective_user.id}: {name} {before} → {format_value(settings.get(name))}")
+    await update.message.reply_text(f"✅ {name}: {before} → {format_value(settings.get(name))}")
+
+async def run_test_order(bot, order_id: int,
+                         completed_status: str = "test_completed", failed_status: str = "test_failed") -> None:
+    """Генерирует и доставляет тестовый заказ"""
+    context = build_order_context(bot, get_order(order_id), lane="test")
+    chat_id = context._chat_id
+    try:
+        await execute_order(
+            bot, order_id, context,
+            caption="✅ Ваша работа готова! (Тестовый режим)\n🎉 Спасибо за использование NinjaEssayAI!",
+            completed_status=completed_status
+        )
+        logging.info(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Заказ {order_id} успешно завершён")
+        
+    except DeliveryError as e:
+        logging.error(f"🧪 ТЕСТОВЫЙ РЕЖИМ: Заказ {order_id} создан, но не доставлен: {e}")
+        await mark_delivery_failed(order_id, chat_id)
+        
+    except Exception as gen_error:
+        logging.error(f"Ошибка при генерации в тестовом режиме: {gen_error}")
+        await update_order_status(order_id, failed_status)
+        await bot.send_message(
+            chat_id=chat_id,
+            text="❌ Произошла ошибка при генерации работы.\n"
+                 "Попробуйте еще раз или обратитесь в поддержку."
+        )
+
 # Функция для обработки тестового заказа (без реальной оплаты)
 async def create_test_order(update: Update, context: CallbackContext) -> int:
     """Создает тестовый заказ без реальной оплаты"""
@@ -2165,48 +2239,13 @@ async def create_test_order(update: Update, context: CallbackContext) -> int:
             "science_name": context.user_data.get("science_name", ""),
             "work_theme": context.user_data.get("work_theme", ""),
             "page_number": context.user_data.get("page_number", 0),
-            "price": 0  # Бесплатно в тестовом режиме
+            "price": 0,  # Бесплатно в тестовом режиме
+            "params": order_params_from_user_data(context.user_data)
         }
         order_id = await create_order(user_id, order_data)
-        await update_order_status(order_id, "test_paid")  # Отмечаем как тестовый заказ
-        
-        # Сразу начинаем генерацию (без ожидания платежа)
-        try:
-            # Генерация плана
-            plan_array = await generate_plan(context)
-            if not plan_array:
-                raise RuntimeError("План не сгенерирован")
-            context.user_data["plan_array"] = plan_array
-            
-            # Генерация документа
-            doc_io = await generate_text(plan_array, context)
-            if doc_io is None:
-                raise RuntimeError("Документ не создан")
-            
-            # Создаем безопасное имя файла
-            work_type = context.user_data.get("work_type", "Работа")
-            work_theme = context.user_data.get("work_theme", "Тема")
-            safe_type = sanitize_filename(work_type)
-            safe_theme = sanitize_filename(work_theme)
-            filename = f"{safe_type}_{safe_theme}.docx"
-            
-            # Отправляем готовый документ
-            await update.callback_query.message.reply_document(
-                document=doc_io, 
-                filename=filename,
-                caption="✅ Ваша работа готова! (Тестовый режим)\n🎉 Спасибо за использование NinjaEssayAI!"
-            )
-            
-            # Обновляем статус заказа как выполненный
-            await update_order_status(order_id, "test_completed")
-            
-        except Exception as gen_error:
-            logging.error(f"Ошибка при генерации в тестовом режиме: {gen_error}")
-            await update_order_status(order_id, "test_failed")
-            await update.callback_query.message.reply_text(
-                "❌ Произошла ошибка при генерации работы.\n"
-                "Попробуйте еще раз или обратитесь в поддержку."
-            )
+        context.user_data["order_id"] = order_id
+        # Тестовый заказ и задание на генерацию в тестовой полосе (не занимает слоты оплаченных заказов)
+        transition_order_status(order_id, ["created"], "test_paid", outbox=[order_job(order_id, "test", "test")])
         
         return ConversationHandler.END
         
@@ -2221,826 +2260,234 @@ async def create_test_order(update: Update, context: CallbackContext) -> int:
             pass
         return ConversationHandler.END
 
-
-
-# Обработка оплаты и генерация документа
-# Упрощение интерактивного элемента загрузки
-async def send_loading_message(update: Update, context: CallbackContext) -> None:
-    await update.message.reply_text("🔄 Генерация вашей работы... Пожалуйста, подождите!")
-
-# Вызов упрощенного элемента загрузки перед генерацией плана и текста
-async def pay(update: Update, context: CallbackContext) -> int:
-    logging.info("Начало выполнения заказа после оплаты.")
-    await update.message.reply_text("Оплата успешно проведена! Начинаем выполнение вашего заказа.")
-
-    # Упрощенный элемент загрузки
-    await send_loading_message(update, context)
-
-    # Генерация плана
-    logging.info("Генерация плана работы.")
-    plan_array = await generate_plan(context)
-    context.user_data["plan_array"] = plan_array
-    logging.info(f"План работы сгенерирован: {plan_array}")
-
-    # Генерация текста и создание документа в памяти
-    logging.info("Генерация текста по главам плана.")
-    doc_io = await generate_text(plan_array, context)
+async def cancel(update: Update, context: CallbackContext) -> int:
+    """Обработчик отмены заказа"""
+    user_id = update.effective_user.id
+    await log_user_action(user_id, "cancel_order")
     
-    if doc_io is None:
-        await update.message.reply_text("❌ Произошла ошибка при создании документа.")
-        return ConversationHandler.END
+    keyboard = [["/order"], ["/help", "/menu"]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    logging.info("Документ создан в памяти")
-
-    # Создаем безопасное имя файла для отправки
-    work_type = context.user_data.get("work_type", "Работа")
-    work_theme = context.user_data.get("work_theme", "Тема")
-    safe_type = sanitize_filename(work_type)
-    safe_theme = sanitize_filename(work_theme)
-    filename = f"{safe_type}_{safe_theme}.docx"
-
-    # Отправка документа пользователю напрямую из памяти
-    await update.message.reply_document(
-        document=doc_io,
-        filename=filename,
-        caption="✅ Ваша работа готова! Спасибо за использование NinjaEssayAI!"
+    await update.message.reply_text(
+        "❌ Заказ отменён.\n\n"
+        "Вы можете начать новый заказ с помощью команды /order",
+        reply_markup=reply_markup
     )
-
-    await update.message.reply_text("🎉 Заказ выполнен успешно! Спасибо за использование нашего сервиса!")
-    logging.info("Заказ успешно выполнен и отправлен пользователю.")
     return ConversationHandler.END
 
-# Enhanced error handling in the generate_plan function.
-async def generate_plan(context: CallbackContext) -> list:
-    # Проверяем, есть ли пользовательский план
-    use_custom_plan = context.user_data.get("use_custom_plan", False)
-    page_number = context.user_data.get("page_number", 0)
-    
-    if use_custom_plan:
-        custom_plan = context.user_data.get("custom_plan", [])
-        if custom_plan:
-            # Проверяем соответствие количества пунктов плана заявленному количеству страниц
-            expected_chapters = max(1, page_number // 2)  # Минимум 1 пункт
-            plan_chapters = len(custom_plan)
-            
-            logging.info(f"Пользовательский план: {custom_plan}")
-            logging.info(f"Заявлено страниц: {page_number}, пунктов в плане: {plan_chapters}, ожидалось: {expected_chapters}")
-            
-            # Если пунктов слишком мало для заявленного количества страниц, предупреждаем
-            if plan_chapters < expected_chapters:
-                try:
-                    chat_id = get_chat_id(context)
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"⚠️ Внимание: Для {page_number} страниц рекомендуется {expected_chapters} пунктов плана, "
-                             f"а у вас {plan_chapters}. Это может повлиять на объем работы."
-                    )
-                except Exception as chat_error:
-                    logging.error(f"Ошибка отправки предупреждения: {chat_error}")
-            
-            return custom_plan
-    
-    # Если пользовательского плана нет, генерируем автоматически
-    logging.info("Запрос на генерация плана отправлен в DeepSeek API.")
-    
-    science_name = context.user_data.get("science_name", "")
-    work_type = context.user_data.get("work_type", "")
-    work_theme = context.user_data.get("work_theme", "")
-    preferences = context.user_data.get("preferences", "")
-    page_number = context.user_data.get("page_number", 0)
-
-    if not science_name or not work_type or not work_theme or not page_number:
-        logging.error("Недостаточно данных для генерации плана.")
-        try:
-            chat_id = get_chat_id(context)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Ошибка: Недостаточно данных для генерации плана. Проверьте введенные данные."
+# Статусы, в которых задание ещё можно выполнять: после аренды, истёкшей у упавшего
+# потребителя, заказ может быть уже доставлен, отмечен неудачным или возвращён
+JOB_RUNNABLE_STATUSES = {"paid": ("paid",), "test_mode": ("paid",), "test": ("test_paid",)}
+# /admin_resume: кроме незавершённых, возобновляются неудачные заказы с сохранёнными главами
+RESUMABLE_STATUSES = ("failed", "refunded", "test_failed")
+
+def order_job_runnable(order, kind: str) -> bool:
+    """Можно ли выполнять задание для заказа в его текущем статусе"""
+    if kind == "resume":
+        if order.status in ("paid", "test_paid"):
+            return True
+        return order.status in RESUMABLE_STATUSES and bool(load_chapter_checkpoints(order.id))
+    return order.status in JOB_RUNNABLE_STATUSES.get(kind, ())
+
+async def run_order_job(bot, job: dict) -> None:
+    """Выполняет задание из order_jobs — в процессе бота или в воркере (worker.py)
+    
+    Задание, заказ которого уже не в рабочем статусе, завершается без выполнения,
+    чтобы повторный захват не сгенерировал и не доставил заказ ещё раз.
+    """
+    order_id = job["order_id"]
+    payload = job["payload"]
+    order = get_order(order_id)
+    if order is None or not order_job_runnable(order, job["kind"]):
+        status = order.status if order is not None else "не найден"
+        logging.warning(f"Задание {job['id']} ({job['kind']}) пропущено: заказ {order_id} в статусе {status}")
+        if job["kind"] == "resume":
+            await bot.send_message(
+                chat_id=payload["admin_chat_id"], text=f"⚠️ Заказ №{order_id} не возобновлён: статус {status}"
             )
-        except Exception as chat_error:
-            logging.error(f"Ошибка отправки сообщения: {chat_error}")
-        return []
-
-    # Минимум 3 пункта (Введение + 1 глава + Заключение)
-    # Расчет: страницы / 2, но не менее 3
-    calls_number = max(3, page_number // 2)
-
-    prompt = (
-        f"Действуй как специалист в области {science_name}. "
-        f"Составь подробный план из {calls_number} пунктов для {work_type} "
-        f"по теме: {work_theme}. Учти предпочтения: {preferences}. "
-        "ОБЯЗАТЕЛЬНО включи в план:\n"
-        "1. 'Введение' (первый пункт)\n"
-        f"2-{calls_number-1}. Основные разделы (содержательные названия глав)\n"
-        f"{calls_number}. 'Заключение' (последний пункт)\n\n"
-        "Верни ТОЛЬКО нумерованный список без дополнительных комментариев:\n"
-        "1. Введение\n"
-        "2. [Название раздела 1]\n"
-        "3. [Название раздела 2]\n"
-        f"{calls_number}. Заключение"
-    )
+        return
+    if job["kind"] == "paid":
+        await run_paid_order(bot, order_id, payload["payment_id"], payload.get("amount"))
+    elif job["kind"] == "test_mode":
+        await process_order(bot, order_id)
+    elif job["kind"] == "test":
+        await run_test_order(bot, order_id)
+    elif job["kind"] == "resume":
+        await run_admin_resume(bot, order_id, payload["admin_chat_id"])
+    else:
+        raise ValueError(f"Неизвестный тип задания: {job['kind']}")
 
-    try:
-        response = await client.chat.completions.create(
-            model="deepseek-reasoner",
-            messages=[
-                {"role": "system", "content": "mode: plan_generation"},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False
-        )
-        response_content = response.choices[0].message.content
-    except Exception as e:
-        logging.error(f"Ошибка при вызове DeepSeek API: {e}")
+async def conversation_expirer(application) -> None:
+    """Фоновый цикл: удаляет брошенные диалоги и данные неактивных пользователей"""
+    while True:
         try:
-            chat_id = get_chat_id(context)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Произошла ошибка при генерации плана. Пожалуйста, попробуйте позже."
-            )
-        except Exception as chat_error:
-            logging.error(f"Ошибка отправки сообщения: {chat_error}")
-        return []
-
-    logging.info("Ответ от DeepSeek API получен.")
-
-    try:
-        plan_array = json.loads(response_content)
-        if not isinstance(plan_array, list):
-            raise ValueError("Ответ не является массивом.")
-    except (json.JSONDecodeError, ValueError):
-        logging.info("Ответ не в формате JSON, обрабатываем как текст.")
-        lines = response_content.splitlines()
-        plan_array = [line.strip() for line in lines if line.strip()]
-        # Удаляем нумерацию и очищаем
-        plan_array = [re.sub(r'^\d+\.\s*', '', item).strip() for item in plan_array if item.strip()]
-        # Фильтруем пустые строки и мусор
-        plan_array = [item for item in plan_array if item and len(item) > 2]
-
-    # Проверяем и дополняем план
-    if len(plan_array) < calls_number:
-        # Если план слишком короткий, дополняем
-        needed = calls_number - len(plan_array)
-        for i in range(needed):
-            plan_array.insert(len(plan_array), f"Раздел {len(plan_array)}")
-    elif len(plan_array) > calls_number:
-        # Если план слишком длинный, обрезаем
-        plan_array = plan_array[:calls_number]
-    
-    # Удаляем эмодзи из всех элементов плана
-    plan_array = [remove_emojis(item) for item in plan_array]
-    
-    # Гарантируем наличие Введения и Заключения
-    if plan_array and not any(keyword in plan_array[0].lower() for keyword in ['введение', 'introduction']):
-        plan_array[0] = 'Введение'
-    
-    if plan_array and not any(keyword in plan_array[-1].lower() for keyword in ['заключение', 'conclusion', 'выводы']):
-        plan_array[-1] = 'Заключение'
-    
-    # Если план пустой или слишком короткий, создаем минимальный план
-    if not plan_array or len(plan_array) < 3:
-        logging.warning("План от DeepSeek некорректен, создаем базовый план")
-        plan_array = ['Введение']
-        for i in range(calls_number - 2):
-            plan_array.append(f'Глава {i+1}')
-        plan_array.append('Заключение')
-
-    logging.info(f"Итоговый план: {plan_array}")
-    return plan_array
-
-# Функция для добавления нумерации страниц
-def add_page_number(section, start_number=1):
-    """Добавляет нумерацию страниц в раздел документа
-    
-    Args:
-        section: Раздел документа
-        start_number: Начальный номер страницы (по умолчанию 1)
-    """
-    footer = section.footer
-    footer_paragraph = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
-    footer_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    run = footer_paragraph.add_run()
-    
-    # Устанавливаем начальный номер страницы для раздела
-    if start_number > 1:
-        sectPr = section._sectPr
-        pgNumType = sectPr.find(qn('w:pgNumType'))
-        if pgNumType is None:
-            pgNumType = OxmlElement('w:pgNumType')
-            sectPr.insert(0, pgNumType)
-        pgNumType.set(qn('w:start'), str(start_number))
-    
-    fldChar1 = OxmlElement('w:fldChar')
-    fldChar1.set(qn('w:fldCharType'), 'begin')
-    run._r.append(fldChar1)
-    instrText = OxmlElement('w:instrText')
-    instrText.text = 'PAGE'
-    run._r.append(instrText)
-    fldChar2 = OxmlElement('w:fldChar')
-    fldChar2.set(qn('w:fldCharType'), 'end')
-    run._r.append(fldChar2)
-
-# Функция для добавления титульного листа
-def add_title_page(doc, work_type, work_theme, science_name, page_number):
-    """Добавляет титульный лист в документ"""
-    
-    # Очищаем тему от смайликов
-    import re
-    emoji_pattern = re.compile(
-        "["
-        u"\U0001F600-\U0001F64F"
-        u"\U0001F300-\U0001F5FF"
-        u"\U0001F680-\U0001F6FF"
-        u"\U0001F1E0-\U0001F1FF"
-        u"\U00002702-\U000027B0"
-        u"\U000024C2-\U0001F251"
-        u"\U0001F900-\U0001F9FF"
-        u"\U0001FA70-\U0001FAFF"
-        "]+", flags=re.UNICODE
-    )
-    work_theme = emoji_pattern.sub('', work_theme).strip()
-    
-    # Название учебного заведения
-    university_p = doc.add_paragraph()
-    university_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    university_run = university_p.add_run("МИНИСТЕРСТВО ОБРАЗОВАНИЯ И НАУКИ РОССИЙСКОЙ ФЕДЕРАЦИИ\n")
-    university_run.font.name = 'Times New Roman'
-    university_run.font.size = Pt(14)
-    university_run.font.bold = True
-    
-    university_run2 = university_p.add_run("ФЕДЕРАЛЬНОЕ ГОСУДАРСТВЕННОЕ БЮДЖЕТНОЕ ОБРАЗОВАТЕЛЬНОЕ УЧРЕЖДЕНИЕ\n")
-    university_run2.font.name = 'Times New Roman'
-    university_run2.font.size = Pt(14)
-    university_run2.font.bold = True
-    
-    university_run3 = university_p.add_run("ВЫСШЕГО ОБРАЗОВАНИЯ\n")
-    university_run3.font.name = 'Times New Roman'
-    university_run3.font.size = Pt(14)
-    university_run3.font.bold = True
-    
-    university_run4 = university_p.add_run("«РОССИЙСКИЙ УНИВЕРСИТЕТ»")
-    university_run4.font.name = 'Times New Roman'
-    university_run4.font.size = Pt(14)
-    university_run4.font.bold = True
-    
-    # Добавляем отступ
-    doc.add_paragraph()
-    doc.add_paragraph()
-    doc.add_paragraph()
-    
-    # Кафедра
-    department_p = doc.add_paragraph()
-    department_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    department_run = department_p.add_run(f"Кафедра {science_name}")
-    department_run.font.name = 'Times New Roman'
-    department_run.font.size = Pt(14)
-    
-    # Добавляем отступ
-    doc.add_paragraph()
-    doc.add_paragraph()
-    
-    # Тип работы
-    work_type_p = doc.add_paragraph()
-    work_type_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    work_type_run = work_type_p.add_run(work_type.upper())
-    work_type_run.font.name = 'Times New Roman'
-    work_type_run.font.size = Pt(16)
-    work_type_run.font.bold = True
-    
-    # Добавляем отступ
-    doc.add_paragraph()
-    
-    # Тема работы
-    theme_p = doc.add_paragraph()
-    theme_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    theme_run = theme_p.add_run(f"на тему: «{work_theme}»")
-    theme_run.font.name = 'Times New Roman'
-    theme_run.font.size = Pt(14)
-    theme_run.font.bold = True
-    
-    # Добавляем отступ
-    doc.add_paragraph()
-    doc.add_paragraph()
-    doc.add_paragraph()
-    doc.add_paragraph()
-    
-    # Информация о студенте и преподавателе (справа)
-    info_table = doc.add_table(rows=6, cols=2)
-    info_table.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    
-    # Настраиваем таблицу
-    for row in info_table.rows:
-        for cell in row.cells:
-            for paragraph in cell.paragraphs:
-                paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-    
-    # Заполняем таблицу
-    info_table.cell(0, 0).text = "Дисциплина:"
-    info_table.cell(0, 1).text = science_name
-    
-    info_table.cell(1, 0).text = "Выполнил(а):"
-    info_table.cell(1, 1).text = "студент(ка) группы ___________"
-    
-    info_table.cell(2, 0).text = ""
-    info_table.cell(2, 1).text = "_________________________"
-    
-    info_table.cell(3, 0).text = "Проверил:"
-    info_table.cell(3, 1).text = "_________________________"
-    
-    info_table.cell(4, 0).text = ""
-    info_table.cell(4, 1).text = "(должность, ученая степень, звание)"
-    
-    info_table.cell(5, 0).text = ""
-    info_table.cell(5, 1).text = "_________________________"
-    
-    # Настраиваем шрифт в таблице
-    for row in info_table.rows:
-        for cell in row.cells:
-            for paragraph in cell.paragraphs:
-                for run in paragraph.runs:
-                    run.font.name = 'Times New Roman'
-                    run.font.size = Pt(12)
-    
-    # Добавляем отступ
-    doc.add_paragraph()
-    doc.add_paragraph()
-    doc.add_paragraph()
-    
-    # Год и город
-    footer_p = doc.add_paragraph()
-    footer_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    footer_run = footer_p.add_run("Москва 2025")
-    footer_run.font.name = 'Times New Roman'
-    footer_run.font.size = Pt(14)
-
-
-def parse_preferences_by_chapter(preferences: str, plan_array: list) -> dict:
-    """
-    Парсит пожелания пользователя и распределяет их по главам
-    
-    Работает в несколько этапов:
-    1. Парсинг по явным ключевым словам (введение, заключение, основная часть)
-    2. Интеллектуальное распределение по контентным ключевым словам (цель, задачи, методология и т.д.)
-    3. Сопоставление с фактическими названиями глав из плана
-    
-    Args:
-        preferences: Текст пожеланий пользователя
-        plan_array: Массив глав плана (может быть автоматическим или пользовательским)
-    
-    Returns:
-        Словарь: {
-            'global': 'общие пожелания для всех глав',
-            'by_chapter': {
-                'Введение': 'специфичные пожелания для введения',
-                'Глава 1': 'специфичные пожелания для главы 1',
-                ...
-            }
-        }
-    """
-    result = {
-        'global': '',
-        'by_chapter': {}
-    }
-    
-    if not preferences or preferences == "Без особых предпочтений":
-        return result
+            persistence.expire(application)
+        except Exception as e:
+            logging.error(f"Ошибка очистки диалогов: {e}")
+        await asyncio.sleep(CONVERSATION_EXPIRE_TICK)
+
+web_server = None
+worker_tasks = []
+
+async def on_startup(application) -> None:
+    """Запускает сверку платежей, обработчик outbox и встроенный HTTP-сервер (уведомления YooKassa, метрики)"""
+    global web_server
+    worker_tasks.append(spawn_background(payment_reconciler(application.bot)))
+    worker_tasks.append(spawn_background(outbox_worker(application.bot)))
+    worker_tasks.append(spawn_background(watch_settings()))
+    if not ORDER_WORKERS_EXTERNAL:
+        worker_tasks.append(spawn_background(consume_order_jobs(
+            lambda job: run_order_job(application.bot, job), consumer_id("bot"), order_scheduler
+        )))
+    if persistence is not None:
+        worker_tasks.append(spawn_background(conversation_expirer(application)))
     
-    # === ЭТАП 1: Базовые ключевые слова для типовых разделов ===
-    base_chapter_keywords = {
-        'введение': ['введение', 'введении', 'во введение', 'для введения', 'во введении'],
-        'заключение': ['заключение', 'заключении', 'в заключение', 'для заключения', 'в заключении'],
-        'основная часть': ['основная часть', 'основной части', 'в основной части', 'основную часть'],
-    }
+    try:
+        import psutil
+        # Первый замер задаёт точку отсчёта для неблокирующего cpu_percent в админ-командах
+        psutil.cpu_percent(interval=None)
+    except ImportError:
+        pass
     
-    # === ЭТАП 2: Контентные ключевые слова (по смыслу содержания) ===
-    content_keywords = {
-        'введение': [
-            'цель', 'задачи', 'задач', 'актуальность', 'актуальности', 
-            'проблема', 'проблемы', 'постановка задачи',
-            'объект исследования', 'предмет исследования', 'гипотеза', 'гипотезу'
-        ],
-        'основная часть': [
-            'методология', 'методологию', 'анализ', 'исследование', 'практика', 
-            'теория', 'теоретическая часть', 'обзор литературы', 
-            'эксперимент', 'данные', 'данных', 'результаты', 'результатов'
-        ],
-        'заключение': [
-            'выводы', 'вывод', 'итоги', 'итог', 'резюме', 'достижения', 
-            'перспективы', 'перспектив', 'рекомендации', 'рекомендаций',
-            'заключительные положения'
-        ]
-    }
+    if not YOOKASSA_WEBHOOK_ENABLED and not METRICS_ENABLED and not TELEGRAM_WEBHOOK_ENABLED:
+        return
     
-    # === ЭТАП 3: Создание словаря ключевых слов для каждой главы плана ===
-    all_chapter_keywords = {}
-    for chapter in plan_array:
-        chapter_lower = chapter.lower()
-        all_chapter_keywords[chapter_lower] = [chapter_lower]
-        
-        # Добавляем базовые ключевые слова
-        for base_chapter, keywords in base_chapter_keywords.items():
-            if base_chapter in chapter_lower:
-                all_chapter_keywords[chapter_lower].extend(keywords)
-                # Добавляем контентные ключевые слова
-                if base_chapter in content_keywords:
-                    all_chapter_keywords[chapter_lower].extend(content_keywords[base_chapter])
-    
-    # === ЭТАП 4: Разбиваем пожелания на предложения ===
-    sentences = re.split(r'[.;!?]', preferences)
-    
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence or len(sentence) < 5:
-            continue
-        
-        sentence_lower = sentence.lower()
-        matched = False
-        
-        # === ЭТАП 5: Поиск соответствий по ключевым словам ===
-        for chapter in plan_array:
-            chapter_lower = chapter.lower()
-            keywords = all_chapter_keywords.get(chapter_lower, [])
-            
-            # Проверяем наличие любого ключевого слова в предложении
-            for keyword in keywords:
-                if keyword in sentence_lower:
-                    if chapter not in result['by_chapter']:
-                        result['by_chapter'][chapter] = []
-                    
-                    # Убираем упоминание главы из текста пожелания
-                    cleaned = re.sub(
-                        f'({"|".join(re.escape(k) for k in keywords)})',
-                        '',
-                        sentence,
-                        flags=re.IGNORECASE
-                    ).strip()
-                    
-                    # Очищаем от лишних предлогов в начале
-                    cleaned = re.sub(r'^(в|для|по|о|про)\s+', '', cleaned, flags=re.IGNORECASE).strip()
-                    
-                    if cleaned and len(cleaned) > 5:
-                        result['by_chapter'][chapter].append(cleaned)
-                    matched = True
-                    break
-            
-            if matched:
-                break
-        
-        # Если не нашли соответствий - это общее пожелание для всей работы
-        if not matched:
-            if result['global']:
-                result['global'] += '. ' + sentence
+    from webhooks import WebServer, yookassa_webhook_handler, telegram_webhook_handler
+    web_server = WebServer(WEB_SERVER_HOST, WEB_SERVER_PORT)
+    
+    if TELEGRAM_WEBHOOK_ENABLED:
+        web_server.add_route("POST", TELEGRAM_WEBHOOK_PATH, telegram_webhook_handler(
+            lambda data: enqueue_update(application, data), TELEGRAM_WEBHOOK_SECRET
+        ))
+    
+    if YOOKASSA_WEBHOOK_ENABLED:
+        bot = application.bot
+        
+        async def on_yookassa_notification(event: str, object_id: str) -> None:
+            if event.startswith("payment."):
+                # Содержимому уведомления не доверяем: статус запрашиваем у YooKassa
+                payment = await payment_gateway.find_payment(object_id)
+                await handle_payment_status(bot, payment)
+            elif event.startswith("refund."):
+                # object_id — id возврата; заказ переводит в refunded outbox_worker по ответу на запрос возврата
+                logging.info(f"Возврат {object_id}: {event}")
             else:
-                result['global'] = sentence
-    
-    # === ЭТАП 6: Объединяем списки пожеланий для каждой главы в строку ===
-    for chapter in result['by_chapter']:
-        if isinstance(result['by_chapter'][chapter], list):
-            result['by_chapter'][chapter] = '. '.join(result['by_chapter'][chapter])
+                # Неизвестные события подтверждаются, иначе YooKassa повторяет их бесконечно
+                logging.warning(f"Неизвестное уведомление YooKassa: {event} ({object_id})")
+        
+        web_server.add_route("POST", YOOKASSA_WEBHOOK_PATH, yookassa_webhook_handler(
+            on_yookassa_notification, trust_forwarded=TRUST_FORWARDED_FOR
+        ))
     
-    # === ЛОГИРОВАНИЕ ДЛЯ ОТЛАДКИ ===
-    logging.info(f"📋 Умное распределение пожеланий по главам:")
-    logging.info(f"   Общие пожелания: {result['global']}")
-    for chapter, prefs in result['by_chapter'].items():
-        logging.info(f"   {chapter}: {prefs}")
+    if METRICS_ENABLED:
+        web_server.add_route("GET", METRICS_PATH, metrics_handler(metrics, token=METRICS_TOKEN or None))
     
-    return result
-
+    await web_server.start()
 
-# Генерация текста и создание документа (в памяти)
-async def generate_text(plan_array, context: CallbackContext) -> io.BytesIO:
-    logging.info("Начало генерации текста по главам плана.")
-    science_name = context.user_data["science_name"]
-    work_type = context.user_data["work_type"]
-    work_theme = context.user_data["work_theme"]
-    preferences = context.user_data["preferences"]
-    page_number = context.user_data.get("page_number", 0)
+def updates_in_progress(application) -> int:
+    """Обновления, уже взятые из очереди, но ещё не обработанные"""
+    processor = application.update_processor
+    if isinstance(processor, ChatOrderedUpdateProcessor):
+        return processor.in_progress()
+    return 0
 
-    if not plan_array:
-        logging.error("План пуст. Невозможно сгенерировать текст.")
-        try:
-            chat_id = get_chat_id(context)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Ошибка: План пуст. Убедитесь, что DeepSeek вернул корректный массив."
-            )
-        except Exception as chat_error:
-            logging.error(f"Ошибка отправки сообщения: {chat_error}")
-        return None
-
-    # Рассчитываем количество слов на главу на основе заявленного количества страниц
-    # Примерно 250-300 слов на страницу, распределяем равномерно между главами
-    total_words = page_number * 275  # Среднее количество слов на страницу
-    words_per_chapter = total_words // len(plan_array)  # Распределяем слова между главами
-    
-    # Для очень маленьких работ (1-2 страницы) минимум 200 слов на главу
-    # Для средних работ (3-5 страниц) минимум 300 слов
-    # Для больших работ (6+ страниц) минимум 400 слов
-    if page_number <= 2:
-        words_per_chapter = max(200, words_per_chapter)
-    elif page_number <= 5:
-        words_per_chapter = max(300, words_per_chapter)
-    else:
-        words_per_chapter = max(400, words_per_chapter)
-    
-    logging.info(f"Запрошено страниц: {page_number}, глав в плане: {len(plan_array)}, слов на главу: {words_per_chapter}")
+def enqueue_update(application, data: dict) -> None:
+    """Ставит обновление из webhook в очередь бота; при переполнении — asyncio.QueueFull"""
+    update = Update.de_json(data, application.bot)
+    try:
+        # При параллельной обработке очередь сразу разбирается в задачи — учитываем и их
+        if application.update_queue.qsize() + updates_in_progress(application) >= UPDATE_QUEUE_SIZE:
+            raise asyncio.QueueFull
+        application.update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        telegram_webhook_updates_total.inc(result="queue_full")
+        raise
+    telegram_webhook_updates_total.inc(result="accepted")
 
-    # === УМНОЕ РАСПРЕДЕЛЕНИЕ ПОЖЕЛАНИЙ ПО ГЛАВАМ ===
-    parsed_preferences = parse_preferences_by_chapter(preferences, plan_array)
-    global_preferences = parsed_preferences['global']
-    chapter_preferences = parsed_preferences['by_chapter']
+def run_webhook(application) -> None:
+    """
+    Запускает бота в режиме webhook
 
-    # Функция для выполнения одного запроса к API
-    async def fetch_chapter_text(chapter: str) -> tuple[str, str]:
-        logging.info(f"Генерация текста для главы: {chapter}")
-        
-        # Определяем пожелания для этой конкретной главы
-        chapter_specific = chapter_preferences.get(chapter, '')
-        
-        # Комбинируем общие и специфичные пожелания
-        if chapter_specific and global_preferences:
-            combined_preferences = f"{global_preferences}. {chapter_specific}"
-        elif chapter_specific:
-            combined_preferences = chapter_specific
-        elif global_preferences:
-            combined_preferences = global_preferences
-        else:
-            combined_preferences = preferences  # Используем оригинальные, если парсинг не дал результата
-        
-        prompt = (
-            f"Действуй как специалист в области {science_name}, "
-            f"напиши, строго с опорой на авторитетные источники, "
-            f"главу: {chapter} в контексте написания {work_type} "
-            f"по теме: {work_theme} (напиши не менее {words_per_chapter} слов) "
-            f"(Напиши текст, в котором предложения будут иметь разную длину, "
-            f"а также будет избегаться нахождение однокоренных слов "
-            f"в соседних предложениях) "
-            f"(избегай комментариев, анализа соблюденных тобою требований, "
-            f"возвращай исключительно текст, так, будто бы ты отправляешь "
-            f"его на проверку преподавателю) "
-            f"НЕ используй вводные фразы типа 'Отлично', 'Вот текст', 'Рассмотрим'. "
-            f"Начинай сразу с основного содержания. {combined_preferences}"
-        )
-        # Выполняем запрос к DeepSeek под контролем семафора и обрабатываем ошибки
-        try:
-            async with GENERATION_SEMAPHORE:
-                response = await client.chat.completions.create(
-                    model="deepseek-reasoner",
-                    messages=[{"role": "user", "content": prompt}],
-                    stream=False
-                )
-            chapter_text = response.choices[0].message.content
-            # Валидируем и очищаем сгенерированный контент
-            chapter_text = validate_generated_content(chapter_text, chapter)
-            logging.info(f"Сгенерирован текст для главы: {chapter_text[:100]}...")
-            return chapter, chapter_text
-        except Exception as e:
-            logging.error(f"Ошибка при генерации текста для главы {chapter}: {e}")
-            # Возвращаем сообщение об ошибке, чтобы не сломать gather
-            return chapter, f"Ошибка при генерации текста для главы: {chapter}"
-
-    # Создание списка задач для параллельного выполнения
-    tasks = [fetch_chapter_text(chapter) for chapter in plan_array]
-    # Параллельное выполнение запросов
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    # Проверка результатов
-    chapters_text = []
-    for result in results:
-        if isinstance(result, Exception):
-            logging.error(f"Ошибка в задаче: {result}")
+    Повторяет жизненный цикл run_polling (post_init, start, stop, shutdown,
+    post_shutdown), но обновления принимает встроенный HTTP-сервер. При
+    остановке сервер закрывается первым, а уже принятые обновления
+    обрабатываются до конца.
+    """
+    async def serve() -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
             try:
-                chat_id = get_chat_id(context)
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Ошибка при генерации текста. Пожалуйста, попробуйте позже."
-                )
-            except Exception as chat_error:
-                logging.error(f"Ошибка отправки сообщения: {chat_error}")
-            return None
-        elif isinstance(result, tuple) and len(result) == 2:
-            chapter, chapter_text = result
-            chapters_text.append((chapter, chapter_text))
-        else:
-            logging.error(f"Неожиданный формат результата: {result}")
-            return None
-
-    # Создание документа в памяти
-    doc = docx.Document()
-    
-    # === ТИТУЛЬНЫЙ ЛИСТ (без нумерации) ===
-    title_section = doc.sections[0]
-    # Настройка полей по требованиям: верх/низ 25мм, лево 30мм, право 10мм
-    title_section.top_margin = Cm(2.5)     # 25 мм
-    title_section.bottom_margin = Cm(2.5)  # 25 мм
-    title_section.left_margin = Cm(3.0)    # 30 мм
-    title_section.right_margin = Cm(1.0)   # 10 мм
-    
-    # Отключаем нумерацию на титульном листе
-    title_section.different_first_page_header_footer = True
-
-    # Установка стиля текста для всего документа
-    style = doc.styles['Normal']
-    font = style.font
-    font.name = 'Times New Roman'
-    font.size = Pt(14)
-    
-    # Настройка параграфа для стиля Normal
-    paragraph_format = style.paragraph_format
-    paragraph_format.line_spacing = 1.5  # Интервал 1.5
-    paragraph_format.first_line_indent = Cm(1.25)  # Отступ первой строки
-
-    # Добавляем титульный лист (без нумерации)
-    add_title_page(doc, work_type, work_theme, science_name, context.user_data.get("page_number", 0))
-    
-    # Добавляем разрыв раздела после титульного листа
-    doc.add_section()
-    
-    # === ОГЛАВЛЕНИЕ (начинается нумерация с 2) ===
-    content_section = doc.sections[-1]
-    content_section.top_margin = Cm(2.5)
-    content_section.bottom_margin = Cm(2.5)
-    content_section.left_margin = Cm(3.0)
-    content_section.right_margin = Cm(1.0)
-    
-    # Добавляем нумерацию страниц со 2-й страницы
-    add_page_number(content_section, start_number=2)
-    
-    # Добавляем заголовок "Оглавление"
-    contents_heading = doc.add_heading("ОГЛАВЛЕНИЕ", level=1)
-    contents_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    for run in contents_heading.runs:
-        run.font.name = 'Times New Roman'
-        run.font.size = Pt(16)
-        run.font.bold = True
-        run.font.color.rgb = RGBColor(0, 0, 0)  # Черный цвет
-    
-    # Добавляем пункты оглавления
-    page_counter = 3  # Первая страница после оглавления
-    
-    # Главы основной части
-    for i, chapter in enumerate(plan_array, 1):
-        contents_p = doc.add_paragraph()
-        contents_p.paragraph_format.first_line_indent = Cm(0)
-        contents_p.paragraph_format.left_indent = Cm(0)
-        
-        # Добавляем номер и название главы
-        chapter_text = f"{i}. {chapter}"
-        run = contents_p.add_run(chapter_text)
-        run.font.name = 'Times New Roman'
-        run.font.size = Pt(14)
-        
-        # Добавляем точки-заполнители
-        dots_count = max(1, 70 - len(chapter_text))
-        dots_run = contents_p.add_run("." * dots_count)
-        dots_run.font.name = 'Times New Roman'
-        dots_run.font.size = Pt(14)
-        
-        # Номер страницы
-        page_run = contents_p.add_run(f" {page_counter}")
-        page_run.font.name = 'Times New Roman'
-        page_run.font.size = Pt(14)
-        page_counter += 1
-    
-    # Список источников
-    contents_p = doc.add_paragraph()
-    contents_p.paragraph_format.first_line_indent = Cm(0)
-    contents_p.paragraph_format.left_indent = Cm(0)
-    run = contents_p.add_run("Список источников")
-    run.font.name = 'Times New Roman'
-    run.font.size = Pt(14)
-    dots_run = contents_p.add_run("." * 57)
-    dots_run.font.name = 'Times New Roman'
-    dots_run.font.size = Pt(14)
-    page_run = contents_p.add_run(f" {page_counter}")
-    page_run.font.name = 'Times New Roman'
-    page_run.font.size = Pt(14)
-    
-    # Добавляем разрыв страницы после оглавления
-    doc.add_page_break()
-
-    # === ОСНОВНАЯ ЧАСТЬ ===
-    # Добавление текста глав в документ
-    for i, (chapter, chapter_text) in enumerate(chapters_text, 1):
-        # Удаляем дублирующийся заголовок из текста главы
-        chapter_text_cleaned = remove_chapter_title_from_text(chapter_text, chapter)
-        
-        chapter_heading = doc.add_heading(f"{i}. {chapter}", level=2)
-        chapter_heading.alignment = WD_ALIGN_PARAGRAPH.LEFT
-        # Настройка шрифта заголовка главы
-        for run in chapter_heading.runs:
-            run.font.name = 'Times New Roman'
-            run.font.size = Pt(14)
-            run.font.bold = True
-            run.font.color.rgb = RGBColor(0, 0, 0)  # Черный цвет
-        
-        # Разбиваем текст на блоки по двойным переносам строк
-        text_blocks = [block.strip() for block in chapter_text_cleaned.split('\n\n') if block.strip()]
-        
-        # Добавляем каждый блок как отдельный параграф
-        for block in text_blocks:
-            p = doc.add_paragraph(block)
-            p.paragraph_format.line_spacing = 1.5
-            p.paragraph_format.first_line_indent = Cm(1.25)
-            p.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY  # Выравнивание по ширине
-            p.paragraph_format.space_after = Pt(0)  # Убираем отступ после параграфа
-            p.paragraph_format.space_before = Pt(0)  # Убираем отступ перед параграфом
-            # Убеждаемся, что текст использует правильный шрифт
-            for run in p.runs:
-                run.font.name = 'Times New Roman'
-                run.font.size = Pt(14)
-        
-        # Добавляем разрыв страницы после каждой главы (кроме последней)
-        if i < len(chapters_text):
-            doc.add_page_break()
-    
-    # === СПИСОК ИСТОЧНИКОВ ===
-    
-    # Определяем количество источников в зависимости от типа работы
-    if work_type in ["Курсовая работа", "Дипломная работа"]:
-        sources_count = 20
-    else:
-        sources_count = 12  # 10-15 источников, берем среднее значение
-    
-    # Получаем ключевые слова для поиска источников
-    keywords = extract_keywords_from_theme(work_theme, science_name)
-    
-    # Получаем источники через Coze workflow
-    sources = await fetch_sources_from_coze(keywords, sources_count)
-    
-    # Если источники получены, добавляем их в документ
-    if sources:
-        # Заголовок раздела
-        sources_heading = doc.add_heading("СПИСОК ИСТОЧНИКОВ", level=1)
-        sources_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        for run in sources_heading.runs:
-            run.font.name = 'Times New Roman'
-            run.font.size = Pt(16)
-            run.font.bold = True
-            run.font.color.rgb = RGBColor(0, 0, 0)  # Черный цвет
-        
-        # Добавляем каждый источник
-        for i, source in enumerate(sources, 1):
-            formatted_source = format_source_gost(source, i)
-            source_p = doc.add_paragraph(formatted_source)
-            source_p.paragraph_format.line_spacing = 1.5
-            source_p.paragraph_format.first_line_indent = Cm(0)  # Без отступа для списка
-            source_p.paragraph_format.left_indent = Cm(0)
-            
-            # Настройка шрифта
-            for run in source_p.runs:
-                run.font.name = 'Times New Roman'
-                run.font.size = Pt(14)
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass  # Windows: остановка по Ctrl+C через KeyboardInterrupt
         
-        logging.info(f"Добавлено {len(sources)} источников в документ")
-        
-        # Уведомляем пользователя о завершении
-        try:
-            chat_id = get_chat_id(context)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"✅ Найдено и добавлено {len(sources)} источников"
-            )
-        except Exception as chat_error:
-            logging.error(f"Ошибка отправки уведомления о завершении поиска: {chat_error}")
-    else:
-        logging.warning("Не удалось получить источники через Coze workflow")
-        # Уведомляем пользователя
+        await application.initialize()
         try:
-            chat_id = get_chat_id(context)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="⚠️ Не удалось автоматически найти источники. Пожалуйста, добавьте их самостоятельно."
-            )
-        except Exception as chat_error:
-            logging.error(f"Ошибка отправки уведомления об ошибке поиска: {chat_error}")
-
-    # Сохранение документа в память
-    doc_io = io.BytesIO()
-    doc.save(doc_io)
-    doc_io.seek(0)  # Возвращаем указатель в начало
-    
-    logging.info("Документ создан в памяти")
-    return doc_io
-
-async def cancel(update: Update, context: CallbackContext) -> int:
-    """Обработчик отмены заказа"""
-    user_id = update.effective_user.id
-    await log_user_action(user_id, "cancel_order")
-    
-    keyboard = [["/order"], ["/help", "/menu"]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
-    await update.message.reply_text(
-        "❌ Заказ отменён.\n\n"
-        "Вы можете начать новый заказ с помощью команды /order",
-        reply_markup=reply_markup
-    )
-    return ConversationHandler.END
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            if TELEGRAM_WEBHOOK_URL:
+                await application.bot.set_webhook(
+                    TELEGRAM_WEBHOOK_URL,
+                    secret_token=TELEGRAM_WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS
+                )
+                logging.info(f"Webhook зарегистрирован: {TELEGRAM_WEBHOOK_URL}")
+            await stop.wait()
+        finally:
+            if web_server is not None:
+                await web_server.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+    
+    asyncio.run(serve())
+
+async def on_shutdown(application) -> None:
+    """Закрывает долгоживущие сетевые клиенты при остановке бота"""
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+    if web_server is not None:
+        await web_server.stop()
+    await close_sources()
+    rate_limiter.close()
+    payment_gateway.shutdown()
 
 # Основная функция
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    configure_logging()
+    check_config()
+    init_db()
+    # Значения, изменённые через /admin_config, действуют и после перезапуска
+    settings.refresh()
+    configure_yookassa()
+    
+    # Задержки запросов к Bot API попадают в метрики; getUpdates идёт через отдельный клиент
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        # Ограниченная очередь: при перегрузке webhook отвечает 503, polling ждёт места
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    # Медленный обработчик (отчёт, тестовый заказ) не задерживает другие чаты
+    if MAX_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(
+            ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES, max_pending=UPDATE_QUEUE_SIZE)
+        )
+    application = builder.build()
+    update_queue_size.set_function(application.update_queue.qsize)
+    updates_in_progress_gauge.set_function(lambda: updates_in_progress(application))
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("order", order)],
@@ -3058,7 +2505,10 @@ def main():
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        # Шаг диалога хранится вместе с user_data и восстанавливается после перезапуска
+        name="order",
+        persistent=persistence is not None
     )
 
     # Основные команды
@@ -3066,6 +2516,8 @@ def main():
     application.add_handler(MessageHandler(filters.Regex("^Продолжить$"), continue_handler))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(CommandHandler("my_orders", my_orders))
+    application.add_handler(CallbackQueryHandler(redownload_handler, pattern=r"^redownload:\d+$"))
     application.add_handler(conv_handler)
     
     # Админ-команды
@@ -3077,18 +2529,26 @@ def main():
     application.add_handler(CommandHandler("admin_finance", admin_finance))
     application.add_handler(CommandHandler("admin_export", admin_export))
     application.add_handler(CommandHandler("admin_monitor", admin_monitor))
+    application.add_handler(CommandHandler("admin_resume", admin_resume))
+    application.add_handler(CommandHandler("admin_refunds", admin_refunds))
+    application.add_handler(CommandHandler("admin_config", admin_config))
 
     # Вывод информации о режиме работы
-    mode_indicator = "ТЕСТОВЫЙ РЕЖИМ (без реальных платежей)" if TESTING_MODE else "РАБОЧИЙ РЕЖИМ (с реальными платежами)"
+    testing_mode = settings.get("TESTING_MODE")
+    mode_indicator = "ТЕСТОВЫЙ РЕЖИМ (без реальных платежей)" if testing_mode else "РАБОЧИЙ РЕЖИМ (с реальными платежами)"
     print("="*60)
     print(f"🚀 Бот запущен с улучшенной админ-панелью!")
-    print(f"{'🧪' if TESTING_MODE else '💳'} {mode_indicator}")
+    print(f"{'🧪' if testing_mode else '💳'} {mode_indicator}")
     print("="*60)
     logging.info("Бот запущен с улучшенной админ-панелью")
     logging.info(f"{'='*60}")
     logging.info(f"{mode_indicator}")
     logging.info(f"{'='*60}")
-    application.run_polling()
+    if TELEGRAM_WEBHOOK_ENABLED:
+        logging.info(f"Обновления принимаются через webhook: {WEB_SERVER_HOST}:{WEB_SERVER_PORT}{TELEGRAM_WEBHOOK_PATH}")
+        run_webhook(application)
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
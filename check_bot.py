@@ -5,6 +5,7 @@
 
 import os
 import sys
+import time
 import importlib.util
 from pathlib import Path
 
@@ -96,15 +97,17 @@ def main():
     # 4. Проверка импорта основного модуля
     print_section("🤖 МОДУЛЬ БОТА")
     try:
+        # Импорт не подключается к базе и не создаёт клиентов: это делает bot.main()
+        started = time.perf_counter()
         import bot
-        print("✅ Модуль bot.py импортирован успешно")
+        print(f"✅ Модуль bot.py импортирован успешно ({(time.perf_counter() - started) * 1000:.0f} мс)")
         
         # Проверяем основные переменные
-        print(f"\n📊 Конфигурация бота:")
-        print(f"   • Тестовый режим: {'ВКЛ 🧪' if bot.TESTING_MODE else 'ВЫКЛ 💳'}")
-        print(f"   • Администраторы: {len(bot.ADMIN_IDS)} чел.")
-        print(f"   • Rate limit: {bot.MAX_REQUESTS_PER_HOUR} запросов/час")
-        print(f"   • Окно времени: {bot.REQUEST_WINDOW} сек")
+        print(f"\n📊 Конфигурация бота (по умолчанию, без изменений из /admin_config):")
+        print(f"   • Тестовый режим: {'ВКЛ 🧪' if bot.settings.get('TESTING_MODE') else 'ВЫКЛ 💳'}")
+        print(f"   • Администраторы: {len(bot.settings.get('ADMIN_IDS'))} чел.")
+        print(f"   • Rate limit: {bot.settings.get('MAX_REQUESTS_PER_HOUR')} заказов")
+        print(f"   • Окно времени: {bot.settings.get('REQUEST_WINDOW')} сек")
         
         # Проверяем функции
         print(f"\n🔧 Проверка основных функций:")
@@ -132,7 +135,7 @@ def main():
         
         # Тест админ-функций
         try:
-            result = bot.is_admin(bot.ADMIN_IDS[0])
+            result = bot.is_admin(bot.settings.get('ADMIN_IDS')[0])
             assert result == True
             print(f"   ✅ is_admin работает")
             test_results.append(True)
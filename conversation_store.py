@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранение состояния диалогов бота в SQLite
+
+Подкласс BasePersistence для python-telegram-bot: context.user_data и
+состояния ConversationHandler (name=..., persistent=True) сохраняются в
+файл и восстанавливаются при запуске, поэтому перезапуск или деплой не
+обрывает оформление заказа на середине.
+
+- Запись пачками: Application вызывает update_* раз в update_interval
+  секунд для всех изменившихся пользователей и диалогов; изменения
+  собираются и записываются одной транзакцией.
+- Ограниченная память: брошенные диалоги и данные пользователей, которые
+  не появлялись дольше ttl, удаляются из памяти и из файла (expire); при
+  превышении max_users удаляются самые давно неактивные.
+- Файл в режиме WAL можно открывать из нескольких процессов: новый процесс
+  подхватывает состояние, сохранённое предыдущим при остановке. Обновления
+  одного чата при этом должен обрабатывать один процесс — состояние
+  диалогов читается только при запуске.
+
+chat_data, bot_data и callback_data бот не использует, они не сохраняются.
+"""
+
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from functools import cached_property
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+
+class SQLitePersistence(BasePersistence):
+    """user_data и состояния диалогов в SQLite с пакетной записью и TTL"""
+
+    def __init__(self, db_path: str = "conversations.db", ttl: float = 86400,
+                 max_users: int = 10000, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        # Отложенные изменения: None — удалить запись
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._write_scheduled = False
+        # Время последней активности — по нему считается TTL
+        self._user_seen = {}
+        self._conversation_seen = {}
+
+    @cached_property
+    def _conn(self) -> sqlite3.Connection:
+        """Соединение открывается при первом обращении, а не при создании объекта"""
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_data ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (name, key))"
+        )
+        return conn
+
+    # ---------- Загрузка при запуске ----------
+
+    async def get_user_data(self) -> dict:
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._conn.execute("DELETE FROM user_data WHERE updated_at < ?", (cutoff,))
+            # Лимит max_users применяет expire: он удаляет данные вместе с диалогами пользователя
+            rows = self._conn.execute("SELECT user_id, data, updated_at FROM user_data").fetchall()
+        result = {}
+        for user_id, data, updated_at in rows:
+            result[user_id] = json.loads(data)
+            self._user_seen[user_id] = updated_at
+        logging.info(f"Восстановлены данные {len(result)} пользователей из {self.db_path}")
+        return result
+
+    async def get_conversations(self, name: str) -> dict:
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._conn.execute("DELETE FROM conversations WHERE updated_at < ?", (cutoff,))
+            rows = self._conn.execute(
+                "SELECT key, state, updated_at FROM conversations WHERE name = ?", (name,)
+            ).fetchall()
+        result = {}
+        for key, state, updated_at in rows:
+            key = tuple(json.loads(key))
+            result[key] = json.loads(state)
+            self._conversation_seen[(name, key)] = updated_at
+        logging.info(f"Восстановлено {len(result)} незавершённых диалогов «{name}»")
+        return result
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ---------- Изменения (вызываются Application пачкой) ----------
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._user_seen[user_id] = time.time()
+        self._pending_users[user_id] = data
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_seen.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        if new_state is None:
+            self._conversation_seen.pop((name, key), None)
+        else:
+            self._conversation_seen[(name, key)] = time.time()
+        self._pending_conversations[(name, key)] = new_state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    def _schedule_write(self) -> None:
+        """
+        Откладывает запись до конца текущей итерации цикла событий
+
+        Application запускает все update_* одного прохода через asyncio.gather,
+        поэтому к моменту записи в буфере оказывается весь проход целиком.
+        """
+        if self._write_scheduled:
+            return
+        self._write_scheduled = True
+        try:
+            asyncio.get_running_loop().call_soon(self._write_pending)
+        except RuntimeError:
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        """Записывает накопленные изменения одной транзакцией"""
+        self._write_scheduled = False
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not users and not conversations:
+            return
+        now = time.time()
+        upsert_users, delete_users = [], []
+        for user_id, data in users.items():
+            if data is None:
+                delete_users.append((user_id,))
+                continue
+            try:
+                upsert_users.append((user_id, json.dumps(data, ensure_ascii=False), now))
+            except (TypeError, ValueError) as e:
+                logging.error(f"Данные пользователя {user_id} не сохранены: {e}")
+        upsert_conversations, delete_conversations = [], []
+        for (name, key), state in conversations.items():
+            if state is None:
+                delete_conversations.append((name, json.dumps(key)))
+            else:
+                upsert_conversations.append((name, json.dumps(key), json.dumps(state), now))
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.executemany(
+                        "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                        upsert_users
+                    )
+                    self._conn.executemany("DELETE FROM user_data WHERE user_id = ?", delete_users)
+                    self._conn.executemany(
+                        "INSERT INTO conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                        upsert_conversations
+                    )
+                    self._conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?", delete_conversations)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка сохранения состояния диалогов: {e}")
+            # Вернём изменения в буфер, более новые значения из буфера не затираем
+            self._pending_users = {**users, **self._pending_users}
+            self._pending_conversations = {**conversations, **self._pending_conversations}
+
+    async def flush(self) -> None:
+        """Вызывается Application при остановке после последнего update_persistence"""
+        self._write_pending()
+        if "_conn" in self.__dict__:
+            with self._lock:
+                self._conn.close()
+            del self.__dict__["_conn"]
+
+    # ---------- TTL ----------
+
+    def expire(self, application, now: float = None) -> int:
+        """
+        Удаляет брошенные диалоги и данные давно неактивных пользователей
+
+        Данные пользователей удаляются через Application.drop_user_data, диалоги —
+        из словаря состояний ConversationHandler: публичного способа завершить
+        диалог извне нет (conversation_timeout требует JobQueue). Данные пользователей
+        удаляются из файла при следующем update_persistence, диалоги — сразу.
+
+        Returns:
+            Сколько пользователей и диалогов удалено
+        """
+        now = now or time.time()
+        cutoff = now - self.ttl
+        stale_users = {user_id for user_id, seen in self._user_seen.items() if seen < cutoff}
+        overflow = len(self._user_seen) - len(stale_users) - self.max_users
+        if overflow > 0:
+            active = sorted(
+                (seen, user_id) for user_id, seen in self._user_seen.items() if user_id not in stale_users
+            )
+            stale_users.update(user_id for _, user_id in active[:overflow])
+        for user_id in stale_users:
+            application.drop_user_data(user_id)
+            self._user_seen.pop(user_id, None)
+
+        handlers = {
+            handler.name: handler
+            for group in application.handlers.values() for handler in group
+            if isinstance(handler, ConversationHandler) and handler.persistent
+        }
+        expired = 0
+        for (name, key), seen in list(self._conversation_seen.items()):
+            handler = handlers.get(name)
+            if handler is None:
+                continue
+            # Без user_data продолжать диалог нельзя — он завершается вместе с ними
+            user_gone = handler.per_user and key and key[-1] in stale_users
+            if seen < cutoff or user_gone:
+                handler._conversations.pop(key, None)
+                self._conversation_seen.pop((name, key), None)
+                # ConversationHandler не сообщает persistence об удалении из своего словаря —
+                # без этого строка осталась бы в файле и диалог вернулся бы после перезапуска
+                self._pending_conversations[(name, key)] = None
+                expired += 1
+        if expired:
+            self._schedule_write()
+        if stale_users or expired:
+            logging.info(f"Удалены данные {len(stale_users)} неактивных пользователей и {expired} брошенных диалогов")
+        return len(stale_users) + expired
+
+    def size(self) -> tuple:
+        """(пользователей, незавершённых диалогов) в памяти"""
+        return len(self._user_seen), len(self._conversation_seen)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Движки NinjaEssayAI, не зависящие от Telegram
+
+- storage — база заказов, чекпоинты, артефакты, стадии выполнения, outbox
+- generation — план и главы через DeepSeek с приоритетными слотами
+- rendering — сборка документа .docx (синхронная, подходит для пула процессов)
+- sources — подбор, индексирование и проверка источников (Coze)
+- payments — платежи и возвраты YooKassa
+- admin — отчёты для админ-команд
+- jobs — очередь заданий на выполнение заказов для бота и воркеров (worker.py)
+- settings — настройки, изменяемые без перезапуска (/admin_config)
+
+Модули импортируются без токена бота и ключей API: клиенты создаются
+при первом запросе, настройки проверяет bot.main(). Обработчики Telegram
+остаются в bot.py и вызывают движки.
+"""
+
+from dotenv import load_dotenv
+
+from metrics import MetricsRegistry
+
+# Движки читают настройки при импорте, в том числе вне bot.py (воркеры, скрипты)
+load_dotenv()
+
+# Общий реестр метрик процесса (эндпоинт METRICS_PATH)
+metrics = MetricsRegistry(prefix="bot_")
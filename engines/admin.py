@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Аналитика для админ-команд
+
+Отчёты строятся по сессии базы и возвращают готовый текст (или CSV),
+поэтому их можно вызывать вне Telegram — из скриптов и воркеров.
+Проверка прав, лимиты и отправка ответа остаются в обработчиках bot.py.
+"""
+
+import io
+import csv
+import math
+from datetime import datetime, timezone, timedelta
+
+from engines.storage import UserAction, Order, OrderStage, ORDER_STAGES
+
+def seconds_between(session, start, end):
+    """
+    SQL-выражение: секунды от start до end
+    
+    Функции дат у СУБД разные, а DATABASE_URL может указывать не только на
+    SQLite, но и на общую базу воркеров (PostgreSQL, MySQL).
+    """
+    from sqlalchemy import func, extract, literal_column
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return (func.julianday(end) - func.julianday(start)) * 86400
+    if dialect in ("mysql", "mariadb"):
+        return func.timestampdiff(literal_column("SECOND"), start, end)
+    return extract("epoch", end - start)
+
+def stats_report(session) -> str:
+    """Статистика пользователей, заказов и доходов (/admin_stats)"""
+    # Общая статистика
+    total_actions = session.query(UserAction).count()
+    unique_users = session.query(UserAction.user_id).distinct().count()
+    
+    # Статистика по действиям
+    start_commands = session.query(UserAction).filter(UserAction.action == "start_command").count()
+    order_commands = session.query(UserAction).filter(UserAction.action == "order_command").count()
+    
+    # Статистика за последние 24 часа
+    day_ago = datetime.now(timezone.utc) - timedelta(hours=24)
+    recent_actions = session.query(UserAction).filter(UserAction.timestamp > day_ago).count()
+    
+    # Дополнительные метрики
+    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    week_actions = session.query(UserAction).filter(UserAction.timestamp > week_ago).count()
+    
+    # Топ-3 популярных действий
+    from sqlalchemy import func
+    top_actions = session.query(
+        UserAction.action,
+        func.count(UserAction.id).label('count')
+    ).group_by(UserAction.action).order_by(func.count(UserAction.id).desc()).limit(3).all()
+    
+    # Активность по дням недели
+    from sqlalchemy import extract
+    today_weekday = datetime.now().weekday()
+    today_actions = session.query(UserAction).filter(
+        extract('dow', UserAction.timestamp) == today_weekday,
+        UserAction.timestamp > day_ago
+    ).count()
+    
+    # Новые пользователи за неделю
+    new_users_week = session.query(UserAction.user_id).filter(
+        UserAction.timestamp > week_ago
+    ).distinct().count()
+    
+    # Активные пользователи (действия за последние 7 дней)
+    active_users_week = session.query(UserAction.user_id).filter(
+        UserAction.timestamp > week_ago
+    ).distinct().count()
+    
+    # Среднее количество действий на пользователя
+    avg_actions_per_user = total_actions / unique_users if unique_users > 0 else 0
+    
+    # === ДОПОЛНИТЕЛЬНЫЕ МЕТРИКИ ===
+    # Статистика заказов
+    total_orders = session.query(Order).count()
+    paid_orders = session.query(Order).filter(Order.status == "paid").count()
+    completed_orders = session.query(Order).filter(Order.status == "completed").count()
+    failed_orders = session.query(Order).filter(Order.status == "failed").count()
+    
+    # Заказы за последние 24 часа и неделю
+    recent_orders = session.query(Order).filter(Order.created_at > day_ago).count()
+    week_orders = session.query(Order).filter(Order.created_at > week_ago).count()
+    
+    # Конверсия (% пользователей, сделавших заказ)
+    users_with_orders = session.query(Order.user_id).distinct().count()
+    conversion_rate = (users_with_orders / unique_users * 100) if unique_users > 0 else 0
+    
+    # Средняя цена заказа
+    from sqlalchemy import func
+    avg_order_price = session.query(func.avg(Order.price)).scalar() or 0
+    
+    # Доходы
+    total_revenue = session.query(func.sum(Order.price)).filter(Order.status.in_(["paid", "completed"])).scalar() or 0
+    week_revenue = session.query(func.sum(Order.price)).filter(
+        Order.status.in_(["paid", "completed"]),
+        Order.created_at > week_ago
+    ).scalar() or 0
+    
+    # Популярные типы работ
+    popular_works = session.query(
+        Order.work_type,
+        func.count(Order.id).label('count')
+    ).group_by(Order.work_type).order_by(func.count(Order.id).desc()).limit(3).all()
+    
+    # Популярные предметы
+    popular_subjects = session.query(
+        Order.science_name,
+        func.count(Order.id).label('count')
+    ).group_by(Order.science_name).order_by(func.count(Order.id).desc()).limit(3).all()
+    
+    # Среднее время выполнения заказа от оплаты до доставки (без времени на оплату)
+    avg_completion_seconds = session.query(
+        func.avg(seconds_between(session, Order.paid_at, Order.delivered_at))
+    ).filter(
+        Order.status == "completed",
+        Order.paid_at.isnot(None),
+        Order.delivered_at.isnot(None)
+    ).scalar()
+    avg_completion_time = float(avg_completion_seconds or 0) / 60  # в минутах
+    
+    # Активность по часам (топ-3 часа)
+    from sqlalchemy import extract
+    hourly_activity = session.query(
+        extract('hour', UserAction.timestamp).label('hour'),
+        func.count(UserAction.id).label('count')
+    ).filter(UserAction.timestamp > day_ago).group_by(
+        extract('hour', UserAction.timestamp)
+    ).order_by(func.count(UserAction.id).desc()).limit(3).all()
+    
+    # Retention: пользователи, вернувшиеся после первого дня
+    first_actions = session.query(
+        UserAction.user_id,
+        func.min(UserAction.timestamp).label('first_action')
+    ).group_by(UserAction.user_id).subquery()
+    
+    returning_users = session.query(UserAction.user_id).join(
+        first_actions, UserAction.user_id == first_actions.c.user_id
+    ).filter(
+        UserAction.timestamp > first_actions.c.first_action + timedelta(days=1)
+    ).distinct().count()
+    
+    retention_rate = (returning_users / unique_users * 100) if unique_users > 0 else 0
+    
+    stats_text = f"""
+📊 **Статистика бота:**
+
+👥 Уникальных пользователей: {unique_users}
+📝 Всего действий: {total_actions}
+🚀 Команд /start: {start_commands}
+📋 Команд /order: {order_commands}
+📈 Среднее действий/пользователь: {avg_actions_per_user:.1f}
+🔄 Retention rate: {retention_rate:.1f}%
+
+💰 **Статистика заказов:**
+📦 Всего заказов: {total_orders}
+✅ Оплаченных: {paid_orders}
+🎯 Завершенных: {completed_orders}
+❌ Неудачных: {failed_orders}
+📈 Конверсия: {conversion_rate:.1f}%
+💵 Средняя цена: {avg_order_price:.0f} руб.
+💸 Общий доход: {total_revenue:.0f} руб.
+
+⏰ **Временная аналитика:**
+🕐 Действий за 24 часа: {recent_actions}
+📅 Действий за неделю: {week_actions}
+🆕 Новых пользователей за неделю: {new_users_week}
+🔥 Активных пользователей за неделю: {active_users_week}
+📊 Активность сегодня: {today_actions}
+🛒 Заказов за 24 часа: {recent_orders}
+📋 Заказов за неделю: {week_orders}
+💰 Доход за неделю: {week_revenue:.0f} руб.
+⏱️ Среднее время выполнения (от оплаты): {avg_completion_time:.1f} мин.
+
+🎯 **Популярные действия:**"""
+    
+    for action, count in top_actions:
+        stats_text += f"\n• {action}: {count}"
+    
+    stats_text += f"""
+
+📊 **Популярные типы работ:**"""
+    for work_type, count in popular_works:
+        stats_text += f"\n• {work_type}: {count}"
+        
+    stats_text += f"""
+
+🎓 **Популярные предметы:**"""
+    for subject, count in popular_subjects:
+        stats_text += f"\n• {subject}: {count}"
+        
+    stats_text += f"""
+
+🕐 **Активность по часам (топ-3):**"""
+    for hour, count in hourly_activity:
+        stats_text += f"\n• {int(hour)}:00 - {count} действий"
+    return stats_text
+
+def users_report(session) -> str:
+    """Топ-10 активных пользователей (/admin_users)"""
+    # Получаем топ пользователей по активности
+    from sqlalchemy import func, desc
+    top_users = session.query(
+        UserAction.user_id,
+        func.count(UserAction.id).label('action_count'),
+        func.max(UserAction.timestamp).label('last_activity')
+    ).group_by(UserAction.user_id)\
+     .order_by(desc('action_count'))\
+     .limit(10).all()
+    
+    users_text = "👥 **Топ-10 активных пользователей:**\n\n"
+    for user_id, action_count, last_activity in top_users:
+        users_text += f"• User ID: {user_id}\n"
+        users_text += f"  📝 Действий: {action_count}\n"
+        users_text += f"  🕐 Последняя активность: {last_activity.strftime('%Y-%m-%d %H:%M')}\n\n"
+    return users_text
+
+def orders_report(session) -> str:
+    """Статистика и последние заказы (/admin_orders)"""
+    # Статистика по заказам
+    from sqlalchemy import func, desc
+    
+    total_orders = session.query(Order).count()
+    completed_orders = session.query(Order).filter(Order.status == "completed").count()
+    failed_orders = session.query(Order).filter(Order.status == "failed").count()
+    refunded_orders = session.query(Order).filter(Order.status == "refunded").count()
+    
+    # Последние заказы
+    recent_orders = session.query(Order)\
+        .order_by(desc(Order.created_at))\
+        .limit(5).all()
+    
+    # Доходы
+    total_revenue = session.query(func.sum(Order.price))\
+        .filter(Order.status == "completed").scalar() or 0
+    
+    orders_text = f"""
+📊 **Статистика заказов:**
+
+📝 Всего заказов: {total_orders}
+✅ Выполнено: {completed_orders}
+❌ Ошибки: {failed_orders}
+💸 Возвраты: {refunded_orders}
+💰 Общий доход: {total_revenue}₽
+
+📋 **Последние заказы:**
+
+    """
+    
+    for order in recent_orders:
+        status_emoji = {
+            "created": "🆕",
+            "paid": "💳",
+            "completed": "✅",
+            "failed": "❌",
+            "refunded": "💸",
+            "cancelled": "🚫",
+            "expired": "⌛"
+        }.get(order.status, "❓")
+        
+        orders_text += f"""
+{status_emoji} ID: {order.id} | {order.work_type}
+💰 {order.price}₽ | 👤 {order.user_id}
+📚 {order.science_name} - {order.work_theme[:30]}...
+🕐 {order.created_at.strftime('%d.%m %H:%M')}
+
+"""
+    return orders_text
+
+def finance_report(session) -> str:
+    """Финансовая аналитика (/admin_finance)"""
+    from sqlalchemy import func, desc
+    
+    # Временные интервалы
+    now = datetime.now(timezone.utc)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    yesterday = today - timedelta(days=1)
+    week_ago = now - timedelta(days=7)
+    month_ago = now - timedelta(days=30)
+    
+    # Доходы по периодам
+    today_revenue = session.query(func.sum(Order.price)).filter(
+        Order.status.in_(["paid", "completed"]),
+        Order.created_at >= today
+    ).scalar() or 0
+    
+    yesterday_revenue = session.query(func.sum(Order.price)).filter(
+        Order.status.in_(["paid", "completed"]),
+        Order.created_at >= yesterday,
+        Order.created_at < today
+    ).scalar() or 0
+    
+    week_revenue = session.query(func.sum(Order.price)).filter(
+        Order.status.in_(["paid", "completed"]),
+        Order.created_at >= week_ago
+    ).scalar() or 0
+    
+    month_revenue = session.query(func.sum(Order.price)).filter(
+        Order.status.in_(["paid", "completed"]),
+        Order.created_at >= month_ago
+    ).scalar() or 0
+    
+    # Заказы по периодам
+    today_orders = session.query(Order).filter(Order.created_at >= today).count()
+    yesterday_orders = session.query(Order).filter(
+        Order.created_at >= yesterday,
+        Order.created_at < today
+    ).count()
+    
+    # Средний чек по периодам
+    today_avg = today_revenue / today_orders if today_orders > 0 else 0
+    yesterday_avg = yesterday_revenue / yesterday_orders if yesterday_orders > 0 else 0
+    
+    # Топ-5 самых дорогих заказов
+    expensive_orders = session.query(Order).filter(
+        Order.status.in_(["paid", "completed"])
+    ).order_by(desc(Order.price)).limit(5).all()
+    
+    # Статистика по типам работ (доходы)
+    work_revenue = session.query(
+        Order.work_type,
+        func.sum(Order.price).label('revenue'),
+        func.count(Order.id).label('count')
+    ).filter(
+        Order.status.in_(["paid", "completed"])
+    ).group_by(Order.work_type).order_by(desc('revenue')).limit(5).all()
+    
+    # Статистика по дням недели
+    weekday_stats = session.query(
+        func.extract('dow', Order.created_at).label('weekday'),
+        func.sum(Order.price).label('revenue'),
+        func.count(Order.id).label('count')
+    ).filter(
+        Order.status.in_(["paid", "completed"]),
+        Order.created_at >= week_ago
+    ).group_by(func.extract('dow', Order.created_at)).all()
+    
+    # Конверсия воронки
+    total_users = session.query(UserAction.user_id).distinct().count()
+    order_users = session.query(Order.user_id).distinct().count()
+    paid_users = session.query(Order.user_id).filter(
+        Order.status.in_(["paid", "completed"])
+    ).distinct().count()
+    
+    conversion_to_order = (order_users / total_users * 100) if total_users > 0 else 0
+    conversion_to_payment = (paid_users / order_users * 100) if order_users > 0 else 0
+    
+    # Возвраты и отмены
+    refunds = session.query(Order).filter(Order.status == "refunded").count()
+    failed_orders = session.query(Order).filter(Order.status == "failed").count()
+    
+    finance_text = f"""
+💰 **Финансовая аналитика:**
+
+📊 **Доходы:**
+💸 Сегодня: {today_revenue:.0f} руб. ({today_orders} заказов)
+📅 Вчера: {yesterday_revenue:.0f} руб. ({yesterday_orders} заказов)
+📈 За неделю: {week_revenue:.0f} руб.
+📊 За месяц: {month_revenue:.0f} руб.
+
+💵 **Средний чек:**
+🔥 Сегодня: {today_avg:.0f} руб.
+📊 Вчера: {yesterday_avg:.0f} руб.
+
+🎯 **Конверсия:**
+👥 Всего пользователей: {total_users}
+📝 Создали заказ: {order_users} ({conversion_to_order:.1f}%)
+💳 Оплатили: {paid_users} ({conversion_to_payment:.1f}%)
+
+🔥 **Топ-5 дорогих заказов:**"""
+    
+    for order in expensive_orders:
+        finance_text += f"\n💰 {order.price}₽ - {order.work_type} ({order.science_name})"
+    
+    finance_text += f"""
+
+📊 **Доходы по типам работ:**"""
+    for work_type, revenue, count in work_revenue:
+        finance_text += f"\n• {work_type}: {revenue:.0f}₽ ({count} заказов)"
+    
+    finance_text += f"""
+
+📅 **Статистика по дням недели:**"""
+    weekdays = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+    for weekday, revenue, count in weekday_stats:
+        day_name = weekdays[int(weekday) - 1] if weekday and weekday > 0 else "Неизв"
+        finance_text += f"\n• {day_name}: {revenue:.0f}₽ ({count} заказов)"
+    
+    finance_text += f"""
+
+⚠️ **Проблемы:**
+🔴 Возвраты: {refunds}
+❌ Неудачные заказы: {failed_orders}
+    """
+    return finance_text
+
+def orders_csv(session) -> bytes:
+    """Экспорт заказов в CSV (UTF-8)"""
+    # Экспорт заказов
+    orders = session.query(Order).all()
+    
+    # Создаем CSV в памяти
+    csv_buffer = io.StringIO()
+    writer = csv.writer(csv_buffer)
+    
+    # Заголовки
+    writer.writerow([
+        'ID', 'User ID', 'Work Type', 'Science Name', 'Theme', 
+        'Pages', 'Price', 'Status', 'Created At', 'Completed At'
+    ])
+    
+    # Данные
+    for order in orders:
+        writer.writerow([
+            order.id,
+            order.user_id,
+            order.work_type,
+            order.science_name,
+            order.work_theme,
+            order.page_number,
+            order.price,
+            order.status,
+            order.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            order.completed_at.strftime('%Y-%m-%d %H:%M:%S') if order.completed_at else ''
+        ])
+    return csv_buffer.getvalue().encode('utf-8')
+
+def actions_csv(session) -> bytes:
+    """Экспорт активности пользователей в CSV (UTF-8)"""
+    # Экспорт активности пользователей
+    actions = session.query(UserAction).all()
+    
+    actions_csv_buffer = io.StringIO()
+    actions_writer = csv.writer(actions_csv_buffer)
+    
+    # Заголовки
+    actions_writer.writerow(['ID', 'User ID', 'Action', 'Timestamp'])
+    
+    # Данные
+    for action in actions:
+        actions_writer.writerow([
+            action.id,
+            action.user_id,
+            action.action,
+            action.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        ])
+    return actions_csv_buffer.getvalue().encode('utf-8')
+
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+LATENCY_WINDOWS = (("1 ч", timedelta(hours=1)), ("24 ч", timedelta(hours=24)))
+
+def sql_percentiles(query, value, quantiles=LATENCY_QUANTILES) -> tuple:
+    """
+    Перцентили выражения value по строкам запроса (метод ближайшего ранга)
+    
+    Каждый перцентиль — отдельный запрос ORDER BY ... LIMIT 1 OFFSET k,
+    строки в Python не загружаются.
+    
+    Returns:
+        (количество строк, [значения перцентилей])
+    """
+    count = query.count()
+    if not count:
+        return 0, []
+    values = []
+    for q in quantiles:
+        rank = max(0, math.ceil(q * count) - 1)
+        values.append(query.order_by(value).offset(rank).limit(1).scalar())
+    return count, values
+
+def format_duration(seconds: float) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 10:
+        return f"{seconds:.1f} с"
+    if seconds < 120:
+        return f"{seconds:.0f} с"
+    return f"{seconds / 60:.1f} мин"
+
+def latency_report(session) -> str:
+    """p50/p90/p99 стадий заказа и полного времени от оплаты до доставки по скользящим окнам"""
+    now = datetime.now(timezone.utc)
+    total_seconds = seconds_between(session, Order.paid_at, Order.delivered_at)
+    report = ""
+    for window_name, window in LATENCY_WINDOWS:
+        since = now - window
+        report += f"\n🕒 За {window_name}:"
+        rows = []
+        for stage in ORDER_STAGES:
+            query = session.query(OrderStage.duration).filter(
+                OrderStage.stage == stage,
+                OrderStage.outcome == "ok",
+                OrderStage.started_at >= since
+            )
+            rows.append((stage, *sql_percentiles(query, OrderStage.duration)))
+        total_query = session.query(total_seconds).filter(
+            Order.paid_at.isnot(None),
+            Order.delivered_at.isnot(None),
+            Order.delivered_at >= since
+        )
+        rows.append(("оплата→доставка", *sql_percentiles(total_query, total_seconds)))
+        
+        for name, count, values in rows:
+            if not count:
+                continue
+            p50, p90, p99 = (format_duration(v) for v in values)
+            report += f"\n• {name}: p50 {p50} · p90 {p90} · p99 {p99} (n={count})"
+        if not any(count for _, count, _ in rows):
+            report += "\n• выполненных стадий нет"
+    return report
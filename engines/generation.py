@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Генерация работы через DeepSeek: план и тексты глав
+
+Запросы к модели идут через приоритетные слоты generation_scheduler
+(полосы paid > retry > test). Функции получают параметры заказа словарём
+user_data и не зависят от Telegram: сообщения пользователю передаются
+через необязательную корутину notify(text).
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+
+from preference_matcher import parse_preferences_by_chapter
+from priority_scheduler import PriorityScheduler
+from text_cleaning import remove_emojis, validate_generated_content
+from engines import metrics
+from engines.settings import settings
+from engines.storage import (
+    get_order_plan, save_order_plan, load_chapter_checkpoints, save_chapter_checkpoint,
+    is_valid_chapter_text, save_order_artifact
+)
+
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+
+# Потолки для младших полос генерации: повторы неудачных заказов и тестовые/админские заказы
+GENERATION_RETRY_LANE_LIMIT = int(os.getenv("GENERATION_RETRY_LANE_LIMIT", "5"))
+GENERATION_TEST_LANE_LIMIT = int(os.getenv("GENERATION_TEST_LANE_LIMIT", "2"))
+
+_llm_client = None
+
+def get_llm_client():
+    """Клиент DeepSeek; openai импортируется и клиент создаётся при первом запросе к модели"""
+    global _llm_client
+    if _llm_client is None:
+        from openai import AsyncOpenAI
+        _llm_client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
+    return _llm_client
+
+LLM_LATENCY_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 300, 600)
+llm_request_seconds = metrics.histogram(
+    "llm_request_seconds", "Длительность запросов к DeepSeek", ("kind", "outcome"), buckets=LLM_LATENCY_BUCKETS
+)
+llm_tokens_total = metrics.counter("llm_tokens_total", "Токены, израсходованные в DeepSeek", ("kind", "type"))
+
+async def llm_complete(kind: str, **kwargs):
+    """Запрос к DeepSeek с учётом длительности и израсходованных токенов
+    
+    Args:
+        kind: Назначение запроса для метрик (plan, chapter)
+        **kwargs: Параметры chat.completions.create
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        response = await get_llm_client().chat.completions.create(**kwargs)
+        outcome = "ok"
+    finally:
+        llm_request_seconds.observe(time.perf_counter() - started, kind=kind, outcome=outcome)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        llm_tokens_total.inc(usage.prompt_tokens or 0, kind=kind, type="prompt")
+        llm_tokens_total.inc(usage.completion_tokens or 0, kind=kind, type="completion")
+    return response
+
+# Ограничение одновременных запросов к DeepSeek API с приоритетными полосами:
+# paid (оплаченные заказы) > retry (повторы неудачных) > test (тестовые и админские)
+# Общее количество слотов — настройка GENERATION_CAPACITY, меняется без перезапуска:
+# 5 - для малой нагрузки (1-10 пользователей)
+# 10 - для средней нагрузки (10-50 пользователей) [по умолчанию]
+# 20 - для высокой нагрузки (50+ пользователей)
+# 30 - для максимальной нагрузки (100+ пользователей)
+generation_scheduler = PriorityScheduler(settings.get("GENERATION_CAPACITY"), lane_limits={
+    "retry": GENERATION_RETRY_LANE_LIMIT,
+    "test": GENERATION_TEST_LANE_LIMIT,
+})
+settings.on_change("GENERATION_CAPACITY", generation_scheduler.resize)
+
+# Количество попыток генерации одной главы до признания заказа неудачным
+CHAPTER_ATTEMPTS = 2
+
+def order_lane(order, retry: bool = False) -> str:
+    """Полоса генерации заказа: test для тестовых, retry для повтора оплаченного, иначе paid"""
+    if order.payment_id == "TEST_MODE" or (order.status or "").startswith("test_") or not order.price:
+        return "test"
+    return "retry" if retry else "paid"
+
+def order_user_data(order, lane: str = None) -> dict:
+    """Параметры генерации по сохранённому заказу (для повтора и выполнения вне диалога)"""
+    user_data = {
+        "work_type": order.work_type,
+        "science_name": order.science_name,
+        "work_theme": order.work_theme,
+        "page_number": order.page_number,
+        "price": order.price,
+        "preferences": "Без особых предпочтений",
+    }
+    if order.params:
+        try:
+            user_data.update(json.loads(order.params))
+        except json.JSONDecodeError:
+            logging.warning(f"Повреждены параметры заказа {order.id}")
+    user_data["order_id"] = order.id
+    user_data["generation_lane"] = lane or order_lane(order)
+    return user_data
+
+async def send_notice(notify, text: str) -> None:
+    """Сообщение пользователю о ходе генерации; ошибка отправки не прерывает генерацию"""
+    if notify is None:
+        return
+    try:
+        await notify(text)
+    except Exception as e:
+        logging.error(f"Ошибка отправки сообщения: {e}")
+
+async def generate_plan(user_data: dict, notify=None) -> list:
+    """Возвращает план работы: пользовательский, сохранённый для заказа или сгенерированный
+    
+    Args:
+        user_data: Параметры заказа (work_type, science_name, work_theme, page_number, ...)
+        notify: Корутина-функция notify(text) для сообщений пользователю или None
+    """
+    # Проверяем, есть ли пользовательский план
+    use_custom_plan = user_data.get("use_custom_plan", False)
+    page_number = user_data.get("page_number", 0)
+    
+    if use_custom_plan:
+        custom_plan = user_data.get("custom_plan", [])
+        if custom_plan:
+            # Проверяем соответствие количества пунктов плана заявленному количеству страниц
+            expected_chapters = max(1, page_number // 2)  # Минимум 1 пункт
+            plan_chapters = len(custom_plan)
+            
+            logging.info(f"Пользовательский план: {custom_plan}")
+            logging.info(f"Заявлено страниц: {page_number}, пунктов в плане: {plan_chapters}, ожидалось: {expected_chapters}")
+            
+            # Если пунктов слишком мало для заявленного количества страниц, предупреждаем
+            if plan_chapters < expected_chapters:
+                await send_notice(
+                    notify,
+                    f"⚠️ Внимание: Для {page_number} страниц рекомендуется {expected_chapters} пунктов плана, "
+                    f"а у вас {plan_chapters}. Это может повлиять на объем работы."
+                )
+            
+            return custom_plan
+    
+    # При повторной попытке используем уже сгенерированный план заказа,
+    # чтобы сохранённые главы совпали с пунктами плана
+    order_id = user_data.get("order_id")
+    if order_id:
+        saved_plan = get_order_plan(order_id)
+        if saved_plan:
+            logging.info(f"Используется сохранённый план заказа {order_id}")
+            return saved_plan
+    
+    # Если пользовательского плана нет, генерируем автоматически
+    logging.info("Запрос на генерация плана отправлен в DeepSeek API.")
+    
+    science_name = user_data.get("science_name", "")
+    work_type = user_data.get("work_type", "")
+    work_theme = user_data.get("work_theme", "")
+    preferences = user_data.get("preferences", "")
+    page_number = user_data.get("page_number", 0)
+
+    if not science_name or not work_type or not work_theme or not page_number:
+        logging.error("Недостаточно данных для генерации плана.")
+        await send_notice(notify, "Ошибка: Недостаточно данных для генерации плана. Проверьте введенные данные.")
+        return []
+
+    # Минимум 3 пункта (Введение + 1 глава + Заключение)
+    # Расчет: страницы / 2, но не менее 3
+    calls_number = max(3, page_number // 2)
+
+    prompt = (
+        f"Действуй как специалист в области {science_name}. "
+        f"Составь подробный план из {calls_number} пунктов для {work_type} "
+        f"по теме: {work_theme}. Учти предпочтения: {preferences}. "
+        "ОБЯЗАТЕЛЬНО включи в план:\n"
+        "1. 'Введение' (первый пункт)\n"
+        f"2-{calls_number-1}. Основные разделы (содержательные названия глав)\n"
+        f"{calls_number}. 'Заключение' (последний пункт)\n\n"
+        "Верни ТОЛЬКО нумерованный список без дополнительных комментариев:\n"
+        "1. Введение\n"
+        "2. [Название раздела 1]\n"
+        "3. [Название раздела 2]\n"
+        f"{calls_number}. Заключение"
+    )
+
+    try:
+        async with generation_scheduler.slot(user_data.get("generation_lane", "paid")):
+            response = await llm_complete(
+                "plan",
+                model=settings.get("PLAN_MODEL"),
+                messages=[
+                    {"role": "system", "content": "mode: plan_generation"},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=False
+            )
+        response_content = response.choices[0].message.content
+    except Exception as e:
+        logging.error(f"Ошибка при вызове DeepSeek API: {e}")
+        await send_notice(notify, "Произошла ошибка при генерации плана. Пожалуйста, попробуйте позже.")
+        return []
+
+    logging.info("Ответ от DeepSeek API получен.")
+
+    try:
+        plan_array = json.loads(response_content)
+        if not isinstance(plan_array, list):
+            raise ValueError("Ответ не является массивом.")
+    except (json.JSONDecodeError, ValueError):
+        logging.info("Ответ не в формате JSON, обрабатываем как текст.")
+        lines = response_content.splitlines()
+        plan_array = [line.strip() for line in lines if line.strip()]
+        # Удаляем нумерацию и очищаем
+        plan_array = [re.sub(r'^\d+\.\s*', '', item).strip() for item in plan_array if item.strip()]
+        # Фильтруем пустые строки и мусор
+        plan_array = [item for item in plan_array if item and len(item) > 2]
+
+    # Проверяем и дополняем план
+    if len(plan_array) < calls_number:
+        # Если план слишком короткий, дополняем
+        needed = calls_number - len(plan_array)
+        for i in range(needed):
+            plan_array.insert(len(plan_array), f"Раздел {len(plan_array)}")
+    elif len(plan_array) > calls_number:
+        # Если план слишком длинный, обрезаем
+        plan_array = plan_array[:calls_number]
+    
+    # Удаляем эмодзи из всех элементов плана
+    plan_array = [remove_emojis(item) for item in plan_array]
+    
+    # Гарантируем наличие Введения и Заключения
+    if plan_array and not any(keyword in plan_array[0].lower() for keyword in ['введение', 'introduction']):
+        plan_array[0] = 'Введение'
+    
+    if plan_array and not any(keyword in plan_array[-1].lower() for keyword in ['заключение', 'conclusion', 'выводы']):
+        plan_array[-1] = 'Заключение'
+    
+    # Если план пустой или слишком короткий, создаем минимальный план
+    if not plan_array or len(plan_array) < 3:
+        logging.warning("План от DeepSeek некорректен, создаем базовый план")
+        plan_array = ['Введение']
+        for i in range(calls_number - 2):
+            plan_array.append(f'Глава {i+1}')
+        plan_array.append('Заключение')
+
+    logging.info(f"Итоговый план: {plan_array}")
+    if order_id:
+        save_order_plan(order_id, plan_array)
+    return plan_array
+
+async def generate_chapters(plan_array, user_data: dict) -> list:
+    """Генерирует тексты глав плана (готовые главы берутся из чекпоинтов)
+    
+    Returns:
+        Список пар (название главы, текст) в порядке плана
+    
+    Raises:
+        RuntimeError: если план пуст или какую-то главу сгенерировать не удалось
+    """
+    logging.info("Начало генерации текста по главам плана.")
+    science_name = user_data["science_name"]
+    work_type = user_data["work_type"]
+    work_theme = user_data["work_theme"]
+    preferences = user_data["preferences"]
+    page_number = user_data.get("page_number", 0)
+
+    if not plan_array:
+        raise RuntimeError("План пуст. Невозможно сгенерировать текст.")
+
+    # Рассчитываем количество слов на главу на основе заявленного количества страниц
+    # Примерно 250-300 слов на страницу, распределяем равномерно между главами
+    total_words = page_number * 275  # Среднее количество слов на страницу
+    words_per_chapter = total_words // len(plan_array)  # Распределяем слова между главами
+    
+    # Для очень маленьких работ (1-2 страницы) минимум 200 слов на главу
+    # Для средних работ (3-5 страниц) минимум 300 слов
+    # Для больших работ (6+ страниц) минимум 400 слов
+    if page_number <= 2:
+        words_per_chapter = max(200, words_per_chapter)
+    elif page_number <= 5:
+        words_per_chapter = max(300, words_per_chapter)
+    else:
+        words_per_chapter = max(400, words_per_chapter)
+    
+    logging.info(f"Запрошено страниц: {page_number}, глав в плане: {len(plan_array)}, слов на главу: {words_per_chapter}")
+
+    # === УМНОЕ РАСПРЕДЕЛЕНИЕ ПОЖЕЛАНИЙ ПО ГЛАВАМ ===
+    parsed_preferences = parse_preferences_by_chapter(preferences, plan_array)
+    global_preferences = parsed_preferences['global']
+    chapter_preferences = parsed_preferences['by_chapter']
+
+    # Уже сгенерированные главы заказа (после сбоя генерируются только недостающие)
+    order_id = user_data.get("order_id")
+    checkpoints = load_chapter_checkpoints(order_id) if order_id else {}
+
+    # Функция для выполнения одного запроса к API
+    async def fetch_chapter_text(position: int, chapter: str) -> tuple[str, str]:
+        saved = checkpoints.get(position)
+        if saved and saved[0] == chapter and is_valid_chapter_text(saved[1]):
+            logging.info(f"Глава {position} заказа {order_id} взята из чекпоинта: {chapter}")
+            return chapter, saved[1]
+        
+        logging.info(f"Генерация текста для главы: {chapter}")
+        
+        # Определяем пожелания для этой конкретной главы
+        chapter_specific = chapter_preferences.get(chapter, '')
+        
+        # Комбинируем общие и специфичные пожелания
+        if chapter_specific and global_preferences:
+            combined_preferences = f"{global_preferences}. {chapter_specific}"
+        elif chapter_specific:
+            combined_preferences = chapter_specific
+        elif global_preferences:
+            combined_preferences = global_preferences
+        else:
+            combined_preferences = preferences  # Используем оригинальные, если парсинг не дал результата
+        
+        prompt = (
+            f"Действуй как специалист в области {science_name}, "
+            f"напиши, строго с опорой на авторитетные источники, "
+            f"главу: {chapter} в контексте написания {work_type} "
+            f"по теме: {work_theme} (напиши не менее {words_per_chapter} слов) "
+            f"(Напиши текст, в котором предложения будут иметь разную длину, "
+            f"а также будет избегаться нахождение однокоренных слов "
+            f"в соседних предложениях) "
+            f"(избегай комментариев, анализа соблюденных тобою требований, "
+            f"возвращай исключительно текст, так, будто бы ты отправляешь "
+            f"его на проверку преподавателю) "
+            f"НЕ используй вводные фразы типа 'Отлично', 'Вот текст', 'Рассмотрим'. "
+            f"Начинай сразу с основного содержания. {combined_preferences}"
+        )
+        # Выполняем запрос к DeepSeek под контролем семафора и обрабатываем ошибки
+        last_error = None
+        for attempt in range(1, CHAPTER_ATTEMPTS + 1):
+            try:
+                async with generation_scheduler.slot(user_data.get("generation_lane", "paid")):
+                    response = await llm_complete(
+                        "chapter",
+                        model=settings.get("CHAPTER_MODEL"),
+                        messages=[{"role": "user", "content": prompt}],
+                        stream=False
+                    )
+                chapter_text = response.choices[0].message.content
+                # Валидируем и очищаем сгенерированный контент
+                chapter_text = validate_generated_content(chapter_text, chapter)
+                logging.info(f"Сгенерирован текст для главы: {chapter_text[:100]}...")
+                if order_id:
+                    save_chapter_checkpoint(order_id, position, chapter, chapter_text)
+                return chapter, chapter_text
+            except Exception as e:
+                last_error = e
+                logging.error(f"Ошибка при генерации текста для главы {chapter} (попытка {attempt}): {e}")
+        # Глава не сохраняется: при повторной попытке заказа она будет сгенерирована заново
+        raise RuntimeError(f"Не удалось сгенерировать главу {chapter}: {last_error}")
+
+    # Создание списка задач для параллельного выполнения
+    tasks = [fetch_chapter_text(position, chapter) for position, chapter in enumerate(plan_array)]
+    # Параллельное выполнение запросов
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Проверка результатов
+    chapters_text = []
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка в задаче: {result}")
+            if order_id:
+                done = sum(1 for r in results if not isinstance(r, Exception))
+                logging.info(f"Заказ {order_id}: сохранено {done} из {len(plan_array)} глав, "
+                             f"повтор сгенерирует только недостающие")
+            raise result
+        chapters_text.append(result)
+
+    # Сохраняем промежуточный результат (тексты глав) вместе с заказом
+    if order_id:
+        try:
+            chapters_json = json.dumps(
+                [{"chapter": chapter, "text": text} for chapter, text in chapters_text],
+                ensure_ascii=False
+            ).encode("utf-8")
+            await save_order_artifact(order_id, "chapters", chapters_json, f"order_{order_id}_chapters.json")
+        except Exception as e:
+            logging.error(f"Не удалось сохранить главы заказа {order_id}: {e}")
+    
+    return chapters_text
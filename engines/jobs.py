@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Очередь заданий на выполнение заказов
+
+Бот ставит задание в таблицу order_jobs (для оплаченного заказа — в одной
+транзакции со сменой статуса), а выполняют его потребители очереди: цикл
+в процессе бота или отдельные воркеры (worker.py), в том числе на других
+машинах с общей базой. Задание захватывается условным UPDATE, поэтому его
+получает ровно один потребитель. Пока задание выполняется, аренда
+продлевается; задание упавшего воркера после окончания аренды забирает
+другой, а готовые главы берутся из чекпоинтов. Если задание так и не
+выполнено, заказ помечается неудачным в той же транзакции, а за
+оплаченный заказ ставится возврат платежа.
+"""
+
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import func, or_, and_
+
+from priority_scheduler import LANES
+from engines import metrics
+from payment_gateway import idempotence_key
+from engines.storage import SessionLocal, Order, OrderJob, OutboxMessage, outbox_message, notify_message
+
+# Аренда задания: потребитель продлевает её, пока выполняет задание
+JOB_LEASE_SECONDS = int(os.getenv("ORDER_JOB_LEASE_SECONDS", "120"))
+JOB_POLL_INTERVAL = 1  # секунды между проверками очереди, когда заданий нет
+# Сколько раз задание можно начать заново после падения потребителя
+JOB_MAX_ATTEMPTS = 3
+# Статус заказа, задание которого завершилось неудачей (как при ошибке в bot.run_order_job)
+JOB_FAILED_ORDER_STATUS = {"paid": "failed", "test_mode": "failed", "test": "test_failed"}
+# Заказы в этих статусах неудача задания не меняет: работа готова или платёж уже возвращён
+SETTLED_ORDER_STATUSES = ("completed", "test_completed", "delivery_failed", "refunded")
+
+order_jobs_total = metrics.counter(
+    "order_jobs_total", "Задания на выполнение заказов по результату", ("kind", "result")
+)
+
+
+def consumer_id(role: str) -> str:
+    """Идентификатор потребителя для order_jobs.worker_id: роль, хост и pid"""
+    return f"{role}@{socket.gethostname()}:{os.getpid()}"
+
+
+def order_job(order_id: int, kind: str, lane: str, payload: dict = None) -> OrderJob:
+    """Задание для сохранения в транзакции со сменой статуса заказа (transition_order_status)"""
+    return OrderJob(
+        order_id=order_id,
+        kind=kind,
+        lane=lane,
+        priority=LANES.index(lane),
+        payload=json.dumps(payload or {}, ensure_ascii=False),
+        status="queued",
+        attempts=0
+    )
+
+
+def enqueue_order_job(order_id: int, kind: str, lane: str, payload: dict = None) -> int:
+    """Ставит задание в очередь; возвращает его id"""
+    session = SessionLocal()
+    try:
+        job = order_job(order_id, kind, lane, payload)
+        session.add(job)
+        session.commit()
+        logging.info(f"Задание {job.id} ({kind}) для заказа {order_id} поставлено в очередь")
+        return job.id
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка постановки задания для заказа {order_id}: {e}")
+        raise
+    finally:
+        session.close()
+
+
+def fail_job_order(session, order_id: int, kind: str, payload: dict) -> str:
+    """
+    Помечает заказ неудачного задания в транзакции session
+
+    За оплаченный заказ, как в bot.run_paid_order, в outbox ставятся возврат
+    платежа и уведомление пользователя; повторно они не добавляются.
+
+    Returns:
+        Что сделано с заказом (для журнала)
+    """
+    order = session.query(Order).filter(Order.id == order_id).first()
+    if order is None:
+        return "заказ не найден"
+    if order.status in SETTLED_ORDER_STATUSES:
+        return f"заказ уже в статусе {order.status}"
+    if kind == "resume":
+        # /admin_resume возобновляет и тестовые, и оплаченные заказы
+        status = "test_failed" if (order.status or "").startswith("test_") else "failed"
+    else:
+        status = JOB_FAILED_ORDER_STATUS.get(kind, "failed")
+    order.status = status
+    if kind != "paid":
+        return f"заказ переведён в {status}"
+
+    payment_id = payload.get("payment_id") or order.payment_id
+    messages = [notify_message(
+        order_id, order.user_id, "❌ Произошла ошибка при генерации. Оформляем возврат платежа.", "generation_failed"
+    )]
+    if payment_id:
+        amount = payload.get("amount")
+        amount_value = f"{float(order.price):.2f}" if order.price is not None else amount
+        messages.append(outbox_message("refund", order_id, {
+            "payment_id": payment_id,
+            "amount": {"value": amount_value, "currency": "RUB"},
+            "chat_id": int(order.user_id),
+        }, idempotence_key("refund", payment_id)))
+    keys = [message.idempotence_key for message in messages]
+    existing = {
+        key for (key,) in session.query(OutboxMessage.idempotence_key).filter(
+            OutboxMessage.idempotence_key.in_(keys)
+        ).all()
+    }
+    session.add_all([message for message in messages if message.idempotence_key not in existing])
+    if not payment_id:
+        return f"заказ переведён в {status}, платёж для возврата не найден"
+    return f"заказ переведён в {status}, возврат платежа {payment_id} поставлен в очередь"
+
+
+def claim_order_job(worker_id: str, lanes: list):
+    """
+    Захватывает первое по приоритету задание из указанных полос
+
+    Задания с истёкшей арендой (потребитель упал) захватываются заново, пока
+    не исчерпан JOB_MAX_ATTEMPTS, после этого помечаются failed вместе
+    с заказом (fail_job_order).
+
+    Returns:
+        Словарь с полями задания или None, если заданий нет
+    """
+    if not lanes:
+        return None
+    now = time.time()
+    session = SessionLocal()
+    try:
+        abandoned = and_(OrderJob.status == "running", OrderJob.lease_until < now)
+        exhausted = session.query(OrderJob).filter(abandoned, OrderJob.attempts >= JOB_MAX_ATTEMPTS).all()
+        for job in exhausted:
+            # Условный UPDATE: задание, которое уже закрыл другой потребитель, пропускается
+            failed = session.query(OrderJob).filter(OrderJob.id == job.id, abandoned).update({
+                "status": "failed",
+                "last_error": "Потребитель не завершил задание за отведённые попытки",
+                "finished_at": datetime.now(timezone.utc)
+            }, synchronize_session=False)
+            if failed:
+                outcome = fail_job_order(session, job.order_id, job.kind, json.loads(job.payload or "{}"))
+                session.commit()
+                order_jobs_total.inc(kind=job.kind, result="failed")
+                logging.error(
+                    f"Задание {job.id} ({job.kind}) брошено после {JOB_MAX_ATTEMPTS} попыток: "
+                    f"заказ {job.order_id} — {outcome}"
+                )
+
+        claimable = or_(OrderJob.status == "queued", abandoned)
+        candidates = session.query(OrderJob.id).filter(
+            OrderJob.lane.in_(lanes), claimable
+        ).order_by(OrderJob.priority, OrderJob.id).limit(5).all()
+        for (job_id,) in candidates:
+            # Условный UPDATE: если задание уже забрал другой потребитель, строка не изменится
+            claimed = session.query(OrderJob).filter(OrderJob.id == job_id, claimable).update({
+                "status": "running",
+                "worker_id": worker_id,
+                "lease_until": now + JOB_LEASE_SECONDS,
+                "attempts": OrderJob.attempts + 1
+            }, synchronize_session=False)
+            session.commit()
+            if claimed:
+                job = session.query(OrderJob).filter(OrderJob.id == job_id).first()
+                return {
+                    "id": job.id,
+                    "order_id": job.order_id,
+                    "kind": job.kind,
+                    "lane": job.lane,
+                    "payload": json.loads(job.payload or "{}"),
+                    "attempts": job.attempts,
+                }
+        return None
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def update_order_job(job_id: int, worker_id: str, values: dict) -> bool:
+    """Меняет задание, только если оно всё ещё захвачено этим потребителем"""
+    session = SessionLocal()
+    try:
+        updated = session.query(OrderJob).filter(
+            OrderJob.id == job_id,
+            OrderJob.worker_id == worker_id,
+            OrderJob.status == "running"
+        ).update(values, synchronize_session=False)
+        session.commit()
+        return bool(updated)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def fail_claimed_job(job: dict, worker_id: str, error: str):
+    """
+    Помечает захваченное задание и его заказ неудачными одной транзакцией
+
+    Returns:
+        Что сделано с заказом или None, если задание уже не захвачено этим потребителем
+    """
+    session = SessionLocal()
+    try:
+        failed = session.query(OrderJob).filter(
+            OrderJob.id == job["id"],
+            OrderJob.worker_id == worker_id,
+            OrderJob.status == "running"
+        ).update({
+            "status": "failed", "last_error": error[:1000], "finished_at": datetime.now(timezone.utc)
+        }, synchronize_session=False)
+        if not failed:
+            session.rollback()
+            return None
+        outcome = fail_job_order(session, job["order_id"], job["kind"], job["payload"])
+        session.commit()
+        return outcome
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def order_job_counts() -> dict:
+    """Количество заданий по статусам"""
+    session = SessionLocal()
+    try:
+        return dict(session.query(OrderJob.status, func.count(OrderJob.id)).group_by(OrderJob.status).all())
+    finally:
+        session.close()
+
+
+metrics.gauge("order_jobs", "Задания на выполнение заказов по статусам", ("status",)).set_function(lambda: [
+    ({"status": status}, count) for status, count in order_job_counts().items() if status in ("queued", "running")
+])
+
+
+async def keep_lease(job_id: int, worker_id: str) -> None:
+    """Продлевает аренду задания, пока оно выполняется"""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            if not update_order_job(job_id, worker_id, {"lease_until": time.time() + JOB_LEASE_SECONDS}):
+                logging.warning(f"Задание {job_id} больше не захвачено потребителем {worker_id}")
+                return
+        except Exception as e:
+            logging.error(f"Ошибка продления аренды задания {job_id}: {e}")
+
+
+async def run_claimed_job(run_job, job: dict, worker_id: str, scheduler) -> None:
+    """Выполняет захваченное задание в занятом слоте планировщика"""
+    heartbeat = asyncio.create_task(keep_lease(job["id"], worker_id))
+    try:
+        await run_job(job)
+    except asyncio.CancelledError:
+        # Потребитель останавливается: задание сразу возвращается в очередь, попытка не засчитывается
+        update_order_job(job["id"], worker_id, {
+            "status": "queued", "worker_id": None, "lease_until": None, "attempts": OrderJob.attempts - 1
+        })
+        logging.info(f"Задание {job['id']} возвращено в очередь")
+        order_jobs_total.inc(kind=job["kind"], result="released")
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка задания {job['id']} ({job['kind']}) для заказа {job['order_id']}: {e}")
+        try:
+            outcome = fail_claimed_job(job, worker_id, str(e))
+        except Exception as fail_error:
+            logging.error(f"Не удалось отметить неудачу задания {job['id']}: {fail_error}")
+        else:
+            if outcome is not None:
+                logging.error(f"Задание {job['id']} не выполнено: заказ {job['order_id']} — {outcome}")
+        order_jobs_total.inc(kind=job["kind"], result="failed")
+    else:
+        update_order_job(job["id"], worker_id, {"status": "done", "finished_at": datetime.now(timezone.utc)})
+        order_jobs_total.inc(kind=job["kind"], result="done")
+    finally:
+        heartbeat.cancel()
+        scheduler.release(job["lane"])
+
+
+async def consume_order_jobs(run_job, worker_id: str, scheduler, poll_interval: float = JOB_POLL_INTERVAL) -> None:
+    """
+    Цикл потребителя очереди заданий
+
+    Задания захватываются, только пока в полосах планировщика есть свободные
+    слоты, поэтому каждый потребитель берёт не больше своей ёмкости, а
+    остальное достаётся другим. При отмене цикла выполняемые задания
+    прерываются и возвращаются в очередь.
+
+    Args:
+        run_job: Корутина (job), выполняющая задание
+        worker_id: Идентификатор потребителя (хост и pid)
+        scheduler: PriorityScheduler с ёмкостью и лимитами полос потребителя
+    """
+    running = set()
+    logging.info(f"Потребитель заданий {worker_id} запущен, ёмкость {scheduler.capacity}")
+    try:
+        while True:
+            lanes = [lane for lane in scheduler.lanes if scheduler.can_start(lane)]
+            try:
+                job = claim_order_job(worker_id, lanes)
+            except Exception as e:
+                logging.error(f"Ошибка получения задания: {e}")
+                job = None
+            if job is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            logging.info(f"Задание {job['id']} ({job['kind']}) заказа {job['order_id']} захвачено {worker_id}")
+            await scheduler.acquire(job["lane"])
+            task = asyncio.create_task(run_claimed_job(run_job, job, worker_id, scheduler))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
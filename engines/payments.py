@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Платежи YooKassa: создание платежа, поиск заказа по платежу и возвраты
+
+Вызовы SDK идут через payment_gateway (отдельный пул потоков с таймаутом),
+SDK импортируется при первом вызове. Учётные данные магазина передаются
+в SDK функцией configure_yookassa() при запуске бота.
+"""
+
+import os
+import logging
+
+from sqlalchemy.exc import IntegrityError
+
+from payment_gateway import PaymentGateway, idempotence_key
+from engines import metrics
+from engines.storage import SessionLocal, Order, outbox_message, notify_message, PermanentOutboxError
+
+# Значения по умолчанию для YooKassa удалены для безопасности
+YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
+YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+
+# Вызовы SDK YooKassa блокирующие — выполняем их в отдельном пуле потоков
+YOOKASSA_MAX_WORKERS = int(os.getenv("YOOKASSA_MAX_WORKERS", "4"))
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "15"))
+payment_gateway = PaymentGateway(max_workers=YOOKASSA_MAX_WORKERS, timeout=YOOKASSA_TIMEOUT)
+
+def configure_yookassa() -> None:
+    """Передаёт учётные данные магазина в SDK YooKassa"""
+    from yookassa import Configuration
+    Configuration.account_id = YOOKASSA_SHOP_ID or ""
+    Configuration.secret_key = YOOKASSA_SECRET_KEY or ""
+
+def payment_gateway_samples(field: str, **labels):
+    return [({"operation": operation, **labels}, stats[field]) for operation, stats in payment_gateway.stats().items()]
+
+metrics.counter("yookassa_calls_total", "Вызовы YooKassa", ("operation",)).set_function(
+    lambda: payment_gateway_samples("calls")
+)
+metrics.counter("yookassa_errors_total", "Ошибки и таймауты вызовов YooKassa", ("operation", "kind")).set_function(
+    lambda: payment_gateway_samples("errors", kind="error") + payment_gateway_samples("timeouts", kind="timeout")
+)
+metrics.gauge("yookassa_latency_seconds", "Задержка YooKassa по последним вызовам", ("operation", "stat")).set_function(
+    lambda: payment_gateway_samples("avg_latency", stat="avg") + payment_gateway_samples("max_latency", stat="max")
+)
+
+def payment_request(order_id: int, user_id: int, price: int, work_type: str, work_theme: str) -> dict:
+    """Параметры платежа YooKassa за заказ (с чеком на услугу)"""
+    return {
+        "amount": {"value": f"{price}.00", "currency": "RUB"},
+        "confirmation": {"type": "redirect", "return_url": "https://t.me/NinjaEssayAI_bot"},
+        "capture": True,
+        "description": f"{work_type} - {work_theme}",
+        "metadata": {"order_id": str(order_id)},
+        "receipt": {
+            "customer": {
+                "email": f"user{user_id}@ninjaessayai.com"
+            },
+            "items": [
+                {
+                    "description": f"Написание работы: {work_type}",
+                    "quantity": "1.00",
+                    "amount": {
+                        "value": f"{price}.00",
+                        "currency": "RUB"
+                    },
+                    "vat_code": 1,
+                    "payment_mode": "full_payment",
+                    "payment_subject": "service"
+                }
+            ]
+        }
+    }
+
+def find_order_by_payment(payment):
+    """Находит заказ по ID платежа или по order_id из метаданных платежа"""
+    session = SessionLocal()
+    try:
+        order = session.query(Order).filter(Order.payment_id == payment.id).first()
+        if order is None:
+            metadata = getattr(payment, "metadata", None) or {}
+            order_id = metadata.get("order_id") if isinstance(metadata, dict) else None
+            if order_id and str(order_id).isdigit():
+                order = session.query(Order).filter(Order.id == int(order_id)).first()
+        return order
+    finally:
+        session.close()
+
+def schedule_refund(order_id: int, payment_id: str, amount_value: str, chat_id: int) -> bool:
+    """Помечает заказ неудачным и ставит возврат платежа в outbox
+    
+    Returns:
+        True, если возврат поставлен (False — он уже был поставлен ранее)
+    """
+    session = SessionLocal()
+    try:
+        session.query(Order).filter(Order.id == order_id).update(
+            {"status": "failed"}, synchronize_session=False
+        )
+        session.add(outbox_message("refund", order_id, {
+            "payment_id": payment_id,
+            "amount": {"value": amount_value, "currency": "RUB"},
+            "chat_id": chat_id,
+        }, idempotence_key("refund", payment_id)))
+        session.commit()
+        logging.info(f"Возврат платежа {payment_id} по заказу {order_id} поставлен в очередь")
+        return True
+    except IntegrityError:
+        session.rollback()
+        logging.info(f"Возврат платежа {payment_id} уже поставлен в очередь")
+        return False
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка постановки возврата по заказу {order_id}: {e}")
+        raise
+    finally:
+        session.close()
+
+async def execute_refund(order_id: int, payload: dict, key: str) -> list:
+    """Выполняет возврат и возвращает сообщения outbox для завершающей транзакции"""
+    refund = await payment_gateway.create_refund(
+        {"payment_id": payload["payment_id"], "amount": payload["amount"]}, key
+    )
+    if getattr(refund, "status", None) == "canceled":
+        # Повтор с тем же ключом вернёт тот же отклонённый возврат
+        raise PermanentOutboxError("YooKassa отклонила возврат")
+    logging.info(f"Возврат по заказу {order_id} создан: {refund.id} ({refund.status})")
+    return [notify_message(order_id, payload["chat_id"], "💸 Платеж возвращён.", "refunded")]
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сборка документа .docx по плану, текстам глав и источникам
+
+Оформление по требованиям к учебным работам: титульный лист, оглавление,
+нумерация страниц со второй, главы и список источников по ГОСТ.
+python-docx импортируется при первой сборке документа.
+"""
+
+import io
+import re
+import logging
+from datetime import datetime
+
+from source_enrichment import classify_source
+from text_cleaning import remove_theme_emojis, remove_chapter_title_from_text
+
+# Заголовки страниц диссертаций: «Диссертация на тему «…» … по специальности ВАК РФ 08.00.05»
+DISSERTATION_TITLE = re.compile(r"^(?:диссертация|автореферат(?: диссертации)?)\s+на\s+тему\s*[«\"](.+?)[»\"]", re.IGNORECASE)
+SPECIALTY_CODE = re.compile(r"\b\d{1,2}\.\d{1,2}\.\d{1,2}\b")
+
+def source_imprint(source: dict) -> str:
+    """Выходные данные «Город : Издательство, год» из известных полей источника"""
+    place = " : ".join(part for part in (source.get("city"), source.get("publisher")) if part)
+    return ", ".join(str(part) for part in (place, source.get("year")) if part)
+
+def dissertation_description(source: dict, title: str) -> str:
+    """Название и сведения о диссертации: «Название : дис. ... канд. наук : 08.00.05»"""
+    kind = "автореф. дис." if title.lower().startswith("автореферат") else "дис."
+    match = DISSERTATION_TITLE.match(title)
+    name = match.group(1).strip() if match else title
+    degree = source.get("degree") or ("д-ра наук" if "доктор" in title.lower() else "канд. наук")
+    specialty = SPECIALTY_CODE.search(title)
+    return f"{name} : {kind} ... {degree}" + (f" : {specialty.group(0)}" if specialty else "")
+
+def format_source_gost(source: dict, index: int) -> str:
+    """
+    Оформляет источник по ГОСТу
+    
+    Args:
+        source: Словарь с ключами 'title' и 'url', после обогащения также
+            'type', 'accessed', 'doi', 'authors', 'journal', 'year'
+        index: Номер источника в списке
+    
+    Returns:
+        Строка с оформленным источником
+    """
+    title = source.get("title", "Без названия")
+    url = source.get("url", "")
+    source_type = source.get("type") or classify_source(source)
+    accessed = source.get("accessed") or datetime.now().strftime('%d.%m.%Y')
+    
+    # Базовое оформление по ГОСТ 7.0.5-2008
+    # Для электронных ресурсов
+    if url:
+        if source_type == "article" and source.get("journal"):
+            # Научная статья с известными метаданными (Crossref)
+            authors = f"{source['authors']} " if source.get("authors") else ""
+            year = f" – {source['year']}." if source.get("year") else ""
+            doi = f" – DOI: {source['doi']}." if source.get("doi") else ""
+            formatted = f"{index}. {authors}{title} // {source['journal']}.{year}{doi} – URL: {url} (дата обращения: {accessed})."
+        elif source_type == "wikipedia":
+            # Википедия
+            formatted = f"{index}. {title} // Википедия [Электронный ресурс]. – URL: {url} (дата обращения: {accessed})."
+        elif source_type == "legal":
+            # Нормативный правовой акт
+            formatted = f"{index}. {title} [Электронный ресурс] // Официальный интернет-ресурс. – URL: {url} (дата обращения: {accessed})."
+        elif source_type == "book":
+            # Книга: Автор. Название. – Город : Издательство, год.
+            authors = f"{source['authors'].rstrip('.')}. " if source.get("authors") else ""
+            imprint = f" – {source_imprint(source)}." if source_imprint(source) else ""
+            formatted = f"{index}. {authors}{title} [Электронный ресурс].{imprint} – URL: {url} (дата обращения: {accessed})."
+        elif source_type == "dissertation":
+            # Диссертация: Автор. Название : дис. ... канд. наук : шифр. – Город, год.
+            authors = f"{source['authors'].rstrip('.')}. " if source.get("authors") else ""
+            place = ", ".join(str(part) for part in (source.get("city"), source.get("year")) if part)
+            imprint = f" – {place}." if place else ""
+            formatted = (f"{index}. {authors}{dissertation_description(source, title)} [Электронный ресурс].{imprint}"
+                         f" – URL: {url} (дата обращения: {accessed}).")
+        elif source_type == "document":
+            # Документ в формате PDF
+            formatted = f"{index}. {title} [Электронный ресурс]. – Текст : электронный. – URL: {url} (дата обращения: {accessed})."
+        else:
+            # Статья без метаданных или обычный веб-ресурс
+            formatted = f"{index}. {title} [Электронный ресурс]. – URL: {url} (дата обращения: {accessed})."
+    else:
+        # Если URL отсутствует
+        formatted = f"{index}. {title}."
+    
+    return formatted
+
+# Функция для добавления нумерации страниц
+def add_page_number(section, start_number=1):
+    """Добавляет нумерацию страниц в раздел документа
+    
+    Args:
+        section: Раздел документа
+        start_number: Начальный номер страницы (по умолчанию 1)
+    """
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    
+    footer = section.footer
+    footer_paragraph = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
+    footer_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    run = footer_paragraph.add_run()
+    
+    # Устанавливаем начальный номер страницы для раздела
+    if start_number > 1:
+        sectPr = section._sectPr
+        pgNumType = sectPr.find(qn('w:pgNumType'))
+        if pgNumType is None:
+            pgNumType = OxmlElement('w:pgNumType')
+            sectPr.insert(0, pgNumType)
+        pgNumType.set(qn('w:start'), str(start_number))
+    
+    fldChar1 = OxmlElement('w:fldChar')
+    fldChar1.set(qn('w:fldCharType'), 'begin')
+    run._r.append(fldChar1)
+    instrText = OxmlElement('w:instrText')
+    instrText.text = 'PAGE'
+    run._r.append(instrText)
+    fldChar2 = OxmlElement('w:fldChar')
+    fldChar2.set(qn('w:fldCharType'), 'end')
+    run._r.append(fldChar2)
+
+# Функция для добавления титульного листа
+def add_title_page(doc, work_type, work_theme, science_name, page_number):
+    """Добавляет титульный лист в документ"""
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.shared import Pt
+    
+    # Очищаем тему от смайликов
+    work_theme = remove_theme_emojis(work_theme)
+    
+    # Название учебного заведения
+    university_p = doc.add_paragraph()
+    university_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    university_run = university_p.add_run("МИНИСТЕРСТВО ОБРАЗОВАНИЯ И НАУКИ РОССИЙСКОЙ ФЕДЕРАЦИИ\n")
+    university_run.font.name = 'Times New Roman'
+    university_run.font.size = Pt(14)
+    university_run.font.bold = True
+    
+    university_run2 = university_p.add_run("ФЕДЕРАЛЬНОЕ ГОСУДАРСТВЕННОЕ БЮДЖЕТНОЕ ОБРАЗОВАТЕЛЬНОЕ УЧРЕЖДЕНИЕ\n")
+    university_run2.font.name = 'Times New Roman'
+    university_run2.font.size = Pt(14)
+    university_run2.font.bold = True
+    
+    university_run3 = university_p.add_run("ВЫСШЕГО ОБРАЗОВАНИЯ\n")
+    university_run3.font.name = 'Times New Roman'
+    university_run3.font.size = Pt(14)
+    university_run3.font.bold = True
+    
+    university_run4 = university_p.add_run("«РОССИЙСКИЙ УНИВЕРСИТЕТ»")
+    university_run4.font.name = 'Times New Roman'
+    university_run4.font.size = Pt(14)
+    university_run4.font.bold = True
+    
+    # Добавляем отступ
+    doc.add_paragraph()
+    doc.add_paragraph()
+    doc.add_paragraph()
+    
+    # Кафедра
+    department_p = doc.add_paragraph()
+    department_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    department_run = department_p.add_run(f"Кафедра {science_name}")
+    department_run.font.name = 'Times New Roman'
+    department_run.font.size = Pt(14)
+    
+    # Добавляем отступ
+    doc.add_paragraph()
+    doc.add_paragraph()
+    
+    # Тип работы
+    work_type_p = doc.add_paragraph()
+    work_type_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    work_type_run = work_type_p.add_run(work_type.upper())
+    work_type_run.font.name = 'Times New Roman'
+    work_type_run.font.size = Pt(16)
+    work_type_run.font.bold = True
+    
+    # Добавляем отступ
+    doc.add_paragraph()
+    
+    # Тема работы
+    theme_p = doc.add_paragraph()
+    theme_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    theme_run = theme_p.add_run(f"на тему: «{work_theme}»")
+    theme_run.font.name = 'Times New Roman'
+    theme_run.font.size = Pt(14)
+    theme_run.font.bold = True
+    
+    # Добавляем отступ
+    doc.add_paragraph()
+    doc.add_paragraph()
+    doc.add_paragraph()
+    doc.add_paragraph()
+    
+    # Информация о студенте и преподавателе (справа)
+    info_table = doc.add_table(rows=6, cols=2)
+    info_table.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    
+    # Настраиваем таблицу
+    for row in info_table.rows:
+        for cell in row.cells:
+            for paragraph in cell.paragraphs:
+                paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    
+    # Заполняем таблицу
+    info_table.cell(0, 0).text = "Дисциплина:"
+    info_table.cell(0, 1).text = science_name
+    
+    info_table.cell(1, 0).text = "Выполнил(а):"
+    info_table.cell(1, 1).text = "студент(ка) группы ___________"
+    
+    info_table.cell(2, 0).text = ""
+    info_table.cell(2, 1).text = "_________________________"
+    
+    info_table.cell(3, 0).text = "Проверил:"
+    info_table.cell(3, 1).text = "_________________________"
+    
+    info_table.cell(4, 0).text = ""
+    info_table.cell(4, 1).text = "(должность, ученая степень, звание)"
+    
+    info_table.cell(5, 0).text = ""
+    info_table.cell(5, 1).text = "_________________________"
+    
+    # Настраиваем шрифт в таблице
+    for row in info_table.rows:
+        for cell in row.cells:
+            for paragraph in cell.paragraphs:
+                for run in paragraph.runs:
+                    run.font.name = 'Times New Roman'
+                    run.font.size = Pt(12)
+    
+    # Добавляем отступ
+    doc.add_paragraph()
+    doc.add_paragraph()
+    doc.add_paragraph()
+    
+    # Год и город
+    footer_p = doc.add_paragraph()
+    footer_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    footer_run = footer_p.add_run("Москва 2025")
+    footer_run.font.name = 'Times New Roman'
+    footer_run.font.size = Pt(14)
+
+def render_document(plan_array, chapters_text: list, sources: list, user_data: dict) -> bytes:
+    """Собирает документ .docx: титульный лист, оглавление, главы и список источников
+    
+    Функция синхронная и принимает только простые данные, поэтому её можно
+    выполнять в отдельном потоке или в пуле процессов.
+    
+    Args:
+        plan_array: Пункты плана
+        chapters_text: Пары (название главы, текст) в порядке плана
+        sources: Источники для списка литературы
+        user_data: Параметры заказа (work_type, science_name, work_theme, page_number)
+    
+    Returns:
+        Содержимое файла .docx
+    """
+    import docx
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.shared import Pt, Cm, RGBColor
+    
+    science_name = user_data["science_name"]
+    work_type = user_data["work_type"]
+    work_theme = user_data["work_theme"]
+
+    # Создание документа в памяти
+    doc = docx.Document()
+    
+    # === ТИТУЛЬНЫЙ ЛИСТ (без нумерации) ===
+    title_section = doc.sections[0]
+    # Настройка полей по требованиям: верх/низ 25мм, лево 30мм, право 10мм
+    title_section.top_margin = Cm(2.5)     # 25 мм
+    title_section.bottom_margin = Cm(2.5)  # 25 мм
+    title_section.left_margin = Cm(3.0)    # 30 мм
+    title_section.right_margin = Cm(1.0)   # 10 мм
+    
+    # Отключаем нумерацию на титульном листе
+    title_section.different_first_page_header_footer = True
+
+    # Установка стиля текста для всего документа
+    style = doc.styles['Normal']
+    font = style.font
+    font.name = 'Times New Roman'
+    font.size = Pt(14)
+    
+    # Настройка параграфа для стиля Normal
+    paragraph_format = style.paragraph_format
+    paragraph_format.line_spacing = 1.5  # Интервал 1.5
+    paragraph_format.first_line_indent = Cm(1.25)  # Отступ первой строки
+
+    # Добавляем титульный лист (без нумерации)
+    add_title_page(doc, work_type, work_theme, science_name, user_data.get("page_number", 0))
+    
+    # Добавляем разрыв раздела после титульного листа
+    doc.add_section()
+    
+    # === ОГЛАВЛЕНИЕ (начинается нумерация с 2) ===
+    content_section = doc.sections[-1]
+    content_section.top_margin = Cm(2.5)
+    content_section.bottom_margin = Cm(2.5)
+    content_section.left_margin = Cm(3.0)
+    content_section.right_margin = Cm(1.0)
+    
+    # Добавляем нумерацию страниц со 2-й страницы
+    add_page_number(content_section, start_number=2)
+    
+    # Добавляем заголовок "Оглавление"
+    contents_heading = doc.add_heading("ОГЛАВЛЕНИЕ", level=1)
+    contents_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    for run in contents_heading.runs:
+        run.font.name = 'Times New Roman'
+        run.font.size = Pt(16)
+        run.font.bold = True
+        run.font.color.rgb = RGBColor(0, 0, 0)  # Черный цвет
+    
+    # Добавляем пункты оглавления
+    page_counter = 3  # Первая страница после оглавления
+    
+    # Главы основной части
+    for i, chapter in enumerate(plan_array, 1):
+        contents_p = doc.add_paragraph()
+        contents_p.paragraph_format.first_line_indent = Cm(0)
+        contents_p.paragraph_format.left_indent = Cm(0)
+        
+        # Добавляем номер и название главы
+        chapter_text = f"{i}. {chapter}"
+        run = contents_p.add_run(chapter_text)
+        run.font.name = 'Times New Roman'
+        run.font.size = Pt(14)
+        
+        # Добавляем точки-заполнители
+        dots_count = max(1, 70 - len(chapter_text))
+        dots_run = contents_p.add_run("." * dots_count)
+        dots_run.font.name = 'Times New Roman'
+        dots_run.font.size = Pt(14)
+        
+        # Номер страницы
+        page_run = contents_p.add_run(f" {page_counter}")
+        page_run.font.name = 'Times New Roman'
+        page_run.font.size = Pt(14)
+        page_counter += 1
+    
+    # Список источников
+    contents_p = doc.add_paragraph()
+    contents_p.paragraph_format.first_line_indent = Cm(0)
+    contents_p.paragraph_format.left_indent = Cm(0)
+    run = contents_p.add_run("Список источников")
+    run.font.name = 'Times New Roman'
+    run.font.size = Pt(14)
+    dots_run = contents_p.add_run("." * 57)
+    dots_run.font.name = 'Times New Roman'
+    dots_run.font.size = Pt(14)
+    page_run = contents_p.add_run(f" {page_counter}")
+    page_run.font.name = 'Times New Roman'
+    page_run.font.size = Pt(14)
+    
+    # Добавляем разрыв страницы после оглавления
+    doc.add_page_break()
+
+    # === ОСНОВНАЯ ЧАСТЬ ===
+    # Добавление текста глав в документ
+    for i, (chapter, chapter_text) in enumerate(chapters_text, 1):
+        # Удаляем дублирующийся заголовок из текста главы
+        chapter_text_cleaned = remove_chapter_title_from_text(chapter_text, chapter)
+        
+        chapter_heading = doc.add_heading(f"{i}. {chapter}", level=2)
+        chapter_heading.alignment = WD_ALIGN_PARAGRAPH.LEFT
+        # Настройка шрифта заголовка главы
+        for run in chapter_heading.runs:
+            run.font.name = 'Times New Roman'
+            run.font.size = Pt(14)
+            run.font.bold = True
+            run.font.color.rgb = RGBColor(0, 0, 0)  # Черный цвет
+        
+        # Разбиваем текст на блоки по двойным переносам строк
+        text_blocks = [block.strip() for block in chapter_text_cleaned.split('\n\n') if block.strip()]
+        
+        # Добавляем каждый блок как отдельный параграф
+        for block in text_blocks:
+            p = doc.add_paragraph(block)
+            p.paragraph_format.line_spacing = 1.5
+            p.paragraph_format.first_line_indent = Cm(1.25)
+            p.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY  # Выравнивание по ширине
+            p.paragraph_format.space_after = Pt(0)  # Убираем отступ после параграфа
+            p.paragraph_format.space_before = Pt(0)  # Убираем отступ перед параграфом
+            # Убеждаемся, что текст использует правильный шрифт
+            for run in p.runs:
+                run.font.name = 'Times New Roman'
+                run.font.size = Pt(14)
+        
+        # Добавляем разрыв страницы после каждой главы (кроме последней)
+        if i < len(chapters_text):
+            doc.add_page_break()
+    
+    # === СПИСОК ИСТОЧНИКОВ ===
+    
+    # Если источники получены, добавляем их в документ
+    if sources:
+        # Заголовок раздела
+        sources_heading = doc.add_heading("СПИСОК ИСТОЧНИКОВ", level=1)
+        sources_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        for run in sources_heading.runs:
+            run.font.name = 'Times New Roman'
+            run.font.size = Pt(16)
+            run.font.bold = True
+            run.font.color.rgb = RGBColor(0, 0, 0)  # Черный цвет
+        
+        # Добавляем каждый источник
+        for i, source in enumerate(sources, 1):
+            formatted_source = format_source_gost(source, i)
+            source_p = doc.add_paragraph(formatted_source)
+            source_p.paragraph_format.line_spacing = 1.5
+            source_p.paragraph_format.first_line_indent = Cm(0)  # Без отступа для списка
+            source_p.paragraph_format.left_indent = Cm(0)
+            
+            # Настройка шрифта
+            for run in source_p.runs:
+                run.font.name = 'Times New Roman'
+                run.font.size = Pt(14)
+        
+        logging.info(f"Добавлено {len(sources)} источников в документ")
+
+    # Сохранение документа в память
+    doc_io = io.BytesIO()
+    doc.save(doc_io)
+    
+    logging.info("Документ создан в памяти")
+    return doc_io.getvalue()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Настройки, изменяемые без перезапуска
+
+Лимиты, ёмкость генерации, модели, администраторы и тестовый режим
+описаны схемой SETTINGS: значение по умолчанию (или из переменной
+окружения с тем же именем), разбор и проверка текстового значения.
+Изменения, сделанные командой /admin_config, сохраняются в таблице
+runtime_settings общей базы, поэтому их видят бот и все воркеры: каждый
+процесс перечитывает таблицу раз в SETTINGS_REFRESH_TICK секунд и
+вызывает подписчиков изменённых настроек (например, меняет ёмкость
+планировщика). Без записи в таблице действует значение по умолчанию.
+"""
+
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple
+
+from engines.storage import SessionLocal, RuntimeSetting
+
+SETTINGS_REFRESH_TICK = 5  # секунды между проверками изменений в базе
+
+
+class Setting(NamedTuple):
+    """Настройка: значение по умолчанию, разбор текстового значения и описание"""
+    default: object
+    parse: Callable[[str], object]
+    description: str
+
+
+def integer(minimum: int, maximum: int) -> Callable[[str], int]:
+    """Целое число в заданных пределах"""
+    def parse(text: str) -> int:
+        try:
+            value = int(text.strip())
+        except ValueError:
+            raise ValueError(f"ожидается целое число, получено «{text.strip()}»")
+        if not minimum <= value <= maximum:
+            raise ValueError(f"значение должно быть от {minimum} до {maximum}")
+        return value
+    return parse
+
+
+def boolean(text: str) -> bool:
+    value = text.strip().lower()
+    if value in ("true", "1", "on", "yes", "да"):
+        return True
+    if value in ("false", "0", "off", "no", "нет"):
+        return False
+    raise ValueError("ожидается true или false")
+
+
+def id_list(text: str) -> list:
+    """Непустой список Telegram ID через запятую"""
+    try:
+        ids = [int(item) for item in text.replace(" ", "").split(",") if item]
+    except ValueError:
+        raise ValueError("ожидаются числовые ID через запятую")
+    if not ids:
+        raise ValueError("список не может быть пустым")
+    return ids
+
+
+def username_list(text: str) -> list:
+    """Список username через запятую (без @); может быть пустым"""
+    return [item.strip().lstrip("@") for item in text.split(",") if item.strip().lstrip("@")]
+
+
+def page_limits(text: str) -> dict:
+    """Лимиты страниц по типам работ: «Эссе=10, Курсовая работа=30»"""
+    limits = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        work_type, separator, pages = item.partition("=")
+        if not separator or not work_type.strip():
+            raise ValueError(f"ожидается «тип работы=страниц», получено «{item.strip()}»")
+        limits[work_type.strip()] = integer(1, 200)(pages)
+    if not limits:
+        raise ValueError("нужен хотя бы один тип работы")
+    return limits
+
+
+def choice(*options: str) -> Callable[[str], str]:
+    def parse(text: str) -> str:
+        if text.strip() not in options:
+            raise ValueError(f"допустимые значения: {', '.join(options)}")
+        return text.strip()
+    return parse
+
+
+def format_value(value) -> str:
+    """Текстовый вид значения — в этом же виде его принимает parse"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, dict):
+        return ", ".join(f"{key}={item}" for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value)
+    return str(value)
+
+
+DEEPSEEK_MODELS = ("deepseek-reasoner", "deepseek-chat")
+
+SETTINGS = {
+    "TESTING_MODE": Setting(False, boolean, "Тестовый режим: все заказы бесплатные, без YooKassa"),
+    "ADMIN_IDS": Setting([659874549], id_list, "Telegram ID администраторов"),
+    "TEST_MODE_USERNAMES": Setting(["AbuHavva"], username_list, "Пользователи с постоянным тестовым режимом"),
+    "MAX_REQUESTS_PER_HOUR": Setting(5, integer(1, 1000), "Заказов одного пользователя за окно REQUEST_WINDOW"),
+    "REQUEST_WINDOW": Setting(3600, integer(60, 7 * 86400), "Окно лимита заказов, секунды"),
+    "GENERATION_CAPACITY": Setting(10, integer(1, 200), "Одновременных запросов к DeepSeek в процессе"),
+    "MAX_ACTIVE_ORDERS": Setting(10, integer(1, 500), "Заказов, выполняемых одновременно"),
+    "MAX_QUEUED_ORDERS": Setting(20, integer(0, 5000), "Заказов в очереди сверх выполняемых"),
+    "MAX_USER_ACTIVE_ORDERS": Setting(2, integer(1, 50), "Заказов в работе у одного пользователя"),
+    "PAGE_LIMITS": Setting(
+        {"Эссе": 10, "Доклад": 10, "Реферат": 20, "Проект": 20, "Курсовая работа": 30, "Дипломная работа": 70},
+        page_limits, "Максимум страниц по типам работ"
+    ),
+    "PLAN_MODEL": Setting("deepseek-reasoner", choice(*DEEPSEEK_MODELS), "Модель для плана работы"),
+    "CHAPTER_MODEL": Setting("deepseek-reasoner", choice(*DEEPSEEK_MODELS), "Модель для текста глав"),
+}
+
+
+class RuntimeSettings:
+    """Значения настроек процесса: умолчания, изменения из базы и подписчики"""
+
+    def __init__(self, schema: dict):
+        self.schema = schema
+        self.defaults = {name: self._env_default(name, setting) for name, setting in schema.items()}
+        self._values = dict(self.defaults)
+        self._stored = {}  # name -> (текст, кто изменил, когда) из runtime_settings
+        self._listeners = {}
+
+    @staticmethod
+    def _env_default(name: str, setting: Setting):
+        """Значение по умолчанию; переменная окружения с тем же именем его заменяет"""
+        text = os.getenv(name)
+        if text is None or not text.strip():
+            return setting.default
+        try:
+            return setting.parse(text)
+        except ValueError as e:
+            raise ValueError(f"Переменная окружения {name}: {e}")
+
+    def get(self, name: str):
+        return self._values[name]
+
+    def parse(self, name: str, text: str):
+        """Проверяет значение по схеме; ValueError с понятным администратору текстом"""
+        if name not in self.schema:
+            raise ValueError(f"неизвестная настройка {name}")
+        return self.schema[name].parse(text)
+
+    def on_change(self, name: str, callback) -> None:
+        """Вызывает callback(новое значение) при каждом изменении настройки"""
+        if name not in self.schema:
+            raise ValueError(f"Неизвестная настройка: {name}")
+        self._listeners.setdefault(name, []).append(callback)
+
+    def _apply(self, name: str, value) -> None:
+        if value == self._values[name]:
+            return
+        self._values[name] = value
+        logging.info(f"Настройка {name} = {format_value(value)}")
+        for callback in self._listeners.get(name, ()):
+            try:
+                callback(value)
+            except Exception as e:
+                logging.error(f"Ошибка применения настройки {name}: {e}")
+
+    def set(self, name: str, text: str, updated_by: str = None):
+        """Проверяет, сохраняет в базе и сразу применяет новое значение; возвращает его"""
+        value = self.parse(name, text)
+        stored = (format_value(value), updated_by, datetime.now(timezone.utc))
+        session = SessionLocal()
+        try:
+            row = session.get(RuntimeSetting, name) or RuntimeSetting(name=name)
+            row.value, row.updated_by, row.updated_at = stored
+            session.add(row)
+            session.commit()
+            self._stored[name] = stored
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self._apply(name, value)
+        return value
+
+    def reset(self, name: str) -> None:
+        """Удаляет изменение из базы: действует значение по умолчанию"""
+        if name not in self.schema:
+            raise ValueError(f"неизвестная настройка {name}")
+        session = SessionLocal()
+        try:
+            session.query(RuntimeSetting).filter(RuntimeSetting.name == name).delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self._stored.pop(name, None)
+        self._apply(name, self.defaults[name])
+
+    def refresh(self) -> list:
+        """Перечитывает runtime_settings и применяет изменения; возвращает имена изменённых настроек"""
+        session = SessionLocal()
+        try:
+            rows = {
+                row.name: (row.value, row.updated_by, row.updated_at)
+                for row in session.query(RuntimeSetting).all()
+                if row.name in self.schema
+            }
+        finally:
+            session.close()
+
+        changed = []
+        for name in self.schema:
+            stored = rows.get(name)
+            if stored == self._stored.get(name):
+                continue
+            value = self.defaults[name]
+            if stored is not None:
+                try:
+                    value = self.parse(name, stored[0])
+                except ValueError as e:
+                    logging.error(f"Некорректное значение настройки {name} в базе, действует умолчание: {e}")
+            before = self._values[name]
+            self._apply(name, value)
+            if self._values[name] != before:
+                changed.append(name)
+        self._stored = rows
+        return changed
+
+    def describe(self) -> list:
+        """Для /admin_config: (имя, значение, описание, (кто и когда изменил) или None)"""
+        return [
+            (
+                name,
+                format_value(self._values[name]),
+                setting.description,
+                self._stored[name][1:] if name in self._stored else None
+            )
+            for name, setting in self.schema.items()
+        ]
+
+
+settings = RuntimeSettings(SETTINGS)
+
+
+async def watch_settings(tick: float = SETTINGS_REFRESH_TICK) -> None:
+    """Фоновый цикл: применяет изменения, сделанные другими процессами"""
+    while True:
+        await asyncio.sleep(tick)
+        try:
+            settings.refresh()
+        except Exception as e:
+            logging.error(f"Ошибка обновления настроек: {e}")
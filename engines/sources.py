@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Подбор источников для списка литературы
+
+Источники ищутся в локальном индексе (source_index), недостающие
+запрашиваются у Coze workflow, затем ссылки проверяются и классифицируются
+(source_enricher). Сетевые клиенты открывают соединения при первом запросе.
+"""
+
+import os
+import re
+import json
+import asyncio
+import logging
+
+from source_client import CozeSourceClient
+from source_index import SourceIndex
+from source_enrichment import SourceEnricher
+from engines import metrics
+
+# Настройки Coze API для поиска источников
+COZE_API_TOKEN = os.getenv("COZE_API_TOKEN")
+COZE_WORKFLOW_ID = os.getenv("COZE_WORKFLOW_ID")
+COZE_SPACE_ID = os.getenv("COZE_SPACE_ID")
+COZE_API_URL = os.getenv("COZE_API_URL", "https://api.coze.com/v1/workflow/run")
+
+async def fetch_sources_from_coze(keywords: str, count: int = 15) -> list:
+    """
+    Получает источники через Coze workflow API
+    
+    Запрос идёт через общий клиент coze_client: повторные темы берутся из кеша,
+    одинаковые одновременные запросы объединяются в один.
+    
+    Args:
+        keywords: Ключевые слова для поиска источников
+        count: Количество источников для поиска (не используется, т.к. workflow возвращает фиксированное количество)
+    
+    Returns:
+        Список словарей с ключами 'title' и 'url'
+    """
+    return await coze_client.fetch(keywords)
+
+def parse_coze_response(data: dict) -> list:
+    """
+    Парсит ответ от Coze workflow и извлекает источники
+    
+    Args:
+        data: JSON ответ от Coze API
+    
+    Returns:
+        Список словарей с ключами 'title' и 'url'
+    """
+    sources = []
+    
+    try:
+        # Извлекаем данные из ответа
+        if "data" in data:
+            data_str = data.get("data", "{}")
+            
+            # Если data - это строка, парсим как JSON
+            if isinstance(data_str, str):
+                try:
+                    data_obj = json.loads(data_str)
+                except json.JSONDecodeError:
+                    logging.error("Не удалось распарсить JSON из data")
+                    return []
+            else:
+                data_obj = data_str
+            
+            # Извлекаем массив output
+            if "output" in data_obj:
+                output_array = data_obj.get("output", [])
+                
+                if isinstance(output_array, list):
+                    for item in output_array:
+                        if isinstance(item, dict):
+                            # Извлекаем title и link
+                            title = item.get("title", "")
+                            link = item.get("link", "")
+                            
+                            if title and link:
+                                sources.append({"title": title, "url": link})
+                        elif isinstance(item, str):
+                            # Если элемент - строка, парсим её
+                            parsed = parse_source_string(item)
+                            if parsed:
+                                sources.append(parsed)
+        
+        logging.info(f"Распарсено источников: {len(sources)}")
+    except Exception as e:
+        logging.error(f"Ошибка при парсинге ответа Coze: {e}")
+    
+    return sources
+
+def parse_sources_from_text(text: str) -> list:
+    """
+    Парсит источники из текстового ответа
+    
+    Args:
+        text: Текст с источниками
+    
+    Returns:
+        Список словарей с ключами 'title' и 'url'
+    """
+    sources = []
+    
+    # Ищем паттерны вида "Заголовок - URL" или "Заголовок: URL"
+    patterns = [
+        r'(.+?)\s*[-–—]\s*(https?://[^\s]+)',
+        r'(.+?):\s*(https?://[^\s]+)',
+        r'\d+\.\s*(.+?)\s*[-–—]\s*(https?://[^\s]+)',
+        r'\d+\.\s*(.+?):\s*(https?://[^\s]+)',
+    ]
+    
+    for pattern in patterns:
+        matches = re.findall(pattern, text, re.MULTILINE)
+        for match in matches:
+            title = match[0].strip()
+            url = match[1].strip()
+            sources.append({"title": title, "url": url})
+    
+    # Если ничего не нашли, попробуем найти просто URL
+    if not sources:
+        urls = re.findall(r'https?://[^\s]+', text)
+        for i, url in enumerate(urls, 1):
+            sources.append({"title": f"Источник {i}", "url": url})
+    
+    return sources
+
+def parse_source_string(text: str) -> dict:
+    """
+    Парсит одну строку с источником
+    
+    Args:
+        text: Строка с источником
+    
+    Returns:
+        Словарь с ключами 'title' и 'url' или None
+    """
+    patterns = [
+        r'(.+?)\s*[-–—]\s*(https?://[^\s]+)',
+        r'(.+?):\s*(https?://[^\s]+)',
+    ]
+    
+    for pattern in patterns:
+        match = re.match(pattern, text.strip())
+        if match:
+            return {"title": match.group(1).strip(), "url": match.group(2).strip()}
+    
+    # Если это просто URL
+    if text.strip().startswith('http'):
+        return {"title": "Источник", "url": text.strip()}
+    
+    return None
+
+def extract_keywords_from_theme(theme: str, science_name: str) -> str:
+    """
+    Извлекает ключевые слова из темы работы для поиска источников
+    
+    Args:
+        theme: Тема работы
+        science_name: Название предмета
+    
+    Returns:
+        Строка с ключевыми словами
+    """
+    # Объединяем тему и предмет для более точного поиска
+    keywords = f"{theme} {science_name}"
+    
+    # Убираем лишние слова
+    stop_words = ["по", "для", "в", "на", "с", "о", "и", "или", "а", "но"]
+    words = keywords.split()
+    filtered_words = [w for w in words if w.lower() not in stop_words]
+    
+    return " ".join(filtered_words)
+
+# Долгоживущий клиент Coze: общий пул соединений, кеш и объединение запросов
+coze_client = CozeSourceClient(
+    COZE_API_URL,
+    COZE_API_TOKEN,
+    COZE_WORKFLOW_ID,
+    parse_response=parse_coze_response,
+    timeout=float(os.getenv("COZE_TIMEOUT", "30")),
+    cache_ttl=float(os.getenv("COZE_CACHE_TTL_HOURS", "6")) * 3600
+)
+
+def coze_request_samples():
+    stats = coze_client.stats()
+    return [({"result": result}, stats[field]) for result, field in (
+        ("total", "requests"), ("cache_hit", "cache_hits"), ("coalesced", "coalesced"), ("error", "errors")
+    )]
+
+metrics.counter("coze_requests_total", "Запросы источников через клиент Coze", ("result",)).set_function(
+    coze_request_samples
+)
+metrics.gauge("coze_cache_hit_ratio", "Доля запросов к Coze, обслуженных из кеша").set_function(
+    lambda: coze_client.stats()["hit_rate"]
+)
+
+# Локальный индекс всех полученных источников: первый уровень перед Coze и резерв
+source_index = SourceIndex(os.getenv("SOURCE_INDEX_DB", "source_index.db"))
+
+async def find_sources(keywords: str, count: int) -> list:
+    """
+    Подбирает источники для работы: локальный индекс, затем Coze
+    
+    Если в локальном индексе есть достаточно источников, совпадающих со всеми
+    ключевыми словами темы, Coze не вызывается. Иначе источники запрашиваются
+    у Coze, сохраняются в индекс, а недостающие до count добираются из индекса.
+    Запросы к индексу (SQLite) выполняются в пуле потоков, не блокируя цикл событий.
+    
+    Args:
+        keywords: Ключевые слова темы
+        count: Желаемое количество источников
+    
+    Returns:
+        Список словарей с ключами 'title' и 'url'
+    """
+    try:
+        local_sources = await asyncio.to_thread(source_index.search, keywords, count, match_all=True)
+    except Exception as e:
+        logging.error(f"Ошибка поиска в локальном индексе источников: {e}")
+        local_sources = []
+    if len(local_sources) >= count:
+        logging.info(f"Источники взяты из локального индекса ({len(local_sources)} шт.)")
+        return local_sources
+    
+    sources = await fetch_sources_from_coze(keywords, count)
+    try:
+        if sources:
+            await asyncio.to_thread(source_index.add, sources, keywords)
+        if len(sources) < count:
+            known_urls = [source["url"] for source in sources]
+            extra = await asyncio.to_thread(
+                source_index.search, keywords, count - len(sources), exclude_urls=known_urls
+            )
+            if extra:
+                logging.info(f"Из локального индекса добавлено источников: {len(extra)}")
+                sources = sources + extra
+    except Exception as e:
+        logging.error(f"Ошибка работы с локальным индексом источников: {e}")
+    return sources
+
+# Проверка ссылок, дедупликация и метаданные источников
+source_enricher = SourceEnricher(
+    concurrency=int(os.getenv("SOURCE_CHECK_CONCURRENCY", "8")),
+    timeout=float(os.getenv("SOURCE_CHECK_TIMEOUT", "5"))
+)
+
+async def collect_sources(work_type: str, work_theme: str, science_name: str) -> list:
+    """Подбирает, проверяет и классифицирует источники для списка литературы
+    
+    Запускается параллельно с генерацией глав, поэтому не добавляет задержки.
+    """
+    # Определяем количество источников в зависимости от типа работы
+    if work_type in ["Курсовая работа", "Дипломная работа"]:
+        sources_count = 20
+    else:
+        sources_count = 12  # 10-15 источников, берем среднее значение
+    
+    # Получаем ключевые слова для поиска источников
+    keywords = extract_keywords_from_theme(work_theme, science_name)
+    
+    # Получаем источники из локального индекса и/или через Coze workflow
+    sources = await find_sources(keywords, sources_count)
+    if not sources:
+        return []
+    
+    try:
+        return await source_enricher.enrich(sources)
+    except Exception as e:
+        logging.error(f"Ошибка проверки источников: {e}")
+        return sources
+
+async def close_sources() -> None:
+    """Закрывает клиентов и индекс источников"""
+    await coze_client.close()
+    await source_enricher.close()
+    source_index.close()
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище заказов: база SQLite (SQLAlchemy) и файловое хранилище артефактов
+
+Модели, схема и миграция, статусы заказа, чекпоинты плана и глав,
+артефакты (документ, JSON с главами), учёт стадий выполнения, сообщения
+outbox и задания на выполнение заказов. Подключение к базе открывается при
+первом запросе; таблицы создаёт init_db() при запуске бота или воркера.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, event, inspect, Column, Integer, String, DateTime, Float, Text, UniqueConstraint
+from sqlalchemy.orm import sessionmaker, declarative_base  # Updated import for SQLAlchemy 2.0
+
+from artifact_store import ArtifactStore
+from payment_gateway import idempotence_key
+from engines import metrics
+
+# Хранилище готовых документов и промежуточных результатов
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", "generated")
+ARTIFACTS_MAX_MB = int(os.getenv("ARTIFACTS_MAX_MB", "1024"))
+ARTIFACTS_TTL_DAYS = int(os.getenv("ARTIFACTS_TTL_DAYS", "30"))
+artifact_store = ArtifactStore(
+    ARTIFACTS_DIR,
+    max_bytes=ARTIFACTS_MAX_MB * 1024 * 1024,
+    ttl_seconds=ARTIFACTS_TTL_DAYS * 24 * 3600
+)
+
+# Настройка базы данных; бот и воркеры должны использовать одну базу
+# (для воркеров на других машинах — сетевую, например PostgreSQL)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///user_activity.db")
+Base = declarative_base()  # Updated to use sqlalchemy.orm.declarative_base
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+# Несколько процессов пишут в один файл: ждём блокировку, а не падаем с "database is locked"
+engine = create_engine(DATABASE_URL, connect_args={"timeout": 30} if IS_SQLITE else {})
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+db_query_seconds = metrics.histogram("db_query_seconds", "Длительность SQL-запросов", ("operation",))
+
+if IS_SQLITE:
+    @event.listens_for(engine, "connect")
+    def configure_sqlite(dbapi_connection, connection_record):
+        # WAL: чтение не блокируется записью другого процесса
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+@event.listens_for(engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(engine, "handle_error")
+def discard_query_timer(exception_context):
+    # Запрос упал: after_cursor_execute не вызывается, снимаем его отметку времени
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+@event.listens_for(engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    if operation not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+        operation = "OTHER"
+    db_query_seconds.observe(time.perf_counter() - started, operation=operation)
+
+# Модель для хранения действий пользователей
+class UserAction(Base):
+    __tablename__ = "user_actions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True)
+    action = Column(String, index=True)
+    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Новая модель для хранения заказов
+class Order(Base):
+    __tablename__ = "orders"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String, index=True)
+    work_type = Column(String)
+    science_name = Column(String)
+    work_theme = Column(String)
+    page_number = Column(Integer)
+    price = Column(Integer)
+    status = Column(String, default="created")  # created, paid, completed, failed, refunded
+    payment_id = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    paid_at = Column(DateTime, nullable=True)
+    # Окончание стадий выполнения (при повторном выполнении — последняя попытка)
+    plan_done_at = Column(DateTime, nullable=True)
+    chapters_done_at = Column(DateTime, nullable=True)
+    rendered_at = Column(DateTime, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    params = Column(Text, nullable=True)  # JSON с параметрами заказа (предпочтения, план пользователя)
+    plan = Column(Text, nullable=True)  # JSON с итоговым планом работы
+    payment_checks = Column(Integer, default=0)  # сколько раз статус платежа запрашивался при сверке
+    payment_next_check_at = Column(DateTime, nullable=True)  # когда сверить платёж в следующий раз
+
+# Чекпоинты сгенерированных глав: при повторной попытке генерируются только недостающие
+class OrderChapter(Base):
+    __tablename__ = "order_chapters"
+    __table_args__ = (UniqueConstraint("order_id", "position"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, index=True)
+    position = Column(Integer)
+    title = Column(String)
+    text = Column(Text)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Артефакты заказа (документ, JSON с главами), хранящиеся в artifact_store
+class OrderArtifact(Base):
+    __tablename__ = "order_artifacts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, index=True)
+    kind = Column(String)  # docx, chapters
+    artifact_key = Column(String, index=True)
+    filename = Column(String, nullable=True)
+    size = Column(Integer)
+    telegram_file_id = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Стадии выполнения заказа: время начала и окончания и результат каждой стадии
+class OrderStage(Base):
+    __tablename__ = "order_stages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, index=True)
+    stage = Column(String, index=True)  # plan, chapters, sources, render, deliver
+    started_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime, nullable=True)
+    duration = Column(Float, nullable=True)  # секунды
+    outcome = Column(String, nullable=True)  # ok, error, cancelled
+    error = Column(Text, nullable=True)
+
+# Outbox: возвраты и уведомления, которые нужно выполнить и не потерять при перезапуске
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, index=True)  # refund, notify
+    order_id = Column(Integer, index=True, nullable=True)
+    payload = Column(Text)  # JSON с параметрами операции
+    idempotence_key = Column(String, unique=True)  # повтор операции с тем же ключом не выполняется дважды
+    status = Column(String, default="pending", index=True)  # pending, done, failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    processed_at = Column(DateTime, nullable=True)
+
+# Задания на выполнение заказов: ставит бот, выполняют потребители очереди (бот или воркеры)
+class OrderJob(Base):
+    __tablename__ = "order_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    order_id = Column(Integer, index=True)
+    kind = Column(String)  # paid, test_mode, test, resume
+    lane = Column(String)  # полоса планировщика: paid, retry, test
+    priority = Column(Integer)  # порядок полосы, меньше — раньше
+    payload = Column(Text, nullable=True)  # JSON с параметрами задания
+    status = Column(String, default="queued", index=True)  # queued, running, done, failed
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String, nullable=True)
+    lease_until = Column(Float, nullable=True)  # unix-время; после него задание может забрать другой потребитель
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime, nullable=True)
+
+class RuntimeSetting(Base):
+    __tablename__ = "runtime_settings"
+
+    name = Column(String, primary_key=True)  # имя настройки из engines.settings.SETTINGS
+    value = Column(Text)  # значение в текстовом виде, как его вводит администратор
+    updated_by = Column(String, nullable=True)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+def migrate_schema():
+    """Добавляет в существующие таблицы колонки, появившиеся в моделях позже"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                    logging.info(f"Добавлена колонка {table.name}.{column.name}")
+
+def init_db():
+    """Создаёт таблицы и добавляет недостающие колонки (вызывается при запуске бота)"""
+    Base.metadata.create_all(bind=engine)
+    migrate_schema()
+
+# Функция для записи действий пользователя
+async def log_user_action(user_id: str, action: str):
+    session = SessionLocal()
+    try:
+        user_action = UserAction(
+            user_id=str(user_id), 
+            action=action,
+            timestamp=datetime.now(timezone.utc)  # Заменить deprecated utcnow()
+        )
+        session.add(user_action)
+        session.commit()
+        logging.info(f"User action logged: {action} for user {user_id}")
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка записи действия пользователя: {e}")
+        raise
+    finally:
+        session.close()
+
+# Функция для создания заказа
+async def create_order(user_id: str, order_data: dict) -> int:
+    """Создает заказ в базе данных и возвращает ID заказа"""
+    session = SessionLocal()
+    try:
+        order = Order(
+            user_id=str(user_id),
+            work_type=order_data.get("work_type", ""),
+            science_name=order_data.get("science_name", ""),
+            work_theme=order_data.get("work_theme", ""),
+            page_number=order_data.get("page_number", 0),
+            price=order_data.get("price", 0),
+            status="created",
+            params=json.dumps(order_data.get("params") or {}, ensure_ascii=False)
+        )
+        session.add(order)
+        session.commit()
+        order_id = order.id
+        logging.info(f"Order created: {order_id} for user {user_id}")
+        return order_id
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка создания заказа: {e}")
+        raise
+    finally:
+        session.close()
+
+# Функция для обновления статуса заказа
+async def update_order_status(order_id: int, status: str, payment_id: str = None):
+    """Обновляет статус заказа"""
+    session = SessionLocal()
+    try:
+        order = session.query(Order).filter(Order.id == order_id).first()
+        if order:
+            order.status = status
+            if payment_id:
+                order.payment_id = payment_id
+            if status in ("paid", "test_paid"):
+                order.paid_at = datetime.now(timezone.utc)
+            if status == "completed":
+                order.completed_at = datetime.now(timezone.utc)
+            session.commit()
+            logging.info(f"Order {order_id} status updated to {status}")
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка обновления статуса заказа: {e}")
+        raise
+    finally:
+        session.close()
+
+def transition_order_status(order_id: int, from_statuses: list, to_status: str,
+                            outbox: list = None, **fields) -> bool:
+    """Атомарно меняет статус заказа, только если текущий статус из from_statuses
+    
+    Сообщения outbox и задания order_jobs (если переданы) сохраняются в той
+    же транзакции и только при успешной смене статуса.
+    
+    Returns:
+        True, если статус изменён этим вызовом
+    """
+    session = SessionLocal()
+    try:
+        values = {"status": to_status, **fields}
+        if to_status in ("paid", "test_paid"):
+            values["paid_at"] = datetime.now(timezone.utc)
+        if to_status == "completed":
+            values["completed_at"] = datetime.now(timezone.utc)
+        updated = session.query(Order).filter(
+            Order.id == order_id,
+            Order.status.in_(from_statuses)
+        ).update(values, synchronize_session=False)
+        if updated and outbox:
+            session.add_all(outbox)
+        session.commit()
+        if updated:
+            logging.info(f"Order {order_id} status updated to {to_status}")
+        return bool(updated)
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка обновления статуса заказа: {e}")
+        raise
+    finally:
+        session.close()
+
+# ===================== ЧЕКПОИНТЫ ЗАКАЗА =====================
+
+def get_order(order_id: int):
+    session = SessionLocal()
+    try:
+        return session.query(Order).filter(Order.id == order_id).first()
+    finally:
+        session.close()
+
+def save_order_plan(order_id: int, plan_array: list) -> None:
+    session = SessionLocal()
+    try:
+        order = session.query(Order).filter(Order.id == order_id).first()
+        if order:
+            order.plan = json.dumps(plan_array, ensure_ascii=False)
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка сохранения плана заказа {order_id}: {e}")
+    finally:
+        session.close()
+
+def get_order_plan(order_id: int) -> list:
+    """Возвращает сохранённый план заказа или пустой список"""
+    order = get_order(order_id)
+    if order is None or not order.plan:
+        return []
+    try:
+        plan_array = json.loads(order.plan)
+    except json.JSONDecodeError:
+        return []
+    return plan_array if isinstance(plan_array, list) else []
+
+def load_chapter_checkpoints(order_id: int) -> dict:
+    """Возвращает {позиция: (название, текст)} для уже сгенерированных глав"""
+    session = SessionLocal()
+    try:
+        rows = session.query(OrderChapter).filter(OrderChapter.order_id == order_id).all()
+        return {row.position: (row.title, row.text) for row in rows}
+    finally:
+        session.close()
+
+def save_chapter_checkpoint(order_id: int, position: int, title: str, text: str) -> None:
+    session = SessionLocal()
+    try:
+        row = session.query(OrderChapter).filter(
+            OrderChapter.order_id == order_id,
+            OrderChapter.position == position
+        ).first()
+        if row is None:
+            row = OrderChapter(order_id=order_id, position=position)
+            session.add(row)
+        row.title = title
+        row.text = text
+        row.updated_at = datetime.now(timezone.utc)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка сохранения главы {position} заказа {order_id}: {e}")
+    finally:
+        session.close()
+
+def is_valid_chapter_text(text: str) -> bool:
+    """Проверяет, что сохранённый текст главы пригоден для повторного использования"""
+    return bool(text) and len(text.strip()) >= 100
+
+# ===================== ХРАНИЛИЩЕ ДОКУМЕНТОВ =====================
+
+async def save_order_artifact(order_id: int, kind: str, data: bytes, filename: str = None) -> str:
+    """Сохраняет артефакт заказа в хранилище и привязывает его к заказу
+
+    Returns:
+        Ключ артефакта в хранилище
+    """
+    suffix = os.path.splitext(filename)[1] if filename else f".{kind}"
+    # Запись файла и вытеснение по квоте — дисковые операции, выполняются вне event loop
+    key = await asyncio.to_thread(artifact_store.put, data, suffix)
+    session = SessionLocal()
+    try:
+        artifact = session.query(OrderArtifact).filter(
+            OrderArtifact.order_id == order_id,
+            OrderArtifact.kind == kind
+        ).first()
+        if artifact is None:
+            artifact = OrderArtifact(order_id=order_id, kind=kind)
+            session.add(artifact)
+        if artifact.artifact_key != key:
+            artifact.telegram_file_id = None
+        artifact.artifact_key = key
+        artifact.filename = filename
+        artifact.size = len(data)
+        session.commit()
+        return key
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка сохранения артефакта заказа {order_id}: {e}")
+        raise
+    finally:
+        session.close()
+
+def get_order_artifact(order_id: int, kind: str = "docx"):
+    """Возвращает запись об артефакте заказа или None"""
+    session = SessionLocal()
+    try:
+        return session.query(OrderArtifact).filter(
+            OrderArtifact.order_id == order_id,
+            OrderArtifact.kind == kind
+        ).first()
+    finally:
+        session.close()
+
+def find_telegram_file_id(artifact_key: str) -> str:
+    """Ищет уже загруженный в Telegram файл с тем же содержимым"""
+    session = SessionLocal()
+    try:
+        artifact = session.query(OrderArtifact).filter(
+            OrderArtifact.artifact_key == artifact_key,
+            OrderArtifact.telegram_file_id.isnot(None)
+        ).first()
+        return artifact.telegram_file_id if artifact else None
+    finally:
+        session.close()
+
+def set_telegram_file_id(order_id: int, kind: str, file_id: str) -> None:
+    session = SessionLocal()
+    try:
+        artifact = session.query(OrderArtifact).filter(
+            OrderArtifact.order_id == order_id,
+            OrderArtifact.kind == kind
+        ).first()
+        if artifact:
+            artifact.telegram_file_id = file_id
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка сохранения file_id для заказа {order_id}: {e}")
+    finally:
+        session.close()
+
+# ===================== СТАДИИ ЗАКАЗА =====================
+# Каждая стадия выполнения записывается в order_stages со временем начала,
+# окончания и результатом.
+
+ORDER_STAGES = ("plan", "chapters", "sources", "render", "deliver")
+# Колонки заказа, в которые записывается время успешного окончания стадии
+ORDER_STAGE_COLUMNS = {
+    "plan": "plan_done_at",
+    "chapters": "chapters_done_at",
+    "render": "rendered_at",
+    "deliver": "delivered_at",
+}
+
+def start_order_stage(order_id: int, stage: str) -> int:
+    session = SessionLocal()
+    try:
+        span = OrderStage(order_id=order_id, stage=stage, started_at=datetime.now(timezone.utc))
+        session.add(span)
+        session.commit()
+        return span.id
+    finally:
+        session.close()
+
+def finish_order_stage(span_id: int, order_id: int, stage: str, outcome: str,
+                       duration: float, error: str = None) -> None:
+    now = datetime.now(timezone.utc)
+    session = SessionLocal()
+    try:
+        session.query(OrderStage).filter(OrderStage.id == span_id).update({
+            "finished_at": now,
+            "duration": duration,
+            "outcome": outcome,
+            "error": error[:1000] if error else None,
+        }, synchronize_session=False)
+        column = ORDER_STAGE_COLUMNS.get(stage)
+        if outcome == "ok" and column:
+            session.query(Order).filter(Order.id == order_id).update(
+                {column: now}, synchronize_session=False
+            )
+        session.commit()
+    finally:
+        session.close()
+
+@asynccontextmanager
+async def order_stage(order_id: int, stage: str):
+    """Записывает время и результат стадии заказа (ok, error или cancelled)"""
+    span_id = None
+    if order_id:
+        try:
+            span_id = start_order_stage(order_id, stage)
+        except Exception as e:
+            # Учёт стадий не должен мешать выполнению заказа
+            logging.error(f"Не удалось записать начало стадии {stage} заказа {order_id}: {e}")
+    started = time.monotonic()
+    outcome, error = "ok", None
+    try:
+        yield
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        outcome, error = "error", str(e) or e.__class__.__name__
+        raise
+    finally:
+        duration = time.monotonic() - started
+        logging.info(f"Заказ {order_id}: стадия {stage} — {outcome} за {duration:.1f} с")
+        if span_id is not None:
+            try:
+                finish_order_stage(span_id, order_id, stage, outcome, duration, error)
+            except Exception as e:
+                logging.error(f"Не удалось записать окончание стадии {stage} заказа {order_id}: {e}")
+
+def as_utc(value: datetime) -> datetime:
+    """SQLite возвращает даты без часового пояса — считаем их UTC"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+# ===================== OUTBOX =====================
+# Возвраты и уведомления сохраняются в таблицу outbox в одной транзакции
+# с изменением заказа; выполняет их фоновый обработчик (bot.outbox_worker).
+
+def outbox_message(kind: str, order_id: int, payload: dict, key: str) -> OutboxMessage:
+    return OutboxMessage(
+        kind=kind,
+        order_id=order_id,
+        payload=json.dumps(payload, ensure_ascii=False),
+        idempotence_key=key,
+        status="pending"
+    )
+
+def notify_message(order_id: int, chat_id, text: str, event: str) -> OutboxMessage:
+    """Уведомление пользователя о событии заказа (одно на событие)"""
+    return outbox_message(
+        "notify", order_id, {"chat_id": int(chat_id), "text": text},
+        idempotence_key("notify", order_id, event)
+    )
+
+def add_outbox_messages(messages: list) -> int:
+    """Добавляет сообщения outbox, которых ещё нет (по ключу идемпотентности)
+
+    Returns:
+        Количество добавленных сообщений
+    """
+    if not messages:
+        return 0
+    session = SessionLocal()
+    try:
+        keys = [message.idempotence_key for message in messages]
+        existing = {
+            key for (key,) in session.query(OutboxMessage.idempotence_key).filter(
+                OutboxMessage.idempotence_key.in_(keys)
+            ).all()
+        }
+        new = [message for message in messages if message.idempotence_key not in existing]
+        session.add_all(new)
+        session.commit()
+        return len(new)
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Ошибка добавления сообщений outbox: {e}")
+        return 0
+    finally:
+        session.close()
+
+class PermanentOutboxError(Exception):
+    """Ошибка, после которой повторять операцию бессмысленно"""
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+📨 Имитация Telegram для проверки режима webhook
+
+Отправляет на webhook бота синтетические обновления (текстовые сообщения
+от нескольких чатов) так же, как это делает Telegram: POST с JSON и
+заголовком X-Telegram-Bot-Api-Secret-Token.
+1. Проверяет, что запрос без секрета и некорректное тело отклоняются
+2. Отправляет --count обновлений с параллельностью --concurrency
+3. Показывает коды ответов (503 — очередь обновлений переполнена),
+   пропускную способность и задержку приёма
+
+Бот запускается локально с TELEGRAM_WEBHOOK_ENABLED=true и пустым
+TELEGRAM_WEBHOOK_URL (setWebhook не вызывается). Ответы бота уходят
+в настоящий Bot API, поэтому для несуществующих чатов в логе будут
+ошибки отправки — на приём обновлений это не влияет.
+
+Запуск: py fake_telegram_updates.py [--url http://127.0.0.1:8080/telegram/webhook]
+        [--count 500] [--concurrency 50] [--chats 20] [--text /help]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+import aiohttp
+from dotenv import load_dotenv
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Обновление с текстовым сообщением из личного чата"""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"Тест {chat_id}", "username": f"fake_user_{chat_id}"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+async def post(session: aiohttp.ClientSession, url: str, secret: str, payload) -> tuple:
+    """Отправляет одно обновление; возвращает (код ответа, задержка в секундах)"""
+    headers = {SECRET_HEADER: secret} if secret else {}
+    started = time.perf_counter()
+    try:
+        async with session.post(url, json=payload, headers=headers) as response:
+            await response.read()
+            return response.status, time.perf_counter() - started
+    except aiohttp.ClientError as e:
+        return type(e).__name__, time.perf_counter() - started
+
+
+async def run(args) -> int:
+    ok = True
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+        print("🔐 Проверка защиты:")
+        checks = [
+            ("без секрета", "", make_update(1, args.first_chat, args.text), 403),
+            ("неверный секрет", "wrong-" + args.secret, make_update(1, args.first_chat, args.text), 403),
+            ("тело без update_id", args.secret, {"message": {}}, 400),
+        ]
+        for title, secret, payload, expected in checks:
+            status, _ = await post(session, args.url, secret, payload)
+            passed = status == expected
+            ok = ok and passed
+            print(f"  {'✅' if passed else '❌'} {title}: {status} (ожидается {expected})")
+
+        print(f"\n📨 Отправка {args.count} обновлений из {args.chats} чатов, параллельно {args.concurrency}:")
+        semaphore = asyncio.Semaphore(args.concurrency)
+        base_id = int(time.time()) * 1000
+
+        async def send(i: int) -> tuple:
+            payload = make_update(base_id + i, args.first_chat + i % args.chats, args.text)
+            async with semaphore:
+                return await post(session, args.url, args.secret, payload)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(send(i) for i in range(args.count)))
+        elapsed = time.perf_counter() - started
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    for status, count in sorted(statuses.items(), key=lambda item: str(item[0])):
+        print(f"  {status}: {count}")
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"\n⏱️ {args.count / elapsed:.0f} обновлений/с, "
+          f"задержка приёма p50 {p50 * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс, макс. {latencies[-1] * 1000:.1f} мс")
+    if statuses.get(503):
+        print("ℹ️ 503 — очередь обновлений переполнена (UPDATE_QUEUE_SIZE); Telegram в этом случае повторяет доставку")
+    ok = ok and statuses.get(200, 0) + statuses.get(503, 0) == args.count
+    return 0 if ok else 1
+
+
+def main() -> int:
+    load_dotenv()
+    port = os.getenv("WEB_SERVER_PORT", "8080")
+    path = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+    parser = argparse.ArgumentParser(description="Имитация Telegram для проверки режима webhook")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{port}{path}")
+    parser.add_argument("--secret", default=os.getenv("TELEGRAM_WEBHOOK_SECRET", ""))
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--first-chat", type=int, default=900000001)
+    parser.add_argument("--text", default="/help")
+    args = parser.parse_args()
+    if not args.secret:
+        print("❌ Задайте TELEGRAM_WEBHOOK_SECRET в .env или --secret")
+        return 1
+    return asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
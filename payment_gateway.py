@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Асинхронная обёртка над YooKassa SDK
+
+SDK YooKassa синхронный (requests без таймаута), поэтому прямой вызов
+Payment.create / Payment.find_one / Refund.create из обработчика блокирует
+весь event loop. Здесь вызовы выполняются в отдельном ограниченном пуле
+потоков с таймаутом ожидания, ключами идемпотентности и учётом задержек,
+а HTTP-запросам SDK задаются таймауты соединения и чтения — иначе зависший
+запрос навсегда занимал бы поток пула. Сам SDK импортируется при первом
+вызове, чтобы не замедлять запуск бота.
+"""
+
+import time
+import uuid
+import asyncio
+import logging
+import functools
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Таймаут установки соединения с YooKassa (секунды); таймаут чтения равен таймауту шлюза
+CONNECT_TIMEOUT = 5
+
+# Пространство имён для детерминированных ключей идемпотентности
+IDEMPOTENCE_NAMESPACE = uuid.UUID("7d3b6f6e-2a51-4c1f-9a55-4e2f1b3c9a10")
+
+
+class PaymentGatewayError(Exception):
+    """Ошибка обращения к YooKassa"""
+
+
+class PaymentGatewayTimeout(PaymentGatewayError):
+    """YooKassa не ответила за отведённое время"""
+
+
+def idempotence_key(*parts) -> str:
+    """Ключ идемпотентности, одинаковый для повторов одной и той же операции"""
+    return str(uuid.uuid5(IDEMPOTENCE_NAMESPACE, ":".join(str(p) for p in parts)))
+
+
+def install_http_timeout(connect_timeout: float, read_timeout: float) -> None:
+    """
+    Задаёт таймауты HTTP-запросам YooKassa SDK
+
+    ApiClient создаёт для каждого запроса сессию requests и не передаёт
+    timeout. В эту сессию монтируется адаптер с таймаутами по умолчанию;
+    повторы, настроенные SDK, сохраняются.
+    """
+    from requests.adapters import HTTPAdapter
+    from yookassa.client import ApiClient
+
+    class TimeoutHTTPAdapter(HTTPAdapter):
+        def send(self, request, timeout=None, **kwargs):
+            return super().send(request, timeout=timeout or (connect_timeout, read_timeout), **kwargs)
+
+    get_session = getattr(ApiClient.get_session, "__wrapped__", ApiClient.get_session)
+
+    @functools.wraps(get_session)
+    def get_session_with_timeout(client):
+        session = get_session(client)
+        retries = session.get_adapter("https://").max_retries
+        session.mount("https://", TimeoutHTTPAdapter(max_retries=retries))
+        return session
+
+    ApiClient.get_session = get_session_with_timeout
+
+
+class PaymentGateway:
+    """Вызовы YooKassa в ограниченном пуле потоков с таймаутами"""
+
+    def __init__(self, max_workers: int = 4, timeout: float = 15):
+        """
+        Args:
+            max_workers: Максимум одновременных запросов к YooKassa
+            timeout: Сколько секунд ждать ответа YooKassa
+        """
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yookassa")
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self._latencies = defaultdict(lambda: deque(maxlen=200))
+        self._http_timeout_installed = False
+
+    async def _call(self, operation: str, func, *args):
+        if not self._http_timeout_installed:
+            install_http_timeout(min(CONNECT_TIMEOUT, self.timeout), self.timeout)
+            self._http_timeout_installed = True
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        self.calls[operation] += 1
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._executor, functools.partial(func, *args)),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            # Бот больше не ждёт; поток освободится по таймауту HTTP-запроса (с учётом повторов SDK)
+            self.timeouts[operation] += 1
+            logging.error(f"YooKassa {operation}: нет ответа за {self.timeout} с")
+            raise PaymentGatewayTimeout(f"{operation}: таймаут {self.timeout} с")
+        except Exception:
+            self.errors[operation] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self._latencies[operation].append(elapsed)
+            logging.debug(f"YooKassa {operation}: {elapsed * 1000:.0f} мс")
+
+    async def create_payment(self, params: dict, key: str):
+        """Создаёт платёж; повтор с тем же ключом вернёт тот же платёж"""
+        from yookassa import Payment
+        return await self._call("create_payment", Payment.create, params, key)
+
+    async def find_payment(self, payment_id: str):
+        """Запрашивает актуальное состояние платежа"""
+        from yookassa import Payment
+        return await self._call("find_payment", Payment.find_one, payment_id)
+
+    async def create_refund(self, params: dict, key: str):
+        """Создаёт возврат; повтор с тем же ключом не создаст второй возврат"""
+        from yookassa import Refund
+        return await self._call("create_refund", Refund.create, params, key)
+
+    def stats(self) -> dict:
+        """Количество вызовов, ошибок, таймаутов и задержки по операциям"""
+        result = {}
+        for operation, calls in self.calls.items():
+            latencies = sorted(self._latencies[operation])
+            result[operation] = {
+                "calls": calls,
+                "errors": self.errors[operation],
+                "timeouts": self.timeouts[operation],
+                "avg_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+                "max_latency": latencies[-1] if latencies else 0.0,
+            }
+        return result
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
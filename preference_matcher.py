@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Распределение пожеланий пользователя по главам плана
+
+Ключевые слова разделов (введение, основная часть, заключение) и названия
+глав собираются в автомат Ахо–Корасик, который находит все вхождения в
+предложении за один проход, вместо перебора «предложения × главы × ключевые
+слова».
+
+Кроме точных подстрок, предложения и названия глав сравниваются по основам
+слов (russian_stemmer), поэтому «введению» или «в анализе практики» тоже
+находят свою главу, а не попадают в общие пожелания, которые добавляются
+в промпт каждой главы. С morphology=False результат совпадает с прежним
+parse_preferences_by_chapter из bot.py (проверяется скриптом
+benchmark_preferences.py).
+"""
+
+import re
+import logging
+from collections import deque
+from functools import lru_cache, cached_property
+
+from russian_stemmer import lemma
+
+# Ключевые слова для типовых разделов
+BASE_CHAPTER_KEYWORDS = {
+    'введение': ['введение', 'введении', 'во введение', 'для введения', 'во введении'],
+    'заключение': ['заключение', 'заключении', 'в заключение', 'для заключения', 'в заключении'],
+    'основная часть': ['основная часть', 'основной части', 'в основной части', 'основную часть'],
+}
+
+# Контентные ключевые слова (по смыслу содержания)
+CONTENT_KEYWORDS = {
+    'введение': [
+        'цель', 'задачи', 'задач', 'актуальность', 'актуальности',
+        'проблема', 'проблемы', 'постановка задачи',
+        'объект исследования', 'предмет исследования', 'гипотеза', 'гипотезу'
+    ],
+    'основная часть': [
+        'методология', 'методологию', 'анализ', 'исследование', 'практика',
+        'теория', 'теоретическая часть', 'обзор литературы',
+        'эксперимент', 'данные', 'данных', 'результаты', 'результатов'
+    ],
+    'заключение': [
+        'выводы', 'вывод', 'итоги', 'итог', 'резюме', 'достижения',
+        'перспективы', 'перспектив', 'рекомендации', 'рекомендаций',
+        'заключительные положения'
+    ]
+}
+
+# Названия глав длинные и у каждого заказа свои, поэтому в автомат попадает только их начало,
+# а полное совпадение проверяется для глав, у которых начало нашлось в предложении
+TITLE_ANCHOR_LENGTH = 8
+
+# Служебные слова не участвуют в сравнении по основам
+STOP_WORDS = frozenset(('в', 'во', 'для', 'по', 'о', 'об', 'про', 'на', 'и', 'к', 'с', 'со', 'из', 'у', 'а', 'или'))
+# Короткие основы слишком многозначны («цел» — и «цель», и «в целом»): для однословных
+# ключевых слов с такой основой остаётся только точное совпадение
+MIN_STEM_LENGTH = 5
+# Номер главы в начале названия («Глава 2.», «2.1») — как CHAPTER_PREFIX в text_cleaning:
+# в пожеланиях его не пишут, поэтому в сравнении по основам он не участвует
+CHAPTER_NUMBER_PREFIX = re.compile(r'^\s*(?:глава\s+)?\d+(?:\.\d+)*[\.:)]?\s*', re.IGNORECASE)
+
+WORD = re.compile(r'[^\W\d_]+')
+SENTENCE_SPLIT = re.compile(r'[.;!?]')
+LEADING_PREPOSITION = re.compile(r'^(в|для|по|о|про)\s+', re.IGNORECASE)
+LEADING_PREPOSITIONS = re.compile(r'^(?:(?:в|во|для|по|о|об|про|на)\s+)+', re.IGNORECASE)
+
+
+class KeywordAutomaton:
+    """Автомат Ахо–Корасик: все ключевые слова, встречающиеся в тексте, за один проход"""
+
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(keywords))
+        goto = [{}]
+        out = {}  # состояние → ключевые слова, которые в нём заканчиваются
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                state = next_state
+            out[state] = (keyword,)
+
+        # Ссылки неудач в порядке обхода в ширину; выходы наследуются по ссылке неудачи.
+        # Переходы сразу дополняются переходами состояния неудачи, поэтому при поиске
+        # на каждый символ приходится один поиск в словаре
+        fail = [0] * len(goto)
+        delta = [dict(children) for children in goto]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                link = delta[fail[state]].get(char, 0)
+                fail[next_state] = link
+                delta[next_state] = {**delta[link], **goto[next_state]}
+                if link in out:
+                    out[next_state] = out.get(next_state, ()) + out[link]
+        self._delta = delta
+        self._out = [out.get(state, ()) for state in range(len(goto))]
+
+    def find(self, text: str) -> set:
+        """Ключевые слова, встречающиеся в тексте как подстроки"""
+        delta, out = self._delta, self._out
+        found = set(out[0])  # пустое ключевое слово входит в любой текст
+        state = 0
+        for char in text:
+            state = delta[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+def stem_phrase(text: str) -> str:
+    """Основы значимых слов текста через пробел, с пробелами по краям (пустая строка, если слов нет)"""
+    stems = [lemma(word) for word in WORD.findall(text.lower()) if word not in STOP_WORDS]
+    return f" {' '.join(stems)} " if stems else ""
+
+
+def usable_stem_phrase(text: str) -> str:
+    """Основы для сравнения или пустая строка, если однословная основа слишком коротка"""
+    phrase = stem_phrase(text)
+    if phrase.count(" ") == 2 and len(phrase) - 2 < MIN_STEM_LENGTH:
+        return ""
+    return phrase
+
+
+def _section_keywords(normalize) -> dict:
+    """Ключевое слово (после normalize) → разделы, к которым оно относится"""
+    sections = {}
+    for section, keywords in BASE_CHAPTER_KEYWORDS.items():
+        for keyword in keywords + CONTENT_KEYWORDS.get(section, []):
+            keyword = normalize(keyword)
+            if keyword:
+                sections.setdefault(keyword, set()).add(section)
+    return sections
+
+
+KEYWORD_SECTIONS = _section_keywords(lambda keyword: keyword)
+SECTION_AUTOMATON = KeywordAutomaton(KEYWORD_SECTIONS)
+STEM_KEYWORD_SECTIONS = _section_keywords(usable_stem_phrase)
+SECTION_STEM_AUTOMATON = KeywordAutomaton(STEM_KEYWORD_SECTIONS)
+# Основы однословных ключевых слов раздела: их формы убираются из текста пожелания
+SECTION_WORD_STEMS = {
+    section: frozenset(phrase.strip() for phrase, sections in STEM_KEYWORD_SECTIONS.items()
+                       if section in sections and phrase.count(" ") == 2)
+    for section in BASE_CHAPTER_KEYWORDS
+}
+
+
+class TitleIndex:
+    """Поиск названий глав в тексте"""
+
+    def __init__(self, titles: dict):
+        """
+        Args:
+            titles: Название → позиция первой главы с таким названием
+        """
+        self.positions = titles
+        self._by_anchor = {}
+        for title in titles:
+            self._by_anchor.setdefault(title[:TITLE_ANCHOR_LENGTH], []).append(title)
+        self._automaton = KeywordAutomaton(self._by_anchor)
+
+    def find(self, text: str) -> list:
+        """Позиции глав, названия которых входят в текст"""
+        return [
+            self.positions[title]
+            for anchor in self._automaton.find(text)
+            for title in self._by_anchor[anchor]
+            if title in text
+        ]
+
+
+class ChapterIndex:
+    """Названия, разделы и ключевые слова глав одного плана"""
+
+    def __init__(self, chapters_lower: tuple):
+        self.chapters_lower = chapters_lower
+        self.first_by_section = {}
+        self.sections = []
+        self.keywords = []
+        titles = {}
+        for position, chapter_lower in enumerate(chapters_lower):
+            titles.setdefault(chapter_lower, position)
+            sections = [section for section in BASE_CHAPTER_KEYWORDS if section in chapter_lower]
+            keywords = [chapter_lower]
+            for section in sections:
+                self.first_by_section.setdefault(section, position)
+                keywords.extend(BASE_CHAPTER_KEYWORDS[section])
+                keywords.extend(CONTENT_KEYWORDS.get(section, []))
+            self.sections.append(sections)
+            self.keywords.append(tuple(keywords))
+        self.titles = TitleIndex(titles)
+
+    @cached_property
+    def stem_titles(self) -> TitleIndex:
+        """Названия глав по основам слов (строится при первом сравнении по основам)"""
+        titles = {}
+        for position, chapter_lower in enumerate(self.chapters_lower):
+            stems = usable_stem_phrase(CHAPTER_NUMBER_PREFIX.sub('', chapter_lower, count=1))
+            if stems:
+                titles.setdefault(stems, position)
+        return TitleIndex(titles)
+
+    def keyword_stems(self, position: int) -> frozenset:
+        return frozenset().union(*(SECTION_WORD_STEMS[section] for section in self.sections[position]))
+
+
+@lru_cache(maxsize=32)
+def chapter_index(chapters_lower: tuple) -> ChapterIndex:
+    return ChapterIndex(chapters_lower)
+
+
+@lru_cache(maxsize=256)
+def keyword_strip_pattern(keywords: tuple):
+    """Шаблон, убирающий упоминания главы из текста пожелания"""
+    return re.compile(f'({"|".join(re.escape(k) for k in keywords)})', re.IGNORECASE)
+
+
+def strip_keyword_forms(text: str, stems: frozenset) -> str:
+    """Убирает слова, основа которых совпадает с основой ключевого слова главы"""
+    if not stems:
+        return text
+    return WORD.sub(lambda match: '' if lemma(match.group()) in stems else match.group(), text)
+
+
+def parse_preferences_by_chapter(preferences: str, plan_array: list, morphology: bool = True) -> dict:
+    """
+    Парсит пожелания пользователя и распределяет их по главам
+
+    Предложение относится к первой по порядку плана главе, с которой совпало
+    название главы или ключевое слово её раздела (введение, основная часть,
+    заключение и их контентные слова). Остальные предложения — общие пожелания.
+
+    Args:
+        preferences: Текст пожеланий пользователя
+        plan_array: Массив глав плана (может быть автоматическим или пользовательским)
+        morphology: Сравнивать также по основам слов (иначе только точные подстроки)
+
+    Returns:
+        Словарь: {
+            'global': 'общие пожелания для всех глав',
+            'by_chapter': {
+                'Введение': 'специфичные пожелания для введения',
+                'Глава 1': 'специфичные пожелания для главы 1',
+                ...
+            }
+        }
+    """
+    result = {
+        'global': '',
+        'by_chapter': {}
+    }
+
+    if not preferences or preferences == "Без особых предпочтений":
+        return result
+
+    index = chapter_index(tuple(chapter.lower() for chapter in plan_array))
+
+    for sentence in SENTENCE_SPLIT.split(preferences):
+        sentence = sentence.strip()
+        if not sentence or len(sentence) < 5:
+            continue
+
+        sentence_lower = sentence.lower()
+        candidates = index.titles.find(sentence_lower)
+        sections = {
+            section for keyword in SECTION_AUTOMATON.find(sentence_lower) for section in KEYWORD_SECTIONS[keyword]
+        }
+        if morphology:
+            stems = stem_phrase(sentence_lower)
+            if stems:
+                candidates += index.stem_titles.find(stems)
+                sections.update(
+                    section
+                    for keyword in SECTION_STEM_AUTOMATON.find(stems)
+                    for section in STEM_KEYWORD_SECTIONS[keyword]
+                )
+        candidates += [index.first_by_section[section] for section in sections if section in index.first_by_section]
+
+        # Если не нашли соответствий - это общее пожелание для всей работы
+        if not candidates:
+            if result['global']:
+                result['global'] += '. ' + sentence
+            else:
+                result['global'] = sentence
+            continue
+
+        position = min(candidates)
+        chapter = plan_array[position]
+        chapter_preferences = result['by_chapter'].setdefault(chapter, [])
+        # Убираем упоминание главы и лишние предлоги в начале
+        if morphology:
+            # Сначала целые слова («Выводам»), чтобы от них не оставались обрывки окончаний
+            cleaned = strip_keyword_forms(sentence, index.keyword_stems(position))
+            cleaned = keyword_strip_pattern(index.keywords[position]).sub('', cleaned).strip()
+            cleaned = LEADING_PREPOSITIONS.sub('', cleaned).strip()
+        else:
+            cleaned = keyword_strip_pattern(index.keywords[position]).sub('', sentence).strip()
+            cleaned = LEADING_PREPOSITION.sub('', cleaned).strip()
+        if cleaned and len(cleaned) > 5:
+            chapter_preferences.append(cleaned)
+
+    # Объединяем списки пожеланий для каждой главы в строку
+    for chapter in result['by_chapter']:
+        result['by_chapter'][chapter] = '. '.join(result['by_chapter'][chapter])
+
+    logging.info("📋 Умное распределение пожеланий по главам:")
+    logging.info(f"   Общие пожелания: {result['global']}")
+    for chapter, prefs in result['by_chapter'].items():
+        logging.info(f"   {chapter}: {prefs}")
+
+    return result
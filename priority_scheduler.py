@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Планировщик генерации с приоритетными полосами
+
+Заменяет общий семафор: слоты выдаются в порядке приоритета полос
+(оплаченные заказы > повторы неудачных оплаченных > тестовые/админские),
+а внутри полосы — в порядке очереди. Для младших полос задаётся потолок
+одновременно занятых слотов, поэтому они не могут занять всю ёмкость.
+Слот берётся на каждый запрос к модели, так что заказ младшей полосы
+уступает освободившийся слот оплаченному заказу уже на следующей главе.
+"""
+
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Полосы по убыванию приоритета
+LANES = ("paid", "retry", "test")
+
+
+class PriorityScheduler:
+    """Ограничение параллельности с приоритетными полосами и статистикой по ним"""
+
+    def __init__(self, capacity: int, lane_limits: dict = None, lanes: tuple = LANES):
+        """
+        Args:
+            capacity: Общее количество слотов
+            lane_limits: Потолок одновременно занятых слотов для полосы, например {"test": 2}
+            lanes: Названия полос по убыванию приоритета
+        """
+        self.capacity = capacity
+        self.lanes = lanes
+        self.lane_limits = lane_limits or {}
+        self._running = {lane: 0 for lane in lanes}
+        self._waiters = {lane: deque() for lane in lanes}
+        self._granted = {lane: 0 for lane in lanes}
+        self._wait_total = {lane: 0.0 for lane in lanes}
+        self._wait_max = {lane: 0.0 for lane in lanes}
+
+    def running(self, lane: str = None) -> int:
+        """Занятые слоты (всего или в полосе)"""
+        if lane is not None:
+            return self._running[lane]
+        return sum(self._running.values())
+
+    def available(self) -> int:
+        return max(0, self.capacity - self.running())
+
+    def waiting(self, lane: str = None) -> int:
+        if lane is not None:
+            return len(self._waiters[lane])
+        return sum(len(q) for q in self._waiters.values())
+
+    def _can_start(self, lane: str) -> bool:
+        limit = self.lane_limits.get(lane, self.capacity)
+        return self.running() < self.capacity and self._running[lane] < limit
+
+    def can_start(self, lane: str) -> bool:
+        """Слот будет выдан без ожидания: есть место и никто из полос с тем же или более высоким приоритетом не ждёт"""
+        ahead = self.lanes[:self.lanes.index(lane) + 1]
+        return self._can_start(lane) and not any(self._waiters[l] for l in ahead)
+
+    async def acquire(self, lane: str) -> None:
+        if lane not in self._running:
+            raise ValueError(f"Неизвестная полоса: {lane}")
+        started = time.monotonic()
+
+        if self.can_start(lane):
+            self._running[lane] += 1
+            self._record(lane, 0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменён — возвращаем слот
+                self.release(lane)
+            else:
+                try:
+                    self._waiters[lane].remove(future)
+                except ValueError:
+                    pass
+            raise
+        self._record(lane, time.monotonic() - started)
+
+    def release(self, lane: str) -> None:
+        self._running[lane] -= 1
+        self._dispatch()
+
+    def resize(self, capacity: int) -> None:
+        """Меняет ёмкость на ходу: при увеличении ожидающие сразу получают слоты,
+        при уменьшении занятые слоты дорабатывают, а новые выдаются после их освобождения"""
+        if capacity < 1:
+            raise ValueError("capacity должно быть положительным")
+        self.capacity = capacity
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        for lane in self.lanes:
+            queue = self._waiters[lane]
+            while queue and self._can_start(lane):
+                future = queue.popleft()
+                if future.cancelled():
+                    continue
+                self._running[lane] += 1
+                future.set_result(None)
+
+    def _record(self, lane: str, waited: float) -> None:
+        self._granted[lane] += 1
+        self._wait_total[lane] += waited
+        self._wait_max[lane] = max(self._wait_max[lane], waited)
+
+    @asynccontextmanager
+    async def slot(self, lane: str = "paid"):
+        """Занимает слот в полосе на время блока"""
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self) -> dict:
+        """Статистика по полосам: занято, ждут, выдано слотов, среднее и максимальное ожидание"""
+        return {
+            lane: {
+                "running": self._running[lane],
+                "waiting": len(self._waiters[lane]),
+                "limit": self.lane_limits.get(lane, self.capacity),
+                "granted": self._granted[lane],
+                "avg_wait": self._wait_total[lane] / self._granted[lane] if self._granted[lane] else 0.0,
+                "max_wait": self._wait_max[lane],
+            }
+            for lane in self.lanes
+        }
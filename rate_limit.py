@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ограничение частоты запросов (GCRA)
+
+Для каждой пары (политика, пользователь) хранится одно число — теоретическое
+время прибытия следующего запроса (TAT). Проверка и обновление выполняются
+за O(1) и дают то же поведение, что скользящее окно «N запросов за период»,
+без списка отметок времени. Записи, у которых TAT в прошлом, ничем не
+отличаются от отсутствующих и периодически удаляются, поэтому память
+зависит только от числа недавно активных пользователей.
+
+Состояние хранится в памяти процесса или в SQLite: во втором случае оно
+переживает перезапуск и общее для нескольких процессов бота.
+"""
+
+import time
+import sqlite3
+import threading
+from functools import cached_property
+from typing import NamedTuple
+
+
+class RateLimitPolicy(NamedTuple):
+    """Не более limit запросов за period секунд"""
+    limit: int
+    period: float
+
+    @property
+    def interval(self) -> float:
+        return self.period / self.limit
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    retry_after: float  # секунды до следующего разрешённого запроса (0, если разрешён)
+    remaining: int  # сколько ещё запросов можно сделать прямо сейчас
+
+
+def gcra(tat: float, now: float, policy: RateLimitPolicy):
+    """
+    Один шаг GCRA
+
+    Returns:
+        (разрешён ли запрос, через сколько секунд повторить, новое значение TAT)
+    """
+    interval = policy.interval
+    tat = max(tat or now, now)
+    allow_at = tat - (policy.period - interval)
+    if allow_at > now:
+        return False, allow_at - now, tat
+    return True, 0.0, tat + interval
+
+
+def remaining_requests(tat: float, now: float, policy: RateLimitPolicy) -> int:
+    return max(0, int((now + policy.period - max(tat, now)) / policy.interval + 1e-9))
+
+
+class MemoryBackend:
+    """Состояние в памяти процесса"""
+
+    def __init__(self):
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, now: float, policy: RateLimitPolicy) -> RateLimitResult:
+        with self._lock:
+            allowed, retry_after, tat = gcra(self._tats.get(key), now, policy)
+            if allowed:
+                self._tats[key] = tat
+            return RateLimitResult(allowed, retry_after, remaining_requests(tat, now, policy))
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self._tats.pop(key, None)
+
+    def evict(self, now: float) -> int:
+        with self._lock:
+            expired = [key for key, tat in self._tats.items() if tat <= now]
+            for key in expired:
+                del self._tats[key]
+            return len(expired)
+
+    def size(self) -> int:
+        return len(self._tats)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBackend:
+    """Состояние в SQLite, общее для всех процессов, использующих файл"""
+
+    def __init__(self, db_path: str = "rate_limits.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+    @cached_property
+    def _conn(self) -> sqlite3.Connection:
+        """Соединение открывается при первой проверке лимита, а не при создании объекта"""
+        # Транзакции открываются явно (BEGIN IMMEDIATE), чтобы чтение и запись TAT были атомарными
+        conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL)"
+        )
+        return conn
+
+    def acquire(self, key: str, now: float, policy: RateLimitPolicy) -> RateLimitResult:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tat FROM rate_limits WHERE key = ?", (key,)).fetchone()
+                allowed, retry_after, tat = gcra(row[0] if row else None, now, policy)
+                if allowed:
+                    self._conn.execute(
+                        "INSERT INTO rate_limits (key, tat) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET tat = excluded.tat",
+                        (key, tat)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return RateLimitResult(allowed, retry_after, remaining_requests(tat, now, policy))
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_limits WHERE key = ?", (key,))
+
+    def evict(self, now: float) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,)).rowcount
+
+    def size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            conn = self.__dict__.pop("_conn", None)
+            if conn is not None:
+                conn.close()
+
+
+class RateLimiter:
+    """Ограничитель частоты запросов с отдельными политиками для разных команд"""
+
+    def __init__(self, policies: dict, backend=None, evict_interval: float = 300):
+        """
+        Args:
+            policies: Словарь {имя политики: RateLimitPolicy}
+            backend: MemoryBackend (по умолчанию) или SQLiteBackend
+            evict_interval: Как часто удалять записи неактивных пользователей (секунды)
+        """
+        self.policies = policies
+        self.backend = backend or MemoryBackend()
+        self.evict_interval = evict_interval
+        self._last_evict = time.time()
+
+    def hit(self, policy_name: str, key) -> RateLimitResult:
+        """Учитывает запрос и сообщает, укладывается ли он в политику"""
+        now = time.time()
+        if now - self._last_evict >= self.evict_interval:
+            self.evict(now)
+        policy = self.policies[policy_name]
+        return self.backend.acquire(f"{policy_name}:{key}", now, policy)
+
+    def set_policy(self, policy_name: str, policy: RateLimitPolicy) -> None:
+        """Меняет политику на ходу: сохранённые TAT остаются, новый лимит действует со следующего запроса"""
+        self.policies[policy_name] = policy
+
+    def reset(self, policy_name: str, key) -> None:
+        self.backend.reset(f"{policy_name}:{key}")
+
+    def evict(self, now: float = None) -> int:
+        """Удаляет записи, которые уже не влияют на решения"""
+        now = now or time.time()
+        self._last_evict = now
+        return self.backend.evict(now)
+
+    def size(self) -> int:
+        return self.backend.size()
+
+    def close(self) -> None:
+        self.backend.close()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Стеммер русского языка (алгоритм Snowball / Портера для русского)
+
+Отсекает окончания, суффиксы причастий, деепричастий и т.п., так что
+разные формы слова дают одну основу: «введение», «введении», «введению»
+→ «введен». Реализация на чистом Python без внешних зависимостей;
+основы слов кешируются, поскольку в пожеланиях и названиях глав
+повторяется небольшой словарь.
+"""
+
+from functools import lru_cache
+
+VOWELS = "аеиоуыэюя"
+
+PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")  # после «а» или «я»
+PERFECTIVE_GERUND_2 = ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв")
+ADJECTIVE = (
+    "ими", "ыми", "его", "ого", "ему", "ому",
+    "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+    "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+)
+PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")  # после «а» или «я»
+PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+REFLEXIVE = ("ся", "сь")
+VERB_1 = (
+    "ете", "йте", "ешь", "нно",
+    "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть",
+    "й", "л", "н",
+)  # после «а» или «я»
+VERB_2 = (
+    "ейте", "уйте",
+    "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют", "ены", "ить", "ыть", "ишь",
+    "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит", "ыт", "ую",
+    "ю",
+)
+NOUN = (
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях",
+    "ев", "ов", "ие", "ье", "еи", "ии", "ей", "ой", "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья",
+    "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я",
+)
+SUPERLATIVE = ("ейше", "ейш")
+DERIVATIONAL = ("ость", "ост")
+
+
+def _regions(word: str) -> tuple:
+    """Начала областей RV и R2 (индексы в слове)"""
+    rv = len(word)
+    for i, char in enumerate(word):
+        if char in VOWELS:
+            rv = i + 1
+            break
+
+    def next_region(start: int) -> int:
+        for i in range(start + 1, len(word)):
+            if word[i] not in VOWELS and word[i - 1] in VOWELS:
+                return i + 1
+        return len(word)
+
+    r1 = next_region(0)
+    return rv, next_region(r1)
+
+
+def _strip(word: str, start: int, endings: tuple, after_a: bool = False):
+    """
+    Отсекает самое длинное окончание из списка, если оно лежит в области [start:]
+
+    Args:
+        after_a: Окончание должно идти после «а» или «я» (сама буква остаётся)
+
+    Returns:
+        Слово без окончания или None, если ни одно окончание не подошло
+    """
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= start:
+            if after_a:
+                before = len(word) - len(ending) - 1
+                if before < start or word[before] not in "ая":
+                    continue
+            return word[:-len(ending)]
+    return None
+
+
+def _longest_first(*groups: tuple) -> tuple:
+    """Окончания двух групп в порядке убывания длины (ищется самое длинное совпадение)"""
+    return tuple(sorted(groups, key=lambda item: -len(item[0])))
+
+
+def _strip_group(word: str, start: int, plain: tuple, after_a: tuple):
+    """Самое длинное окончание из двух групп: обычной и требующей «а»/«я» перед собой"""
+    candidates = _longest_first(*((ending, False) for ending in plain), *((ending, True) for ending in after_a))
+    for ending, needs_a in candidates:
+        result = _strip(word, start, (ending,), after_a=needs_a)
+        if result is not None:
+            return result
+    return None
+
+
+def stem(word: str) -> str:
+    """Основа слова (слово в нижнем регистре)"""
+    word = word.replace("ё", "е")
+    rv, r2 = _regions(word)
+
+    # Шаг 1: деепричастие, иначе возвратная частица и прилагательное/глагол/существительное
+    result = _strip_group(word, rv, PERFECTIVE_GERUND_2, PERFECTIVE_GERUND_1)
+    if result is None:
+        word = _strip(word, rv, REFLEXIVE) or word
+        result = _strip(word, rv, ADJECTIVE)
+        if result is not None:
+            result = _strip_group(result, rv, PARTICIPLE_2, PARTICIPLE_1) or result
+        else:
+            result = _strip_group(word, rv, VERB_2, VERB_1)
+            if result is None:
+                result = _strip(word, rv, NOUN)
+    word = result if result is not None else word
+
+    # Шаг 2: конечная «и»
+    word = _strip(word, rv, ("и",)) or word
+
+    # Шаг 3: словообразовательный суффикс в области R2
+    word = _strip(word, r2, DERIVATIONAL) or word
+
+    # Шаг 4: «нн» → «н», превосходная степень, мягкий знак
+    if word.endswith("нн") and len(word) - 2 >= rv:
+        return word[:-1]
+    superlative = _strip(word, rv, SUPERLATIVE)
+    if superlative is not None:
+        word = superlative
+        if word.endswith("нн") and len(word) - 2 >= rv:
+            word = word[:-1]
+        return word
+    return _strip(word, rv, ("ь",)) or word
+
+
+@lru_cache(maxsize=65536)
+def lemma(word: str) -> str:
+    """Основа слова с кешированием (словарь пожеланий и названий глав невелик)"""
+    return stem(word.lower())
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Клиент поиска источников через Coze workflow
+
+Одна долгоживущая aiohttp-сессия с общим пулом соединений (без нового
+TCP+TLS рукопожатия на каждый заказ), TTL-кеш по ключевым словам и
+объединение одинаковых запросов: если несколько заказов одновременно ищут
+источники по одной теме, в Coze уходит один запрос.
+"""
+
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+
+class CozeSourceClient:
+    """Клиент Coze workflow с пулом соединений, кешем и coalescing"""
+
+    def __init__(self, api_url: str, token: str, workflow_id: str, parse_response,
+                 timeout: float = 30, cache_ttl: float = 6 * 3600, cache_size: int = 500,
+                 connection_limit: int = 20):
+        """
+        Args:
+            api_url: URL запуска workflow
+            token: Bearer-токен Coze API
+            workflow_id: ID workflow поиска источников
+            parse_response: Функция, превращающая JSON ответа в список источников
+            timeout: Общий таймаут одного запроса (секунды)
+            cache_ttl: Время жизни записи кеша (секунды)
+            cache_size: Максимальное количество тем в кеше
+            connection_limit: Размер пула соединений
+        """
+        self.api_url = api_url
+        self.token = token
+        self.workflow_id = workflow_id
+        self.parse_response = parse_response
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.connection_limit = connection_limit
+
+        self._session = None
+        self._cache = OrderedDict()  # ключ -> (истекает_в, источники)
+        self._inflight = {}  # ключ -> asyncio.Task
+
+        # Метрики
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=200)  # Длительность запросов к Coze, секунды
+
+    @staticmethod
+    def cache_key(keywords: str) -> str:
+        return " ".join(keywords.lower().split())
+
+    async def fetch(self, keywords: str) -> list:
+        """
+        Возвращает источники по ключевым словам
+
+        Returns:
+            Список словарей с ключами 'title' и 'url' (пустой при ошибке)
+        """
+        self.requests += 1
+        key = self.cache_key(keywords)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires_at, sources = cached
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                logging.info(f"Источники для '{keywords}' взяты из кеша ({len(sources)} шт.)")
+                return list(sources)
+            del self._cache[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logging.info(f"Запрос источников для '{keywords}' объединён с уже выполняющимся")
+        else:
+            task = asyncio.ensure_future(self._fetch_and_cache(key, keywords))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # shield: отмена одного ожидающего заказа не отменяет общий запрос
+        return list(await asyncio.shield(task))
+
+    async def _fetch_and_cache(self, key: str, keywords: str) -> list:
+        started = time.monotonic()
+        sources = await self._request(keywords)
+        self._latencies.append(time.monotonic() - started)
+
+        # Пустой результат не кешируем: это почти всегда ошибка или таймаут
+        if sources:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, sources)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return sources
+
+    async def _request(self, keywords: str) -> list:
+        logging.info(f"Запрос источников через Coze workflow по ключевым словам: {keywords}")
+
+        headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json"
+        }
+        # ВАЖНО: Простой запрос (только ключевые слова) даёт максимум источников (~10)
+        # Сложные инструкции с указанием количества уменьшают результат до 3 источников
+        payload = {
+            "workflow_id": self.workflow_id,
+            "parameters": {
+                "input": keywords
+            }
+        }
+
+        try:
+            session = self._get_session()
+            async with session.post(self.api_url, headers=headers, json=payload) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    logging.debug(f"Ответ от Coze API: {str(data)[:500]}")
+                    sources = self.parse_response(data)
+                    logging.info(f"Получено источников: {len(sources)}")
+                    return sources
+                error_text = await response.text()
+                self.errors += 1
+                logging.error(f"Ошибка при запросе к Coze API: {response.status}, {error_text[:300]}")
+                return []
+        except asyncio.TimeoutError:
+            self.errors += 1
+            logging.error("Таймаут при запросе к Coze API")
+            return []
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Исключение при запросе к Coze API: {e}")
+            return []
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp  # импортируется вместе с первой сессией, а не при запуске бота
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> dict:
+        """Метрики клиента: доля попаданий в кеш и задержки Coze"""
+        latencies = sorted(self._latencies)
+        avg_latency = sum(latencies) / len(latencies) if latencies else 0.0
+        p95_latency = latencies[min(len(latencies) - 1, math.ceil(0.95 * len(latencies)) - 1)] if latencies else 0.0
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "hit_rate": self.cache_hits / self.requests if self.requests else 0.0,
+            "avg_latency": avg_latency,
+            "p95_latency": p95_latency,
+            "cached_topics": len(self._cache),
+        }
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка и обогащение списка источников
+
+Источники дедуплицируются по нормализованному URL и DOI, классифицируются
+по типу (статья, Википедия, нормативный акт, книга, документ, веб-ресурс)
+для оформления по ГОСТ, проверяются HEAD-запросами и дополняются
+метаданными Crossref для DOI. Сетевые запросы идут пачкой под общим
+ограничением параллельности, результаты кешируются.
+"""
+
+import re
+import time
+import asyncio
+import logging
+from datetime import datetime
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode, unquote
+
+DOI_PATTERN = re.compile(r"\b(10\.\d{4,9}/[^\s\"<>?#]+)", re.IGNORECASE)
+
+# Параметры ссылок, не влияющие на содержимое страницы
+TRACKING_PARAMS = ("utm_", "yclid", "gclid", "fbclid", "_openstat", "from")
+
+SOURCE_TYPES = {
+    "article": (
+        "doi.org", "elibrary.ru", "cyberleninka.ru", "scholar.google", "sciencedirect.com",
+        "springer.com", "link.springer.com", "wiley.com", "jstor.org", "ncbi.nlm.nih.gov",
+        "arxiv.org", "researchgate.net", "mdpi.com", "tandfonline.com", "vak.ed.gov.ru",
+    ),
+    "wikipedia": ("wikipedia.org",),
+    "legal": ("consultant.ru", "garant.ru", "pravo.gov.ru", "kremlin.ru/acts", "sozd.duma.gov.ru"),
+    "book": ("books.google", "litres.ru", "biblio-online.ru", "urait.ru", "znanium.com", "ozon.ru/product"),
+    "dissertation": ("dissercat.com", "disser.rsl.ru"),
+}
+
+# Ответы, после которых источник считается недоступным и исключается
+DEAD_STATUSES = (404, 410)
+
+
+def normalize_url(url: str) -> str:
+    """Приводит URL к каноническому виду для дедупликации"""
+    url = (url or "").strip()
+    if not url:
+        return ""
+    parsed = urlparse(url if "://" in url else f"https://{url}")
+    netloc = parsed.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    if netloc.startswith("m.") and "wikipedia.org" in netloc:
+        netloc = netloc[2:]
+    query = urlencode([
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if not k.lower().startswith(TRACKING_PARAMS)
+    ])
+    path = unquote(parsed.path).rstrip("/")
+    return urlunparse(("https", netloc, path, "", query, ""))
+
+
+def extract_doi(source: dict) -> str:
+    """Извлекает DOI из URL или названия источника (в нижнем регистре)"""
+    for text in (unquote(source.get("url") or ""), source.get("title") or ""):
+        match = DOI_PATTERN.search(text)
+        if match:
+            return match.group(1).rstrip(".,;)").lower()
+    return ""
+
+
+def classify_source(source: dict) -> str:
+    """Определяет тип источника для оформления по ГОСТ"""
+    if source.get("doi") or extract_doi(source):
+        return "article"
+    url = (source.get("url") or "").lower()
+    for source_type, markers in SOURCE_TYPES.items():
+        if any(marker in url for marker in markers):
+            return source_type
+    if url.split("?")[0].endswith(".pdf") or "pdf" in (source.get("content_type") or ""):
+        return "document"
+    return "web"
+
+
+def dedupe_sources(sources: list) -> list:
+    """Удаляет повторы по DOI и нормализованному URL, сохраняя порядок"""
+    seen = set()
+    result = []
+    for source in sources:
+        doi = extract_doi(source)
+        key = f"doi:{doi}" if doi else normalize_url(source.get("url", "")) or source.get("title", "").lower()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        item = dict(source)
+        if doi:
+            item["doi"] = doi
+        result.append(item)
+    return result
+
+
+class SourceEnricher:
+    """Пакетная проверка ссылок и получение метаданных по DOI"""
+
+    def __init__(self, concurrency: int = 8, timeout: float = 5, cache_ttl: float = 24 * 3600,
+                 crossref_url: str = "https://api.crossref.org/works/", session=None):
+        """
+        Args:
+            concurrency: Максимум одновременных сетевых запросов
+            timeout: Таймаут одного запроса (секунды)
+            cache_ttl: Время жизни результатов проверки в кеше (секунды)
+            crossref_url: Адрес API метаданных DOI (можно подменить локальной заглушкой)
+            session: Готовая aiohttp-сессия (по умолчанию создаётся своя)
+        """
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.crossref_url = crossref_url
+        self._session = session
+        self._own_session = session is None
+        self._cache = {}  # ключ -> (истекает_в, данные)
+
+    async def enrich(self, sources: list) -> list:
+        """
+        Дедуплицирует, проверяет и классифицирует источники
+
+        Недоступные ссылки (404/410) исключаются, при ошибках сети источник
+        остаётся в списке без проверки.
+
+        Returns:
+            Список источников с полями 'type', 'accessed', а также
+            'doi', 'authors', 'journal', 'year', если они известны
+        """
+        unique = dedupe_sources(sources)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def process(source: dict):
+            async with semaphore:
+                return await self._enrich_one(source)
+
+        results = await asyncio.gather(*(process(s) for s in unique), return_exceptions=True)
+
+        enriched = []
+        for source, result in zip(unique, results):
+            if isinstance(result, Exception):
+                logging.warning(f"Не удалось проверить источник {source.get('url')}: {result}")
+                result = dict(source)
+            if result is None:
+                continue
+            result.setdefault("accessed", datetime.now().strftime("%d.%m.%Y"))
+            result["type"] = classify_source(result)
+            enriched.append(result)
+
+        dropped = len(sources) - len(enriched)
+        if dropped:
+            logging.info(f"Из списка источников исключено повторов и недоступных: {dropped}")
+        return enriched
+
+    async def _enrich_one(self, source: dict):
+        item = dict(source)
+        url = item.get("url", "")
+
+        if url:
+            check = await self._cached(f"url:{normalize_url(url)}", lambda: self._check_url(url))
+            if check.get("dead"):
+                logging.info(f"Источник недоступен ({check.get('status')}): {url}")
+                return None
+            if check.get("content_type"):
+                item["content_type"] = check["content_type"]
+            if check.get("checked_at"):
+                item["accessed"] = check["checked_at"]
+
+        doi = item.get("doi")
+        if doi:
+            metadata = await self._cached(f"doi:{doi}", lambda: self._fetch_doi_metadata(doi))
+            for key in ("authors", "journal", "year", "publisher"):
+                if metadata.get(key) and not item.get(key):
+                    item[key] = metadata[key]
+            if metadata.get("title") and item.get("title") in ("", "Источник", None):
+                item["title"] = metadata["title"]
+        return item
+
+    async def _cached(self, key: str, factory):
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        value = await factory()
+        # Сетевые ошибки (пустой результат) не кешируем, чтобы проверить ссылку в следующий раз
+        if value:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, value)
+        return value
+
+    async def _check_url(self, url: str) -> dict:
+        import aiohttp
+        session = self._get_session()
+        try:
+            async with session.head(url, allow_redirects=True) as response:
+                status = response.status
+                content_type = response.headers.get("Content-Type", "")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Сайт может не отвечать на HEAD или быть временно недоступен — не исключаем
+            logging.debug(f"HEAD {url} не выполнен: {e}")
+            return {}
+        return {
+            "status": status,
+            "dead": status in DEAD_STATUSES,
+            "content_type": content_type.lower(),
+            "checked_at": datetime.now().strftime("%d.%m.%Y"),
+        }
+
+    async def _fetch_doi_metadata(self, doi: str) -> dict:
+        import aiohttp
+        session = self._get_session()
+        try:
+            async with session.get(f"{self.crossref_url}{doi}") as response:
+                if response.status != 200:
+                    return {}
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.debug(f"Метаданные DOI {doi} не получены: {e}")
+            return {}
+
+        message = data.get("message", {}) if isinstance(data, dict) else {}
+        authors = [
+            f"{a.get('family', '')} {a.get('given', '')[:1]}.".strip()
+            for a in message.get("author", [])[:3]
+            if a.get("family")
+        ]
+        year_parts = (message.get("issued") or {}).get("date-parts") or [[None]]
+        titles = message.get("title") or [""]
+        journals = message.get("container-title") or [""]
+        return {
+            "title": titles[0],
+            "authors": ", ".join(authors),
+            "journal": journals[0],
+            "year": str(year_parts[0][0]) if year_parts[0][0] else "",
+            "publisher": message.get("publisher", ""),
+        }
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp  # импортируется вместе с первой сессией, а не при запуске бота
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": "NinjaEssayAI/1.0 (source verification)"}
+            )
+            self._own_session = True
+        return self._session
+
+    async def close(self) -> None:
+        if self._own_session and self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальный библиографический индекс NinjaEssayAI
+
+Каждый источник, когда-либо полученный от Coze, сохраняется в SQLite
+(название, URL, домен, ключевые слова темы) и индексируется полнотекстовым
+индексом FTS5. Поиск по ключевым словам темы занимает миллисекунды и
+используется как первый уровень перед Coze и как резерв, когда Coze
+недоступен или вернул мало источников.
+"""
+
+import re
+import time
+import sqlite3
+import logging
+import threading
+from functools import cached_property
+from urllib.parse import urlparse
+
+# Слова короче этой длины не участвуют в поиске (предлоги, союзы)
+MIN_TOKEN_LENGTH = 3
+
+
+def tokenize(text: str) -> list:
+    """Разбивает текст на слова для поиска (без повторов, в нижнем регистре)"""
+    tokens = []
+    for word in re.findall(r"\w+", text.lower()):
+        if len(word) >= MIN_TOKEN_LENGTH and word not in tokens:
+            tokens.append(word)
+    return tokens
+
+
+def token_prefix(token: str) -> str:
+    """Грубое отсечение окончания: «экономики» и «экономика» дают один префикс"""
+    if len(token) <= 5:
+        return token
+    return token[:max(5, len(token) - 2)]
+
+
+class SourceIndex:
+    """Индекс источников на SQLite FTS5 (с запасным вариантом на LIKE)"""
+
+    def __init__(self, db_path: str = "source_index.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._fts_enabled = None
+
+    @cached_property
+    def _conn(self) -> sqlite3.Connection:
+        """Соединение открывается при первом обращении к индексу, а не при создании объекта"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sources (
+                id INTEGER PRIMARY KEY,
+                url TEXT UNIQUE NOT NULL,
+                title TEXT NOT NULL,
+                domain TEXT,
+                keywords TEXT,
+                hits INTEGER DEFAULT 0,
+                added_at REAL,
+                last_seen_at REAL
+            )
+        """)
+        try:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS sources_fts USING fts5(title, keywords)"
+            )
+            self._fts_enabled = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite собран без FTS5, локальный индекс источников работает через LIKE")
+            self._fts_enabled = False
+        conn.commit()
+        return conn
+
+    @property
+    def fts_enabled(self) -> bool:
+        """Доступен ли FTS5 (определяется при открытии базы)"""
+        self._conn  # открывает базу, если она ещё не открыта
+        return self._fts_enabled
+
+    def add(self, sources: list, keywords: str) -> int:
+        """
+        Добавляет источники в индекс и привязывает к ним ключевые слова темы
+
+        Args:
+            sources: Список словарей с ключами 'title' и 'url'
+            keywords: Ключевые слова темы, по которой источники были найдены
+
+        Returns:
+            Количество новых источников
+        """
+        new_count = 0
+        now = time.time()
+        query_tokens = tokenize(keywords)
+        with self._lock:
+            for source in sources:
+                url = (source.get("url") or "").strip()
+                title = (source.get("title") or "").strip()
+                if not url or not title:
+                    continue
+
+                row = self._conn.execute(
+                    "SELECT id, keywords FROM sources WHERE url = ?", (url,)
+                ).fetchone()
+                if row is None:
+                    cursor = self._conn.execute(
+                        "INSERT INTO sources (url, title, domain, keywords, added_at, last_seen_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (url, title, urlparse(url).netloc.lower(), " ".join(query_tokens), now, now)
+                    )
+                    source_id = cursor.lastrowid
+                    merged = " ".join(query_tokens)
+                    new_count += 1
+                else:
+                    source_id, old_keywords = row
+                    old_tokens = (old_keywords or "").split()
+                    merged = " ".join(old_tokens + [t for t in query_tokens if t not in old_tokens])
+                    self._conn.execute(
+                        "UPDATE sources SET title = ?, keywords = ?, last_seen_at = ? WHERE id = ?",
+                        (title, merged, now, source_id)
+                    )
+
+                if self.fts_enabled:
+                    self._conn.execute("DELETE FROM sources_fts WHERE rowid = ?", (source_id,))
+                    self._conn.execute(
+                        "INSERT INTO sources_fts (rowid, title, keywords) VALUES (?, ?, ?)",
+                        (source_id, title, merged)
+                    )
+            self._conn.commit()
+
+        if new_count:
+            logging.info(f"В локальный индекс добавлено источников: {new_count}")
+        return new_count
+
+    def search(self, keywords: str, limit: int, exclude_urls=(), match_all: bool = False) -> list:
+        """
+        Ищет источники по ключевым словам темы
+
+        Args:
+            keywords: Ключевые слова темы
+            limit: Максимальное количество источников
+            exclude_urls: URL, которые уже есть в списке и не нужны повторно
+            match_all: Требовать совпадения всех слов (иначе достаточно любого)
+
+        Returns:
+            Список словарей с ключами 'title' и 'url', лучшие совпадения первыми
+        """
+        tokens = tokenize(keywords)
+        if not tokens or limit <= 0:
+            return []
+
+        exclude = set(exclude_urls)
+        with self._lock:
+            if self.fts_enabled:
+                operator = " AND " if match_all else " OR "
+                match = operator.join(f'"{token_prefix(t)}"*' for t in tokens)
+                rows = self._conn.execute(
+                    "SELECT s.id, s.title, s.url FROM sources_fts "
+                    "JOIN sources s ON s.id = sources_fts.rowid "
+                    "WHERE sources_fts MATCH ? ORDER BY bm25(sources_fts) LIMIT ?",
+                    (match, limit + len(exclude))
+                ).fetchall()
+            else:
+                rows = self._search_like(tokens, limit + len(exclude), match_all)
+
+            result = []
+            for source_id, title, url in rows:
+                if url in exclude:
+                    continue
+                result.append({"title": title, "url": url})
+                self._conn.execute("UPDATE sources SET hits = hits + 1 WHERE id = ?", (source_id,))
+                if len(result) >= limit:
+                    break
+            self._conn.commit()
+        return result
+
+    def _search_like(self, tokens: list, limit: int, match_all: bool) -> list:
+        conditions = []
+        params = []
+        for token in tokens:
+            conditions.append("(title LIKE ? OR keywords LIKE ?)")
+            pattern = f"%{token_prefix(token)}%"
+            params.extend([pattern, pattern])
+        where = (" AND " if match_all else " OR ").join(conditions)
+        rows = self._conn.execute(
+            f"SELECT id, title, url, title || ' ' || keywords FROM sources WHERE {where}",
+            params
+        ).fetchall()
+        # Ранжируем по количеству совпавших слов
+        prefixes = [token_prefix(t) for t in tokens]
+        scored = sorted(
+            rows,
+            key=lambda row: -sum(1 for p in prefixes if p in row[3].lower())
+        )
+        return [(row[0], row[1], row[2]) for row in scored[:limit]]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            conn = self.__dict__.pop("_conn", None)
+            if conn is not None:
+                conn.close()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Распределение пожеланий по главам: автомат против прежнего перебора
+
+С morphology=False preference_matcher должен относить пожелания к тем же
+главам, что и прежний parse_preferences_by_chapter из bot.py (эталон и
+корпус — из benchmark_preferences.py).
+"""
+
+import random
+
+import pytest
+
+import preference_matcher
+from benchmark_preferences import (
+    SHORT_PLAN, STEM_CASES, build_cases, diploma_plan, preferences_text, reference_parse_preferences_by_chapter
+)
+
+
+def corpus() -> list:
+    rng = random.Random(7)
+    cases = build_cases(rng)
+    cases += [(preferences_text(sentences, rng), diploma_plan(chapters, rng))
+              for chapters in (3, 12, 35) for sentences in (2, 15, 40) for _ in range(5)]
+    cases += [
+        ("В анализе практики приведи три примера. Введению удели две страницы", SHORT_PLAN),
+        ("Во введении укажи цель; в заключении — выводы", ["Введение", "Введение", "Заключение"]),
+        ("Заключение сделай коротким", ["Глава 1. Введение", "Глава 2. Заключение"]),
+    ]
+    return cases
+
+
+@pytest.mark.parametrize("preferences, plan", corpus())
+def test_exact_matching_equals_reference(preferences, plan):
+    assert preference_matcher.parse_preferences_by_chapter(preferences, plan, morphology=False) == \
+        reference_parse_preferences_by_chapter(preferences, plan)
+
+
+@pytest.mark.parametrize("preferences, plan, chapter", STEM_CASES)
+def test_stem_matching_routes_to_chapter(preferences, plan, chapter):
+    parsed = preference_matcher.parse_preferences_by_chapter(preferences, plan)
+    assert chapter in parsed["by_chapter"]
+    assert parsed["global"] == ""
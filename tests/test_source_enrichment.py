@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка SourceEnricher на локальной заглушке HTTP (aiohttp)
+
+Заглушка отвечает на HEAD-запросы проверки ссылок (200, 404, 410) и
+отдаёт метаданные DOI в формате Crossref; ссылка на закрытый порт
+изображает сайт, который не отвечает.
+"""
+
+import asyncio
+import socket
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from source_enrichment import SourceEnricher
+
+DOI = "10.1000/xyz123"
+
+CROSSREF_WORK = {
+    "message": {
+        "title": ["Цифровая экономика: теория и практика"],
+        "author": [{"family": "Иванов", "given": "Иван"}, {"family": "Петров", "given": "Пётр"}],
+        "container-title": ["Вопросы экономики"],
+        "issued": {"date-parts": [[2021, 5]]},
+        "publisher": "НИУ ВШЭ",
+    }
+}
+
+
+def closed_port() -> int:
+    """Порт, на котором никто не слушает"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def enrich_with_stub(sources_for) -> tuple:
+    """Запускает заглушку и возвращает (результат enrich, число запросов по путям)"""
+    hits = {}
+
+    async def page(request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+        status = {"/missing": 404, "/gone": 410}.get(request.path, 200)
+        return web.Response(status=status, content_type="text/html")
+
+    async def crossref(request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+        if request.match_info["doi"] != DOI:
+            return web.Response(status=404)
+        return web.json_response(CROSSREF_WORK)
+
+    app = web.Application()
+    app.router.add_get("/works/{doi:.+}", crossref)
+    app.router.add_get("/{path:.*}", page)
+    server = TestServer(app)
+    await server.start_server()
+    base = str(server.make_url("")).rstrip("/")
+    enricher = SourceEnricher(concurrency=4, timeout=2, crossref_url=f"{base}/works/")
+    try:
+        return await enricher.enrich(sources_for(base)), hits
+    finally:
+        await enricher.close()
+        await server.close()
+
+
+def test_dead_links_dropped_and_duplicates_checked_once():
+    dead_port = closed_port()
+
+    def sources(base):
+        return [
+            {"title": "Статья о рынке труда", "url": f"{base}/article?utm_source=coze"},
+            {"title": "Та же статья", "url": f"{base}/article/"},
+            {"title": "Удалённая страница", "url": f"{base}/missing"},
+            {"title": "Снятая публикация", "url": f"{base}/gone"},
+            {"title": "Сайт не отвечает", "url": f"http://127.0.0.1:{dead_port}/page"},
+        ]
+
+    result, hits = asyncio.run(enrich_with_stub(sources))
+
+    assert [source["title"] for source in result] == ["Статья о рынке труда", "Сайт не отвечает"]
+    # Повтор с другими параметрами отслеживания и слэшем проверяется один раз
+    assert hits["/article"] == 1
+    assert hits["/missing"] == 1 and hits["/gone"] == 1
+    # Недоступный по сети источник остаётся, но без отметки о проверке
+    assert "content_type" not in result[1]
+    assert result[0]["content_type"].startswith("text/html")
+
+
+def test_doi_metadata_merged_without_overwriting():
+    def sources(base):
+        return [
+            {"title": "Источник", "url": f"{base}/doi/{DOI}"},
+            {"title": "Дубликат по DOI", "url": f"{base}/mirror?doi={DOI}"},
+            {"title": "Статья с известным годом", "url": f"{base}/doi/10.1000/unknown", "year": "2019"},
+        ]
+
+    result, hits = asyncio.run(enrich_with_stub(sources))
+
+    assert len(result) == 2
+    merged, unknown = result
+    assert merged["doi"] == DOI
+    assert merged["title"] == "Цифровая экономика: теория и практика"
+    assert merged["authors"] == "Иванов И., Петров П."
+    assert merged["journal"] == "Вопросы экономики"
+    assert merged["year"] == "2021"
+    assert merged["publisher"] == "НИУ ВШЭ"
+    assert merged["type"] == "article"
+    assert hits[f"/works/{DOI}"] == 1
+    # Crossref не знает DOI: поля источника не меняются
+    assert unknown["year"] == "2019"
+    assert unknown["title"] == "Статья с известным годом"
+    assert "authors" not in unknown
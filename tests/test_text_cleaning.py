@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Совпадение text_cleaning с прежними реализациями из bot.py
+
+Эталонные функции и корпус глав берутся из benchmark_text_cleaning.py:
+каждое сочетание вводной фразы модели, варианта заголовка и текста главы
+должно давать тот же результат (или ту же ошибку), что и раньше.
+"""
+
+import pytest
+
+import text_cleaning
+from benchmark_text_cleaning import (
+    builtin_corpus, call, reference_validate_generated_content, reference_remove_chapter_title_from_text
+)
+
+CORPUS = builtin_corpus() + [
+    ("", ""),
+    ("Введение", "Введение"),
+    ("Глава 2. Анализ практики", "Глава 2. Анализ практики\n\nКороткий текст."),
+    ("Заключение", "ЗАКЛЮЧЕНИЕ:\n\n" + "Выводы по работе. " * 30),
+    ("Анализ (2015–2023 гг.)", "Анализ (2015–2023 гг.)\n" + "Текст с [скобками] и *звёздочками*. " * 20),
+]
+
+
+@pytest.mark.parametrize("title, text", CORPUS)
+def test_validate_generated_content_matches_reference(title, text):
+    assert call(text_cleaning.validate_generated_content, text, title) == \
+        call(reference_validate_generated_content, text, title)
+
+
+@pytest.mark.parametrize("title, text", CORPUS)
+def test_remove_chapter_title_matches_reference(title, text):
+    assert call(text_cleaning.remove_chapter_title_from_text, text, title) == \
+        call(reference_remove_chapter_title_from_text, text, title)
+
+
+def test_corpus_exercises_both_outcomes():
+    """Корпус содержит и принятые, и отклонённые как слишком короткие главы"""
+    results = [call(text_cleaning.validate_generated_content, text, title) for title, text in CORPUS]
+    assert any(result.startswith("ValueError") for result in results)
+    assert any(not result.startswith("ValueError") for result in results)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Очистка сгенерированного текста глав
+
+Все регулярные выражения компилируются один раз при импорте модуля.
+Результат функций совпадает с прежними реализациями из bot.py символ
+в символ (проверяется скриптом benchmark_text_cleaning.py), меняется
+только стоимость: функции вызываются для каждой главы каждого заказа.
+"""
+
+import re
+import logging
+from functools import lru_cache
+
+# Эмодзи и пиктограммы, удаляемые из текста глав и пунктов плана
+EMOJI_PATTERN = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"  # эмоции
+    "\U0001F300-\U0001F5FF"  # символы и пиктограммы
+    "\U0001F680-\U0001F6FF"  # транспорт и символы на карте
+    "\U0001F1E0-\U0001F1FF"  # флаги
+    "\U00002702-\U000027B0"  # разное
+    "\U000024C2-\U0001F251"  # заключенные символы
+    "\U0001F900-\U0001F9FF"  # дополнительные смайлики
+    "\U0001FA70-\U0001FAFF"  # расширенные символы
+    "\U00002500-\U00002BEF"  # китайские символы
+    "\U0001F018-\U0001F270"  # разные символы
+    "\U00002300-\U000023FF"  # технические символы
+    "\U0001F004-\U0001F0CF"  # игровые символы
+    "]+"
+)
+
+# Для темы на титульном листе исторически используется более узкий набор диапазонов
+THEME_EMOJI_PATTERN = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"
+    "\U0001F300-\U0001F5FF"
+    "\U0001F680-\U0001F6FF"
+    "\U0001F1E0-\U0001F1FF"
+    "\U00002702-\U000027B0"
+    "\U000024C2-\U0001F251"
+    "\U0001F900-\U0001F9FF"
+    "\U0001FA70-\U0001FAFF"
+    "]+"
+)
+
+# Вводные предложения модели («Отлично, вот текст...»). Каждый шаблон проверяется
+# один раз и по порядку, начиная с места, где закончилось предыдущее удаление
+UNWANTED_OPENERS = tuple(re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'[^.]*отлично[^.]*\.',
+    r'[^.]*вот план[^.]*\.',
+    r'[^.]*рассмотрим[^.]*\.',
+    r'[^.]*вот текст[^.]*\.',
+    r'[^.]*итак[^.]*\.',
+    r'[^.]*составленный с учетом[^.]*\.',
+    r'[^.]*план .* по теме[^.]*\.',
+))
+
+NUMBER_PREFIX = re.compile(r'^\d+\.\s*')
+CHAPTER_PREFIX = re.compile(r'^Глава\s+\d+[\.:]\s*', re.IGNORECASE)
+
+MIN_CLEANED_LENGTH = 200
+
+
+def remove_emojis(text: str) -> str:
+    """Удаляет все эмодзи и смайлики из текста"""
+    if not text:
+        return text
+    return EMOJI_PATTERN.sub('', text)
+
+
+def remove_theme_emojis(theme: str) -> str:
+    """Очищает тему работы от смайликов для титульного листа"""
+    return THEME_EMOJI_PATTERN.sub('', theme).strip()
+
+
+def validate_generated_content(content: str, chapter: str) -> str:
+    """Валидирует и очищает сгенерированный контент от нежелательных фраз и смайликов"""
+    if not content or len(content.strip()) < 100:
+        raise ValueError(f"Слишком короткий контент для главы {chapter}")
+
+    content = remove_emojis(content).strip()
+
+    # Вместо удаления каждого предложения через re.sub сдвигаем начало текста
+    start = 0
+    for pattern in UNWANTED_OPENERS:
+        match = pattern.match(content, start)
+        if match:
+            start = match.end()
+    content_cleaned = content[start:].lstrip()
+
+    # Проверяем, что осталось достаточно контента
+    if len(content_cleaned.rstrip()) < MIN_CLEANED_LENGTH:
+        logging.warning(f"Контент для главы {chapter} стал слишком коротким после очистки")
+        return content  # Возвращаем оригинал
+
+    return content_cleaned
+
+
+@lru_cache(maxsize=256)
+def chapter_title_patterns(clean_title: str) -> tuple:
+    """
+    Шаблоны заголовка главы в начале строки
+
+    Returns:
+        (быстрая проверка, что заголовок вообще встречается в начале строки;
+        шаблоны удаления в порядке применения)
+    """
+    title = re.escape(clean_title)
+    upper = re.escape(clean_title.upper())
+    flags = re.IGNORECASE | re.MULTILINE
+    probe = re.compile(rf'^(?:Глава\s+\d+[\.:]\s*|\d+\.\s*|#+\s*|\*\*)?(?:{title}|{upper})', flags)
+    patterns = tuple(re.compile(pattern, flags) for pattern in (
+        # С номером главы в начале: "1. Введение", "Глава 1. Введение", "Глава 1: Введение"
+        rf'^Глава\s+\d+[\.:]\s*{title}\.?\s*\n*',
+        rf'^\d+\.\s*{title}\.?\s*\n*',
+        # Без номера: "Введение", "ВВЕДЕНИЕ"
+        rf'^{title}\.?\s*\n*',
+        rf'^{upper}\.?\s*\n*',
+        # С дополнительными символами
+        rf'^#+\s*{title}\.?\s*\n*',
+        rf'^\*\*{title}\*\*\.?\s*\n*',
+    ))
+    return probe, patterns
+
+
+def remove_chapter_title_from_text(chapter_text: str, chapter_title: str) -> str:
+    """Удаляет дублирующийся заголовок главы из начала текста
+
+    Args:
+        chapter_text: Текст главы, возможно содержащий заголовок
+        chapter_title: Название главы для поиска и удаления
+
+    Returns:
+        Текст без дублирующегося заголовка
+    """
+    if not chapter_text or not chapter_title:
+        return chapter_text
+
+    # Очищаем название главы от номеров и лишних символов для поиска
+    clean_title = NUMBER_PREFIX.sub('', chapter_title, count=1).strip()
+    clean_title = CHAPTER_PREFIX.sub('', clean_title, count=1).strip()
+
+    result = chapter_text.strip()
+    probe, patterns = chapter_title_patterns(clean_title)
+    # Каждый шаблон начинается с заголовка (с необязательным префиксом), поэтому
+    # если его нет ни в одной строке, удалять нечего
+    if probe.search(result):
+        for pattern in patterns:
+            result = pattern.sub('', result, count=1)
+
+    # Удаляем лишние переносы строк в начале
+    return result.lstrip('\n').strip()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Параллельная обработка обновлений Telegram с порядком внутри чата
+
+По умолчанию Application обрабатывает обновления строго по одному, и
+медленный обработчик (админ-отчёт, тестовый заказ) задерживает всех
+пользователей. ChatOrderedUpdateProcessor обрабатывает обновления разных
+чатов параллельно (не больше concurrency одновременно), а обновления
+одного чата — по очереди в порядке поступления, поэтому шаги
+ConversationHandler и user_data пользователя не перемешиваются.
+
+Обновление, которое ждёт предыдущее из своего чата, не занимает слот
+обработки: слот берётся только после получения очереди чата, поэтому
+поток сообщений из одного чата не останавливает остальные.
+"""
+
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Не больше concurrency обновлений одновременно, по одному на чат"""
+
+    def __init__(self, concurrency: int, max_pending: int = 1000):
+        """
+        Args:
+            concurrency: Сколько обновлений обрабатывается одновременно
+            max_pending: Сколько обновлений может одновременно ждать очереди
+                своего чата или слота (семафор базового класса)
+        """
+        super().__init__(max(max_pending, concurrency, 2))
+        if concurrency < 1:
+            raise ValueError("concurrency должно быть положительным")
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        # Очереди чатов: замок и число обновлений, которые его держат или ждут
+        self._chats = {}
+        self._running = 0
+        self._pending = 0
+
+    @staticmethod
+    def chat_key(update: object):
+        """Чат, внутри которого сохраняется порядок; None — обновление не привязано к чату"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        self._pending += 1
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._pending -= 1
+
+    async def _process(self, update: object, coroutine) -> None:
+        key = self.chat_key(update)
+        if key is None:
+            async with self._slots:
+                await self._run(coroutine)
+            return
+
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock отдаёт замок ожидающим в порядке очереди — порядок поступления сохраняется
+            async with entry[0]:
+                async with self._slots:
+                    await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def _run(self, coroutine) -> None:
+        self._running += 1
+        try:
+            await coroutine
+        finally:
+            self._running -= 1
+
+    def in_progress(self) -> int:
+        """Обновления, которые обрабатываются или ждут очереди своего чата либо слота"""
+        return self._pending
+
+    def running(self) -> int:
+        return self._running
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
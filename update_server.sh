@@ -1,19 +1,24 @@
 #!/bin/bash
 
 # Скрипт для обновления бота на сервере
+# Бот останавливается только на время перезапуска: код и зависимости
+# обновляются, пока работает старая версия
 cd /home/ninja/NinjaEssayAI
 
-# Останавливаем сервис
-sudo systemctl stop ninjaessayai-bot
-
 # Получаем последние изменения
 git pull origin main
 
 # Устанавливаем зависимости (если есть новые)
 pip3 install -r requirements.txt
 
-# Запускаем сервис обратно
-sudo systemctl start ninjaessayai-bot
+# Проверяем, что новая версия импортируется (импорт bot.py без побочных действий)
+if ! python3 -c "import bot"; then
+    echo "❌ Новая версия не импортируется, сервис не перезапущен"
+    exit 1
+fi
+
+# Перезапускаем сервис
+sudo systemctl restart ninjaessayai-bot
 
 # Проверяем статус
 sudo systemctl status ninjaessayai-bot
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Встроенный HTTP-сервер бота, приём обновлений Telegram и уведомлений YooKassa
+
+Один aiohttp-сервер работает в том же event loop, что и бот. На нём
+регистрируются обработчики уведомлений о платежах; сами уведомления
+не считаются доверенными — бот повторно запрашивает статус платежа
+в YooKassa перед тем, как изменить заказ. В режиме webhook тот же сервер
+принимает обновления Telegram и ставит их в ограниченную очередь бота.
+"""
+
+import hmac
+import asyncio
+import logging
+import ipaddress
+
+from aiohttp import web
+
+# Заголовок с секретом, заданным в setWebhook (secret_token)
+TELEGRAM_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Адреса, с которых YooKassa отправляет HTTP-уведомления
+# https://yookassa.ru/developers/using-api/webhooks#ip
+YOOKASSA_IP_RANGES = [
+    ipaddress.ip_network(net) for net in (
+        "185.71.76.0/27",
+        "185.71.77.0/27",
+        "77.75.153.0/25",
+        "77.75.156.11/32",
+        "77.75.156.35/32",
+        "77.75.154.128/25",
+        "2a02:5180::/32",
+    )
+]
+
+
+def is_yookassa_ip(ip: str) -> bool:
+    """Проверяет, что адрес входит в список адресов YooKassa"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in YOOKASSA_IP_RANGES)
+
+
+def get_client_ip(request: web.Request, trust_forwarded: bool = False) -> str:
+    """Адрес клиента; за reverse proxy берётся из X-Forwarded-For"""
+    if trust_forwarded:
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.remote or ""
+
+
+class WebServer:
+    """aiohttp-сервер, общий для всех HTTP-эндпоинтов бота"""
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080):
+        self.host = host
+        self.port = port
+        self.app = web.Application(client_max_size=1024 * 1024)
+        self._runner = None
+
+    def add_route(self, method: str, path: str, handler) -> None:
+        self.app.router.add_route(method, path, handler)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        logging.info(f"HTTP-сервер бота запущен на {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def yookassa_webhook_handler(on_notification, trust_forwarded: bool = False,
+                             check_ip: bool = True):
+    """
+    Создаёт обработчик HTTP-уведомлений YooKassa
+
+    Args:
+        on_notification: Корутина (event, object_id), вызываемая для каждого уведомления;
+            object_id — id платежа для payment.* и id возврата для refund.*
+        trust_forwarded: Доверять заголовку X-Forwarded-For (бот за reverse proxy)
+        check_ip: Проверять, что запрос пришёл с адреса YooKassa
+
+    Returns:
+        aiohttp-обработчик запроса
+    """
+    async def handler(request: web.Request) -> web.Response:
+        client_ip = get_client_ip(request, trust_forwarded)
+        if check_ip and not is_yookassa_ip(client_ip):
+            logging.warning(f"Уведомление YooKassa с недоверенного адреса {client_ip} отклонено")
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            event = data["event"]
+            object_id = data["object"]["id"]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        logging.info(f"Уведомление YooKassa: {event} для {object_id}")
+        try:
+            await on_notification(event, object_id)
+        except Exception as e:
+            # 5xx — YooKassa повторит уведомление позже
+            logging.error(f"Ошибка обработки уведомления YooKassa {event} {object_id}: {e}")
+            return web.Response(status=500)
+        return web.Response(status=200)
+
+    return handler
+
+
+def telegram_webhook_handler(on_update, secret_token: str):
+    """
+    Создаёт обработчик обновлений Telegram (режим webhook)
+
+    Args:
+        on_update: Функция (data), ставящая обновление в очередь бота; при
+            переполнении очереди выбрасывает asyncio.QueueFull
+        secret_token: Секрет из setWebhook; запросы без него отклоняются
+
+    Returns:
+        aiohttp-обработчик запроса
+    """
+    expected = secret_token.encode()
+
+    async def handler(request: web.Request) -> web.Response:
+        received = request.headers.get(TELEGRAM_SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(received, expected):
+            logging.warning(f"Обновление Telegram с неверным секретом от {request.remote} отклонено")
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            if not isinstance(data, dict) or "update_id" not in data:
+                raise ValueError("нет update_id")
+            on_update(data)
+        except asyncio.QueueFull:
+            # Не 2xx — Telegram повторит доставку позже, обновление не теряется
+            logging.warning("Очередь обновлений переполнена, Telegram повторит доставку")
+            return web.Response(status=503)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Некорректное обновление Telegram отклонено: {e}")
+            return web.Response(status=400)
+        return web.Response(status=200)
+
+    return handler
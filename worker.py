@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воркер выполнения заказов NinjaEssayAI
+
+Забирает задания из таблицы order_jobs и выполняет их тем же кодом, что и
+бот: план и главы через DeepSeek, источники, сборка .docx и доставка через
+Bot API. С ORDER_WORKERS_EXTERNAL=true бот только ставит задания, а
+генерацию и сборку документов выполняют воркеры — каждый в своём процессе
+и на своём ядре. Воркеры можно запускать на нескольких машинах, если у них
+общая база (DATABASE_URL) и хранилище документов (ARTIFACTS_DIR).
+
+Остановка (SIGTERM, Ctrl+C) возвращает выполняемые задания в очередь —
+их продолжит другой воркер с сохранённых глав.
+
+Запуск: python worker.py [--concurrency 10] [--processes 2]
+"""
+
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import multiprocessing
+
+from telegram import Bot
+
+import bot
+from priority_scheduler import PriorityScheduler
+from engines.storage import init_db
+from engines.generation import GENERATION_RETRY_LANE_LIMIT, GENERATION_TEST_LANE_LIMIT
+from engines.sources import close_sources
+from engines.settings import settings, watch_settings
+from engines.jobs import consume_order_jobs, consumer_id
+
+
+async def serve(concurrency: int) -> None:
+    """Потребляет задания до сигнала остановки"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: остановка по Ctrl+C через KeyboardInterrupt
+
+    # Как order_scheduler бота: младшие полосы не занимают всю ёмкость воркера
+    scheduler = PriorityScheduler(concurrency, lane_limits={
+        "retry": GENERATION_RETRY_LANE_LIMIT,
+        "test": GENERATION_TEST_LANE_LIMIT,
+    })
+    telegram_bot = Bot(bot.TELEGRAM_BOT_TOKEN, request=bot.InstrumentedRequest(connection_pool_size=64))
+    async with telegram_bot:
+        # Ёмкость генерации и модели меняются через /admin_config без перезапуска воркера
+        watcher = asyncio.create_task(watch_settings())
+        consumer = asyncio.create_task(consume_order_jobs(
+            lambda job: bot.run_order_job(telegram_bot, job), consumer_id("worker"), scheduler
+        ))
+        stopped = asyncio.create_task(stop.wait())
+        await asyncio.wait({consumer, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        for task in (consumer, stopped, watcher):
+            task.cancel()
+        await asyncio.gather(consumer, stopped, watcher, return_exceptions=True)
+    await close_sources()
+    logging.info("Воркер остановлен")
+
+
+def run_worker(concurrency: int) -> None:
+    """Один процесс-воркер: свой event loop, планировщик и клиент Bot API"""
+    bot.configure_logging()
+    bot.check_config()
+    if not bot.TELEGRAM_BOT_TOKEN:
+        raise ValueError("Переменная окружения TELEGRAM_BOT_TOKEN не установлена")
+    settings.refresh()
+    try:
+        asyncio.run(serve(concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Воркер выполнения заказов")
+    parser.add_argument("--concurrency", type=int, default=settings.get("MAX_ACTIVE_ORDERS"),
+                        help="заказов одновременно в одном процессе")
+    parser.add_argument("--processes", type=int, default=1, help="число процессов-воркеров")
+    args = parser.parse_args()
+
+    bot.configure_logging()
+    # Схема создаётся один раз, до запуска процессов
+    init_db()
+    if args.processes <= 1:
+        run_worker(args.concurrency)
+        return 0
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args.concurrency,), name=f"worker-{i + 1}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Запущено воркеров: {len(processes)} по {args.concurrency} заказов")
+
+    # SIGTERM передаётся воркерам; Ctrl+C они получают сами вместе с группой процессов
+    signal.signal(signal.SIGTERM, lambda signum, frame: [p.terminate() for p in processes])
+    for process in processes:
+        while True:
+            try:
+                process.join()
+                break
+            except KeyboardInterrupt:
+                continue
+    return max(process.exitcode or 0 for process in processes)
+
+
+if __name__ == '__main__':
+    sys.exit(main())